@@ -1,22 +1,40 @@
 #!/usr/bin/env python3
 
+import asyncio
 import inspect
 import os
-import sys
+import shutil
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 from subprocess import PIPE, Popen
 
-import pandas as pd
 import psutil
 from colorama import Back, Fore, Style, init
+from fieldtools.src.admission import (SpaceAdmission, copy_rate,
+                                       plan_transfers, scan_card)
 from fieldtools.src.aesthetics import (arrow, asterbar, build_logo, info,
                                        tcolor, tstyle)
+from fieldtools.src.devices import (DeviceWatcher, is_card_label,
+                                     volume_inventory)
+from fieldtools.src.faceplates import (FaceplateStore, last_read_date,
+                                        read_rt_file)
+from fieldtools.src.fatimage import image_and_extract
 from fieldtools.src.funs import (clean_vols, copy_with_progress, ensure_mount,
-                                 fetch_recorder_info, find_sdiskpart,
-                                 get_mountedlist, get_nestbox_id, is_faceplate,
-                                 umount_and_rmdir)
+                                 file_fingerprint, find_sdiskpart,
+                                 format_digest, get_deployment_index,
+                                 is_faceplate, link_file, new_hasher,
+                                 plan_nestboxes,
+                                 sweep_partial_copies, umount_and_rmdir)
+from fieldtools.src.ledger import CopyLedger
+from fieldtools.src.metrics import MetricsLogger
 from fieldtools.src.paths import DATA_DIR, OUT_DIR, safe_makedir, valid_vols_list
+from fieldtools.src.pipeline import Pipeline, Stage
+from fieldtools.src.privhelper import HelperError, get_helper
+from fieldtools.src.progress import TransferProgress, human_bytes, human_time
+from fieldtools.src.verify import Verifier, report as verify_report
+from fieldtools.src.wavmeta import parse_wav_header
 from fieldtools.version import __version__
 from pathlib2 import Path
 
@@ -29,9 +47,44 @@ open_origin_window = False
 verbose = False  # Whether to print non-critical errors - not complete
 check_for_drive = False  # Whether to check if the destination drive is mounted
 warn_others = False
+# Maximum number of cards to copy at the same time (one worker per card)
+max_concurrent_cards = 4
+# Whether to checksum files as they are copied (needed to verify copies
+# before formatting, see `verify_copies` in format-cards)
+checksums = True
+# Whether to skip files whose data has already been copied (found by content,
+# whatever their name or card; needs checksums = True). Only copies made
+# with it on can be found as duplicates later.
+deduplicate = True
+# Whether to re-read every copy from disk and compare it with its checksum
+# (or with the card) before the card is released
+verify_after_copy = True
+# Number of files re-read at the same time when verifying
+verify_workers = 4
+# Days an interrupted copy is kept to be resumed (if its card is inserted
+# again); older partial copies are removed when the app starts
+resume_days = 7
+# Free space to always leave at the destination (cards that would eat into
+# it are not copied)
+reserve_bytes = 2 * 1024 ** 3
+# Whether to add the reads in faceplate RT files to the faceplate store
+# (a Parquet dataset, see src/faceplates.py; needs pyarrow)
+store_faceplate_reads = True
+# Whether to read each card in one sequential pass into an image file (only
+# the clusters in use), extract its files from the image and copy them from
+# there (they are linked into place if IMAGE_DIR is on the same disk as
+# DESTINATION_DIR). The card can be removed as soon as it has been read,
+# and cards with many small files are read much faster than file by file.
+image_cards = False
+# Seconds reading a card into an image can take before the read is killed
+# and the card is copied file by file instead
+image_timeout = 3600
 
 # Where to copy the files to (AMs)
 DESTINATION_DIR = DATA_DIR / 'raw' / str(date.today().year)
+# Where card images and the files extracted from them are kept until the
+# files have been copied and verified (if image_cards)
+IMAGE_DIR = DATA_DIR / 'card-images'
 
 # Folders of interest (not currently used)
 folder_names = ['caca' for i in list(range(1, 61))]
@@ -83,196 +136,603 @@ if check_for_drive:
             print(yellow + 'The Data drive is not mounted. Mount it.', end="\r")
             time.sleep(1)
 
-# Store volumes that have been already copied
+# Store volumes that have been copied and verified
 already_done = []
-checked_cards = []
-
-# Clean any mounted volumes
-clean_vols()
-
-# Counter (for progress bar)
-it = 0
-
-while True:
-    print(arrow + tcolor('Scanning for cards',
-                         tstyle.lightgrey), asterbar[it % len(asterbar)], end="\r")
-    time.sleep(.1)
-    it += 1
-
-    # Mount any cards not already mounted
+# Cards somewhere in the pipeline, by volume name
+in_flight = set()
+# Cards with copies that failed verification, or that were skipped (e.g.
+# they could not be mounted or did not fit): they are left alone until they
+# are removed (their label disappears), then copied again when they are
+# inserted again
+held = set()
+# Set when the app has to stop: no new cards are picked up, and the cards
+# in the pipeline are finished (or just unmounted)
+stopping = threading.Event()
+
+
+def stop(job):
+    # Skip this card and stop once the others are done (a stage can't
+    # sys.exit(): it runs in a worker thread)
+    job.skip = True
+    if not stopping.is_set():
+        stopping.set()
+        print(red + 'Stopping once the cards being copied are done')
+
+
+class CardJob:
+    """A card on its way through the copy pipeline.
+    """
+
+    def __init__(self, label, device):
+        self.label = label
+        self.device = device
+        self.mountpoint = None
+        self.files = []
+        self.plan = []  # (file, target directory) pairs
+        self.copied = []  # (file, copy) pairs
+        self.skip = False  # Set if a stage fails; the card is only unmounted
+        self.reads = None  # Parsed RT file, for faceplate cards
+        self.flagged = []  # Recordings with a broken header
+        self.digests = {}  # Checksum of each copied file, if taken
+        self.sizes = {}  # Size of each file in the card
+        self.fingerprints = {}  # See funs.file_fingerprint()
+        self.staging = None  # Files extracted from an image of the card
+        self.bad = []  # Files whose copy failed verification
+        self.short = []  # Files that could not be read whole from the image
+
+    @property
+    def card(self):
+        # (mount point, volume name), as used by the rest of the code
+        return (self.mountpoint, self.label)
+
+
+# Pipeline stages: detect -> mount -> image -> plan -> copy -> verify ->
+# unmount
+
+async def detect_cards():
+    """Yield a CardJob for every new card as soon as it is plugged in.
+    """
+    loop = asyncio.get_running_loop()
+    it = 0  # Counter (for progress bar)
+    while not stopping.is_set():
+        if not in_flight:
+            print(arrow + tcolor('Scanning for cards',
+                                 tstyle.lightgrey), asterbar[it % len(asterbar)], end="\r")
+        changed = await loop.run_in_executor(None, watcher.wait, .1)
+        it += 1
+
+        # Only look at devices if a card has been inserted, removed,
+        # mounted or unmounted
+        if not changed:
+            continue
+        volumes = volume_inventory()
+        held.intersection_update(volumes)
+        for label, vol in sorted(volumes.items()):
+            if (is_card_label(label, valid_vols_list) and
+                    label not in in_flight and label not in already_done
+                    and label not in held):
+                in_flight.add(label)
+                metrics.emit('card_detected', card=label)
+                print(info + f'Found {label}' + ' ' * 20)
+                yield CardJob(label, vol.device)
+
+
+def mount_card(job):
+    # Mount the card if it is not mounted yet
     # (sometimes automount does not work)
-    checked_cards = ensure_mount(
-        valid_directories, 0, checked_cards, already_done, verbose)
-
-    # This is older code and can be made redundant at some point;
-    # just take the right devices from the valid_devices list!
-    mounted = get_mountedlist()
-    new_paths = [dev for dev in mounted if not dev in already_done]
-    valid_faceplates = [(dev, Path(dev).name)
-                        for dev in new_paths if is_faceplate(dev)]
-    valid_audiomoths = sum([[(drive, card[0]) for drive in new_paths
-                             if card[0] in drive] for card in valid_directories], [])
-    valid = valid_faceplates + valid_audiomoths
-
-    # Skip if there are no new cards
-    if not valid:
-        continue
-    else:
-
-        if valid_audiomoths:
-            # Get updated information about recorders.
-            try:
-                recorders_info = fetch_recorder_info(recorders_dir)
-            except FileNotFoundError as e:
-                print(info + tcolor(inspect.cleandoc("""
-                You need to have a .csv file with information
-                about recorder deployment before you can use this program"""), tstyle.rojoroto))
-                sys.exit()
-
-            except IndexError as e:
-                print(info + tcolor(inspect.cleandoc(f"""The file {recorders_dir.name} is empty.
-                You need to have a .csv file with information
-                about recorder deployment before you can use this app"""), tstyle.rojoroto))
-                sys.exit()
-        # Open nautilus window
-        if open_origin_window:
-            for card in valid:
-                open_window = f"nautilus '{card[0]}'"
-                Popen(["/bin/bash", "-c", open_window])
-                time.sleep(1)
-
-        for card in valid:
+    vol = volume_inventory().get(job.label)
+    if vol is not None and vol.mountpoint is None:
+        with metrics.timed('mount', card=job.label):
+            ensure_mount(valid_directories, 0, [], already_done, verbose,
+                         volumes={job.label: vol})
+        vol = volume_inventory().get(job.label)
+    if vol is None or vol.mountpoint is None:
+        print(red + f'Could not mount {job.label}, skipping')
+        job.skip = True
+        return job
+    job.mountpoint = vol.mountpoint
+
+    # Open nautilus window
+    if open_origin_window:
+        Popen(["/bin/bash", "-c", f"nautilus '{job.mountpoint}'"])
+    return job
+
+
+def image_card(job):
+    """Read the card into an image and extract its files, if image_cards.
+
+    The files are then read from the extracted folder instead of the card
+    (it has the card's name, so the ledger sees the same paths), and the
+    card is released straight away.
+    """
+    if job.skip or not image_cards:
+        return job
+    # The image holds the used part of the card, and the files a copy of
+    # it. Once they are on disk they count in the free space, and the
+    # reservation is given back.
+    st = os.statvfs(job.mountpoint)
+    used = (st.f_blocks - st.f_bfree) * st.f_frsize
+    key = f'{job.label} image'
+    decision = image_admission.request(
+        key, 2 * used, on_defer=lambda d: print(
+            yellow + f'Waiting for other cards to finish before imaging '
+            f'{job.label} ({human_bytes(d.needed)} needed)'))
+    if decision.status == 'reject':
+        print(yellow + f'Not enough space in {IMAGE_DIR} to image '
+              f'{job.label} ({human_bytes(2 * used)} needed); copying it '
+              'file by file')
+        return job
+
+    helper = get_helper()
+
+    def read_ranges(device, image, ranges):
+        result = helper.run_one('read_ranges', device, image, ranges,
+                                timeout=image_timeout)
+        if result['returncode'] != 0:
+            raise OSError(result['returncode'], result['stderr'].strip())
+
+    print(info + f'Reading {job.label} ({human_bytes(used)} in use) ...')
+    try:
+        with metrics.timed('image', card=job.label) as fields:
+            result = image_and_extract(job.device, IMAGE_DIR, job.label,
+                                       reader=read_ranges,
+                                       mountpoint=job.mountpoint)
+            fields.update(bytes=result['bytes_read'],
+                          files=len(result['files']))
+    except (OSError, ValueError, HelperError) as e:
+        print(red + f'Could not image {job.label} ({e}); copying it file '
+              'by file')
+        shutil.rmtree(IMAGE_DIR / job.label, ignore_errors=True)
+        return job
+    finally:
+        image_admission.release(key)
+    # Files whose cluster chain ends early are not copied (nor recorded as
+    # copied): the card is not formatted until they have been. What could
+    # be read of them is kept under a quarantine name, outside the folder
+    # (which is cleared if the card is imaged again)
+    for path in result['short']:
+        relpath = os.path.relpath(path, result['path'])
+        kept = IMAGE_DIR / 'incomplete' / job.label / f'{relpath}.failed'
+        safe_makedir(kept)
+        os.replace(path, kept)
+        job.short.append(path)
+
+    with metrics.timed('unmount', card=job.label):
+        release_card(job.card)
+    print(yellow + f'{job.label} has been read. It is now safe to remove.')
+    job.staging = result['path']
+    job.mountpoint = job.staging
+    return job
+
+
+def plan_card(job):
+    """List the files in a card and decide where each of them goes.
+    """
+    if job.skip or stopping.is_set():
+        job.skip = True
+        return job
+    card = job.card
+    print(
+        tcolor('\n' + f'Trying to copy {card[1]} ...', tstyle.mustard))
+
+    if is_faceplate(card[0]):
+        # If this is a faceplate card
+        job.sizes = scan_card(card[0], '.TXT')
+        files = list(job.sizes)
+        # Skip card if there are no files
+        if len(files) == 0:
+            print(f'Card {card[1]} seems to be empty, skipping.')
+            job.skip = True
+            return job
+        # Open RT file
+        try:
+            path = [
+                file for file in files if file.endswith('RT.TXT')][0]
+        except:  # TODO: handle this!
             print(
-                tcolor('\n' + f'Trying to copy {card[1]} ...', tstyle.mustard))
-
-            if is_faceplate(card[0]):
-                # If this is a faceplate card
-                files = [os.path.join(card[0], i)
-                         for i in os.listdir(card[0]) if i.endswith('.TXT')]
-                # Skip card if there are no files
-                if len(files) == 0:
-                    print(f'Card {card[1]} seems to be empty, skipping.')
-                    already_done.append(card[1])
-                    continue
-                # Open RT file
-                try:
-                    path = [
-                        file for file in files if file.endswith('RT.TXT')][0]
-                except:  # TODO: handle this!
-                    print(
-                        f'There is no RT file in this faceplate card ({card[1]}), skipping')
-                    already_done.append(card[1])
-                    continue
-
-                if os.path.isfile(path):
-                    tmp = pd.read_csv(path, sep='\s*\t\s*',
-                                      header=0, engine='python')
-                    cols = [
-                        col for col in tmp.columns if 'TagID' in col]
-                    if cols:
-                        data = tmp.dropna(subset=[cols[0]]).query(
-                            'Date != "Date"')
-                    else:
-                        continue
-                else:
-                    print('There is no RT file in this faceplate card, skipping')
-                    continue
-                # This try/except block is temporary /
-                # need to add option to ask for faceplating date to avoid this issue
-                try:
-                    # Get first date in faceplate
-                    f_datetime = pd.to_datetime(
-                        data['Date']).to_list()[-1].date()
-
-                    # Out folder name
-                    faceplate_out = OUT_DIR / 'faceplates' / \
-                        f'{str(f_datetime)}_{card[1]}'
-                except:
-                    faceplate_out = OUT_DIR / 'faceplates' / \
-                        f'ENTER_DATE_{card[1]}'
+                f'There is no RT file in this faceplate card ({card[1]}), skipping')
+            job.skip = True
+            return job
+
+        if os.path.isfile(path):
+            data = read_rt_file(path)
+            if data is None:
+                job.skip = True
+                return job
+        else:
+            print('There is no RT file in this faceplate card, skipping')
+            job.skip = True
+            return job
+        # The folder is named after the last read; if the log has no
+        # readable dates it is ENTER_DATE_<card>, to be renamed by hand
+        f_datetime = last_read_date(data)
+        if f_datetime is not None:
+            # Out folder name
+            faceplate_out = OUT_DIR / 'faceplates' / \
+                f'{str(f_datetime)}_{card[1]}'
+        else:
+            faceplate_out = OUT_DIR / 'faceplates' / \
+                f'ENTER_DATE_{card[1]}'
+
+        job.files = files
+        job.plan = [(file, faceplate_out) for file in files]
+        job.reads = data
 
+    else:
+        # If this is an Audiomoth card
+        # List files in card (with their sizes, in one pass)
+        job.sizes = scan_card(card[0], '.WAV')
+        files = list(job.sizes)
+        # Skip card if there are no files
+        if len(files) == 0:
+            print(f'Card {card[1]} seems to be empty, skipping.')
+            job.skip = True
+            return job
+
+        # Get updated information about recorders
+        # (only re-read if the file has changed)
+        try:
+            deployments = get_deployment_index(recorders_dir)
+        except FileNotFoundError:
+            print(info + tcolor(inspect.cleandoc("""
+            You need to have a .csv file with information
+            about recorder deployment before you can use this program"""), tstyle.rojoroto))
+            stop(job)
+            return job
+
+        if deployments.empty:
+            print(info + tcolor(inspect.cleandoc(f"""The file {recorders_dir.name} is empty.
+            You need to have a .csv file with information
+            about recorder deployment before you can use this app"""), tstyle.rojoroto))
+            stop(job)
+            return job
+
+        # get AM number
+        am = int(card[1][2:4])
+
+        # Get the nestbox of every file in the card
+        plan, unmatched, ambiguous = plan_nestboxes(deployments, am, files)
+        if ambiguous:
+            print(tcolor('\n\n' + inspect.cleandoc(f"""
+                    There are more than one row compatible with the
+                    AM / date combination of {len(ambiguous)} file(s) in {card[1]}:
+                    {', '.join(Path(file).name for file in ambiguous)}"""), tstyle.rojoroto))
+        if unmatched:
+            print(tcolor('\n\n' + inspect.cleandoc(f"""
+                    There are no rows compatible with the
+                    AM / date combination of {len(unmatched)} file(s) in {card[1]}:
+                    {', '.join(Path(file).name for file in unmatched)}
+                    Check that you have entered the deployment information in
+                    {recorders_dir}"""), tstyle.rojoroto))
+
+        job.files = files
+        job.plan = [(file, DESTINATION_DIR / plan[file])
+                    for file in files if file in plan]
+    return job
+
+
+def copy_card(job):
+    """Copy the planned files of a card to their destination.
+    """
+    if job.skip:
+        return job
+
+    # Copies that failed verification are redone, whatever is in their place
+    redo = ledger.failed([file for file, _ in job.plan])
+    todo, skipped = plan_transfers(job.plan, job.sizes, redo=redo)
+    for file, t_file in skipped:
+        print(
+            f'File {Path(file).name} exists in destination {t_file.parent}; skipping.')
+    if deduplicate:
+        todo = skip_duplicates(job, todo)
+
+    # Files extracted from an image to the destination disk are linked into
+    # place instead of being written again (their space was reserved when
+    # the card was imaged)
+    link = (job.staging is not None and job.reads is None and
+            os.stat(job.staging).st_dev == os.stat(DESTINATION_DIR).st_dev)
+
+    # Only start if the whole card fits at the destination (faceplate logs
+    # are tiny and go to OUT_DIR)
+    needed = sum(transfer.size for transfer in todo)
+    if link:
+        print(info + f'{job.label}: {len(todo)} file(s) to move into place')
+    else:
+        print(info + f'{job.label}: {len(todo)} file(s), '
+              f'{human_bytes(needed)} to copy '
+              f'(~{human_time(needed / typical_rate)} at '
+              f'{human_bytes(typical_rate)}/s)')
+    if job.reads is None and not link:
+        decision = admission.request(
+            job.label, needed, on_defer=lambda d: print(
+                yellow + f'Waiting for other cards to finish before copying '
+                f'{job.label} ({human_bytes(d.needed)} needed, '
+                f'{human_bytes(max(d.available, 0))} free)'))
+        if decision.status == 'reject':
+            print(red + f'Not enough space in {DESTINATION_DIR} for '
+                  f'{job.label}: {human_bytes(needed)} needed, '
+                  f'{human_bytes(max(decision.available, 0))} available '
+                  f'(keeping {human_bytes(admission.reserve)} free). '
+                  'Skipping.')
+            job.skip = True
+            return job
+
+    progress.add(job.label, needed, len(todo))
+    card_start = time.perf_counter()
+    try:
+        for file, target, t_file, size in todo:
+            # Make sure that directory exists
+            safe_makedir(target)
+            # Copy
+            hasher = new_hasher() if checksums else None
+            header = []
+            start = time.perf_counter()
+            shown = progress.file_callback(job.label)
+            on_written = admission.file_callback(job.label)
+
+            def callback(copied, total):
+                shown(copied, total)
+                on_written(copied, total)
+            on_header = header.append if file.endswith('.WAV') else None
+            if link:
+                link_file(file, t_file, hasher=hasher, on_header=on_header)
+                callback(size, size)
             else:
-                # If this is an Audiomoth card
-                # List files in card
-                files = [os.path.join(card[0], i)
-                         for i in os.listdir(card[0]) if i.endswith('.WAV')]
-                # Skip card if there are no files
-                if len(files) == 0:
-                    print(f'Card {card[1]} seems to be empty, skipping.')
-                    already_done.append(card[1])
-                    # Unmount card, remove mount point
-                    try:
-                        p = find_sdiskpart(card[0])
-                    except psutil.Error:
-                        print('Something went wrong :D')
-                    while os.path.exists(card[0]):
-                        umount_and_rmdir(0, card)
-                        if verbose:
-                            print('Trying to umount again')
-                    continue
-
-                # get AM number
-                am = int(card[1][2:4])
-
-            # Otherwise, copy them to the right folder
-            copied = []
-            for file in files:
-                if not is_faceplate(card[0]):
-                    # Get date of file
-                    filedate = pd.to_datetime(
-                        Path(file).stem, format='%Y%m%d_%H%M%S')
-                    # Get nestbox
-                    nestbox = get_nestbox_id(
-                        recorders_dir, recorders_info, card, am, filedate)
-                    if not nestbox:
-                        continue
-                    # Copy file
-                    target = DESTINATION_DIR / nestbox
-                else:
-                    target = faceplate_out
-
-                t_file = target / Path(file).name
-
-                if t_file.exists():
-                    print(
-                        f'File {Path(file).name} exists in destination {target}; skipping.')
-                    continue
-                else:
-                    # Make sure that directory exists
-                    safe_makedir(target)
-                    # Copy
-                    copy_with_progress(file, target)
-                    # Add to copied list
-                    copied.append(os.sep.join(
-                        os.path.normpath(file).split(os.sep)[-2:]))
-
-            # Successful?
-            n_copied = len(copied)
-            if n_copied > 0:
-                print(
-                    Fore.GREEN +
-                    Style.BRIGHT +
-                    f'\n{n_copied} out of {len(files)} file(s) succesfully copied from {card[1]}')
-                # Save to register of copied files
-                with open(OUT_DIR / 'copied.txt', 'a') as cp:
-                    for item in copied:
-                        cp.write("%s\n" % item)
+                copy_with_progress(file, target, callback=callback,
+                                   hasher=hasher, journal=ledger,
+                                   on_header=on_header)
+            metrics.emit('file_copied', card=job.label, file=Path(file).name,
+                         bytes=size,
+                         seconds=round(time.perf_counter() - start, 4))
+            progress.file_done(job.label)
+            # Add to copied list and to the ledger
+            job.copied.append((file, t_file))
+            job.digests[file] = format_digest(hasher) if checksums else None
+            ledger.record(job.label, file, t_file, digest=job.digests[file],
+                          fingerprint=job.fingerprints.get(file))
+            if header:
+                check_recording(job, file, t_file, header[0], size)
+    finally:
+        admission.release(job.label)
+        progress.remove(job.label)
+        copied_bytes = sum(job.sizes[file] for file, _ in job.copied)
+        metrics.emit('card_copied', card=job.label, files=len(job.copied),
+                     bytes=copied_bytes,
+                     seconds=round(time.perf_counter() - card_start, 4))
+    return job
+
+
+def skip_duplicates(job, todo):
+    """Fingerprint the files to copy and leave out (and report) those whose
+    data has already been copied, e.g. from the same card under another
+    label. Returns the transfers that are left.
+    """
+    unique, duplicates = [], []
+    for transfer in todo:
+        fingerprint = file_fingerprint(transfer.file)
+        job.fingerprints[transfer.file] = fingerprint
+        original = ledger.find_duplicate(transfer.file, fingerprint)
+        if original is None:
+            unique.append(transfer)
+            continue
+        duplicates.append((transfer.file, original['destination']))
+        ledger.record(job.label, transfer.file, original['destination'],
+                      status='duplicate', digest=original['digest'],
+                      fingerprint=fingerprint)
+    if duplicates:
+        print(yellow + f'{len(duplicates)} file(s) in {job.label} have '
+              'already been copied from another card; skipping:')
+        for file, destination in duplicates:
+            print(f'  {Path(file).name} = {destination}')
+    return unique
+
+
+def check_recording(job, file, t_file, head, size):
+    # Header fields go to the ledger; broken recordings are flagged now,
+    # not when the analysis fails
+    meta = parse_wav_header(head, size)
+    ledger.record_wav_metadata(job.label, file, t_file, meta)
+    if meta['problems']:
+        job.flagged.append(file)
+        print(red + f'\n{job.label}/{Path(file).name}: '
+              f'{"; ".join(meta["problems"])}')
+
+
+def verify_card(job):
+    """Check every copy against its source (its size, or also its checksum
+    if verify_after_copy), and add the reads of faceplate cards to the
+    faceplate store.
+    """
+    if job.skip:
+        return job
+    if verify_after_copy:
+        checks = verifier.verify([(file, str(t_file), job.digests.get(file))
+                                  for file, t_file in job.copied])
+        verify_report(job.label, checks)
+        bad = [check.source for check in checks if not check.ok]
+        # Failed copies must not count as copied when formatting, and are
+        # moved out of the way so they are copied again next time
+        for file, t_file in job.copied:
+            if file in bad:
+                ledger.record(job.label, file, t_file, status='failed',
+                              digest=job.digests.get(file))
+                quarantine(t_file)
+    else:
+        bad = [file for file, t_file in job.copied
+               if not t_file.exists() or
+               t_file.stat().st_size != os.stat(file).st_size]
+        for file, t_file in job.copied:
+            if file in bad:
+                ledger.record(job.label, file, t_file, status='failed')
+                quarantine(t_file)
+
+    # Successful?
+    n_copied = len(job.copied) - len(bad)
+    if n_copied > 0:
+        print(
+            Fore.GREEN +
+            Style.BRIGHT +
+            f'\n{n_copied} out of {len(job.files)} file(s) succesfully copied from {job.label}')
+    else:
+        print(
+            red + f'\n{n_copied} out of {len(job.files)} file(s) copied from {job.label}')
+    job.bad = bad + job.short
+    if job.short:
+        print(red + f'{len(job.short)} file(s) in {job.label} end before '
+              'their size (a broken cluster chain) and were not copied: '
+              f'{", ".join(Path(file).name for file in job.short)}. What '
+              'could be read of them is in '
+              f'{IMAGE_DIR / "incomplete" / job.label} (*.failed)')
+    if bad:
+        print(red + f'{len(bad)} copied file(s) from {job.label} did not '
+              f'match the card: {", ".join(Path(file).name for file in bad)}'
+              '. They have been renamed to *.failed and will be copied '
+              'again if the card is removed and inserted again')
+    if job.flagged:
+        print(red + f'{len(job.flagged)} recording(s) from {job.label} have '
+              'a truncated or inconsistent header (see the wav_metadata '
+              'table in the copy ledger)')
+
+    if job.reads is not None and faceplate_store is not None:
+        try:
+            n_reads = faceplate_store.append(job.label, job.reads)
+            print(info + f'{n_reads} new reads from {job.label} added to '
+                  'the faceplate store')
+        except Exception as e:
+            print(red + f'Could not add the reads from {job.label} to the '
+                  f'faceplate store: {e}')
+    return job
+
+
+def unmount_card(job):
+    # Unmount card, remove mount point (imaged cards have been released
+    # already; only their extracted files are left)
+    try:
+        if job.staging is not None:
+            if job.skip or job.bad:
+                print(yellow + f'The files read from {job.label} are kept '
+                      f'in {job.staging}\n')
             else:
-                print(
-                    red + f'\n{n_copied} out of {len(files)} file(s) copied from {card[1]}')
-
-            # Unmount card, remove mount point
-            try:
-                p = find_sdiskpart(card[0])
-            except psutil.Error:
-                print('Something went wrong :D')
-            while os.path.exists(card[0]):
-                umount_and_rmdir(0, card)
-                if verbose:
-                    print('Trying to umount again')
-
-            print(yellow + f'Done with {card[1]}. It is now safe to remove.\n')
+                shutil.rmtree(job.staging, ignore_errors=True)
+                print(yellow + f'Done with {job.label}.\n')
+        elif job.mountpoint is not None:
+            with metrics.timed('unmount', card=job.label):
+                release_card(job.card)
+            print(yellow + f'Done with {job.label}. It is now safe to remove.\n')
+    finally:
+        # Cards with failed copies, and skipped cards, are picked up again
+        # when re-inserted (imaged cards may have been removed already)
+        if job.bad or job.skip:
+            if job.label in volume_inventory():
+                held.add(job.label)
+        else:
+            already_done.append(job.label)
+        in_flight.discard(job.label)
+
+
+def quarantine(t_file):
+    # Move a copy that failed verification out of the way (keeping it for
+    # inspection), so that its name is free for the next copy
+    try:
+        os.replace(t_file, f'{t_file}.failed')
+    except FileNotFoundError:
+        pass
+
+
+def release_card(card):
+    try:
+        find_sdiskpart(card[0])
+    except psutil.Error:
+        print('Something went wrong :D')
+    while os.path.exists(card[0]):
+        umount_and_rmdir(0, card)
+        if verbose:
+            print('Trying to umount again')
+
+
+def stage_failed(stage, job, e):
+    print(tcolor(
+        f'\nError in the {stage} stage for {job.label}: {e}', tstyle.rojoroto))
+    if stage == 'unmount':
+        return None
+    # Still unmount the card
+    job.skip = True
+    return job
+
+
+# Register of copied files
+ledger = CopyLedger()
+# Nothing is being copied yet: clear out partial copies that can't be
+# resumed (recordings and faceplate logs)
+removed, dropped = sweep_partial_copies(
+    [DESTINATION_DIR, OUT_DIR / 'faceplates'], ledger,
+    max_age=resume_days * 24 * 3600)
+if removed or dropped:
+    print(info + f'Removed {len(removed)} partial copies and {dropped} '
+          'interrupted copies that could not be resumed')
+pending = ledger.pending_transfers()
+if pending:
+    print(info + f'{len(pending)} interrupted copies will be resumed '
+          'when their cards are inserted again')
+
+# Timings of each step (summary: python -m fieldtools.src.metrics)
+metrics = MetricsLogger('copy')
+# Copy speed of the last cards, for the time estimates (read once)
+typical_rate = copy_rate()
+
+# Season-wide dataset of faceplate reads
+faceplate_store = None
+if store_faceplate_reads:
+    try:
+        faceplate_store = FaceplateStore()
+    except ImportError:
+        print(info + 'pyarrow is not installed: faceplate reads will be '
+              'copied but not added to the faceplate store')
+
+# Start the privileged helper (asks for the sudo password once)
+get_helper().start()
 
-            already_done.append(card[1])
+# Clean any mounted volumes
+clean_vols()
 
-    time.sleep(0.5)
+# Only lets copies start if they fit at the destination
+admission = SpaceAdmission(DESTINATION_DIR, reserve=reserve_bytes)
+# Same for card images (sharing the reservations if they go to the same
+# disk)
+image_admission = admission
+if image_cards:
+    safe_makedir(IMAGE_DIR)
+    if os.stat(IMAGE_DIR).st_dev != os.stat(DESTINATION_DIR).st_dev:
+        image_admission = SpaceAdmission(IMAGE_DIR, reserve=reserve_bytes)
+
+# Re-reads copies to check them before their card is released
+verifier = Verifier(verify_workers)
+
+# Listen for cards being inserted / removed
+watcher = DeviceWatcher()
+
+# Progress of all the cards being copied, redrawn 10 times a second
+progress = TransferProgress(rate=10)
+progress.start()
+
+# Cards are detected while others are being copied; copies run in a
+# thread pool, at most max_concurrent_cards at a time, and cards are
+# verified while the next ones are copied
+pipeline = Pipeline(
+    [Stage('mount', mount_card),
+     Stage('image', image_card, workers=max_concurrent_cards),
+     Stage('plan', plan_card),
+     Stage('copy', copy_card, workers=max_concurrent_cards),
+     Stage('verify', verify_card, workers=max_concurrent_cards),
+     Stage('unmount', unmount_card)],
+    maxsize=max_concurrent_cards,
+    executor=ThreadPoolExecutor(max_workers=3 * max_concurrent_cards + 4),
+    on_error=stage_failed)
+
+try:
+    asyncio.run(pipeline.run(detect_cards()))
+finally:
+    progress.stop()
+    verifier.close()
+    watcher.close()
+    ledger.close()
@@ -12,12 +12,14 @@ import pandas as pd
 from fieldtools.src.aesthetics import (asterbar, build_logo, info,
                                        menu_aes, print_dict, qmark, tcolor,
                                        tstyle)
-from fieldtools.src.funs import (get_full_faceplate_info, get_nestbox_update,
+from fieldtools.src.funs import (get_deployment_index,
+                                 get_full_faceplate_info, get_nestbox_update,
                                  get_recorded_gretis, get_single_gsheet, order,
-                                 reconstruct_path, split_path, workers,
-                                 write_gpx, yes_or_no)
+                                 reconstruct_path, sheet_cache, split_path,
+                                 workers, write_gpx, yes_or_no)
 from fieldtools.src.paths import (DATA_DIR, EGO_DIR, OUT_DIR, PROJECT_DIR,
                                   safe_makedir)
+from fieldtools.src.sheetcache import SheetUnavailable
 from fieldtools.version import __version__
 from PyInquirer import prompt
 from tabulate import tabulate
@@ -26,6 +28,11 @@ from tabulate import tabulate
 
 verbose = False
 warn_others = False
+# Whether to work from the last downloaded copy of the Google sheets
+# (e.g. in the woods, without a connection)
+offline = False
+# Seconds a downloaded sheet is used before checking whether it has changed
+sheet_cache_ttl = 600
 
 # Paths
 
@@ -64,6 +71,13 @@ if warn_others:
  """, tstyle.rojoroto))
         os._exit(0)
 
+# Sheets are kept on disk and only downloaded again when they change
+sheet_cache.ttl = sheet_cache_ttl
+sheet_cache.offline = offline
+if offline:
+    print(info + 'Working offline: using the last downloaded copy of the '
+          'field worker sheets')
+
 while True:
 
     # Get coordinates for all nestboxes
@@ -206,11 +220,17 @@ while True:
     elif answer == 'Get a progress report':  # * get nestboxes to be visited
 
         # Get updated list of nestboxes from google sheets
-        which_greati = get_nestbox_update().replace(
-            'nan', 0).fillna(0).replace('n/a', 0)
+        try:
+            # (the comments sheet is downloaded alongside the others)
+            which_greati, comments = get_nestbox_update(with_comments=True)
+            which_greati = which_greati.replace(
+                'nan', 0).fillna(0).replace('n/a', 0)
+        except SheetUnavailable as e:
+            print(info + tcolor(str(e), tstyle.rojoroto))
+            continue
         # TODO: get number of blutis and gretis separatedly
         already_recorded, diff_df = get_recorded_gretis(
-            recorded_csv, nestbox_coords, which_greati)
+            recorded_csv, nestbox_coords, which_greati, comments=comments)
 
         # Print basic info
         print(
@@ -303,11 +323,8 @@ while True:
                 print('')
 
                 if answer == f"Today's ({today})":
-                    move_today = (
-                        pd.read_csv(recorded_csv_append)
-                        .query('Nestbox != "Nestbox"')
-                        .query("Move_by == @today")
-                    )
+                    move_today = get_deployment_index(
+                        recorded_csv_append).due_on(today)
                     write_gpx(GPX_DIR / str(str(today) + ".gpx"),
                               diff_df, move_today)
 
@@ -320,11 +337,8 @@ while True:
                     break
 
                 elif answer == f"Tomorrow's ({tomorrow})":
-                    move_tomorrow = (
-                        pd.read_csv(recorded_csv_append)
-                        .query('Nestbox != "Nestbox"')
-                        .query("Move_by == @tomorrow")
-                    )
+                    move_tomorrow = get_deployment_index(
+                        recorded_csv_append).due_on(tomorrow)
                     write_gpx(
                         GPX_DIR / str(str(tomorrow) +
                                       ".gpx"), diff_df, move_tomorrow
@@ -375,10 +389,13 @@ while True:
         # Get the data frm the selected round
         name = workers.rounds_dict[answer]
         roundkey = workers.gdict[name]
-        round_df = get_single_gsheet(name, roundkey)
-
-        # Get the data from faceplating. Get birds with known ID or detected but without PIT tag
-        faceplate_df = get_full_faceplate_info().query('Nestbox == Nestbox')
+        try:
+            round_df = get_single_gsheet(name, roundkey)
+            # Get the data from faceplating. Get birds with known ID or detected but without PIT tag
+            faceplate_df = get_full_faceplate_info().query('Nestbox == Nestbox')
+        except SheetUnavailable as e:
+            print(info + tcolor(str(e), tstyle.rojoroto))
+            continue
         mask = faceplate_df.query('Species != "g" and Species != "b"')[
             "Comments"].str.lower().str.contains('unringed')
         unringed = faceplate_df.query(
@@ -4,23 +4,44 @@
 
 
 import os
+import subprocess
 import time
-from subprocess import PIPE, Popen
+from concurrent.futures import ThreadPoolExecutor
+
 import psutil
 from fieldtools.src.aesthetics import (
     arrow, asterbar, build_logo, info, tcolor, tstyle)
+from fieldtools.src.devices import (DeviceWatcher, is_card_label,
+                                     volume_inventory)
+from fieldtools.src.fatimage import (format_serial, make_format_image,
+                                     new_serial, read_device_volume_info)
 from fieldtools.src.funs import (clean_vols, ensure_mount, find_sdiskpart,
-                                 get_mountedlist, get_wav_filenames,
-                                 is_faceplate, umount_and_rmdir)
+                                 umount_and_rmdir)
+from fieldtools.src.ledger import CopyLedger
+from fieldtools.src.metrics import MetricsLogger
 from fieldtools.src.paths import OUT_DIR, safe_makedir, valid_vols_list
+from fieldtools.src.privhelper import HelperError, get_helper
 from fieldtools.version import __version__
-from pathlib2 import Path
+from tabulate import tabulate
 
 # Settings
 skip_empty = False  # Wether to skip already empty cards
 safe_copy = False  # Wether to ensure that files exist before allowing formatting
+# Wether to also re-hash every copy and compare it with the checksum taken
+# when it was copied (needs safe_copy = True)
+verify_copies = False
 verbose = False
 warn_others = False
+# Maximum number of cards formatted at the same time
+max_concurrent_formats = 8
+# Seconds a card can take to format / unmount or relabel before it is
+# given up on (so that one stuck card doesn't hold up the rest)
+format_timeout = 300
+umount_timeout = 30
+# Wether to format cards by writing a cached FAT32 template (built with
+# mkfs.vfat once per card size, see src/fatimage.py) instead of running
+# mkfs.vfat and fatlabel on every card
+fast_format = True
 
 # Folders of interest (not currently used)
 folder_names = ['caca' for i in list(range(1, 61))]
@@ -28,6 +49,129 @@ folder_names = ['caca' for i in list(range(1, 61))]
 valid_directories = [(name, folder_name)
                      for name, folder_name in zip(valid_vols_list, folder_names)]
 
+# Formatting ----------------------------------
+
+
+def read_back_volume(device, label, serial):
+    """Whether the device itself now has the new label and serial number.
+
+    The label alone is not enough: cards are given back the label they
+    already had, so /dev/disk/by-label would match even if nothing was
+    written. The boot sector and root directory are read through the
+    helper, as the device is only readable by root.
+
+    Returns:
+        str: '' if both match, otherwise what is wrong.
+    """
+    def read_ranges(device, image, ranges):
+        result = helper.run_one('read_ranges', device, image, ranges,
+                                timeout=umount_timeout)
+        if result['returncode'] != 0:
+            raise OSError(result['returncode'], result['stderr'].strip())
+
+    try:
+        volume = read_device_volume_info(device, reader=read_ranges)
+    except (OSError, ValueError, HelperError) as e:
+        return f'could not read the new volume: {e}'
+    if volume['serial'] != format_serial(serial):
+        return f'serial is {volume["serial"]}, not {format_serial(serial)}'
+    if volume['label'] != label.upper():
+        return f'label is {volume["label"]}, not {label}'
+    return ''
+
+
+def format_card(card, device):
+    """Unmount, format and relabel a card, and check its new label.
+
+    With fast_format, formatting and relabelling are a single write of a
+    FAT32 template (see fatimage.make_format_image()); if no template can
+    be built, mkfs.vfat and fatlabel are used. Either way the card gets a
+    new serial number, and the label and serial are read back from the
+    device. Every step has a timeout, so a stuck device can't hold up the
+    others.
+
+    Returns:
+        dict: card, device, the return code of each step, whether the
+        label could be read back, seconds taken and 'ok'.
+    """
+    start = time.perf_counter()
+    serial = new_serial()
+    image = None
+    if fast_format:
+        try:
+            image = make_format_image(device, card[1], serial)
+        except (OSError, ValueError, subprocess.CalledProcessError) as e:
+            print(info + f'Could not build a format template for {card[1]} '
+                  f'({e}), using mkfs.vfat')
+    if image is not None:
+        # The label is part of the image: there is no separate relabel step
+        unmounted, formatted = helper.run([
+            {'op': 'umount', 'args': [device, True],
+             'timeout': umount_timeout},
+            {'op': 'write_image', 'args': [image, device],
+             'timeout': format_timeout}], stop_on_error=False)[0]
+        os.remove(image)
+        relabelled = formatted
+    else:
+        unmounted, formatted, relabelled = helper.run([
+            {'op': 'umount', 'args': [device, True],
+             'timeout': umount_timeout},
+            {'op': 'mkfs_vfat', 'args': [device, serial],
+             'timeout': format_timeout},
+            {'op': 'fatlabel', 'args': [device, card[1]],
+             'timeout': umount_timeout}], stop_on_error=False)[0]
+    problem = ''
+    if formatted['returncode'] == 0 and relabelled['returncode'] == 0:
+        problem = read_back_volume(device, card[1], serial)
+    label_ok = (formatted['returncode'] == 0 and
+                relabelled['returncode'] == 0 and not problem)
+    seconds = time.perf_counter() - start
+    ok = formatted['returncode'] == 0 and label_ok
+    metrics.emit('format', card=card[1], returncode=formatted['returncode'],
+                 mode='template' if image is not None else 'mkfs',
+                 seconds=round(seconds, 4))
+
+    # Remove the mount point (the volume may be automounted again)
+    with metrics.timed('unmount', card=card[1]):
+        for _ in range(5):
+            if not os.path.exists(card[0]):
+                break
+            umount_and_rmdir(0, card)
+    return {'card': card[1], 'device': device,
+            'umount': unmounted['returncode'],
+            'format': formatted['returncode'],
+            'relabel': relabelled['returncode'] if image is None else '-',
+            'label': label_ok, 'seconds': round(seconds, 1), 'ok': ok,
+            'error': (formatted['stderr'] or relabelled['stderr'] or
+                      problem).strip() if not ok else ''}
+
+
+def failed_result(card, device, error):
+    # Summary row of a card whose formatting raised an exception
+    return {'card': card[1], 'device': device, 'umount': '-',
+            'format': '-', 'relabel': '-', 'label': False, 'seconds': '-',
+            'ok': False, 'error': f'{type(error).__name__}: {error}'}
+
+
+def print_summary(results):
+    rows = [[r['card'], r['device'], r['umount'], r['format'], r['relabel'],
+             'yes' if r['label'] else 'no', r['seconds'],
+             'OK' if r['ok'] else 'FAILED ' + r['error'][:40]]
+            for r in sorted(results, key=lambda r: r['card'])]
+    print('\n' + tabulate(rows, headers=['Card', 'Device', 'umount', 'format',
+                                         'relabel', 'Label', 'Seconds',
+                                         'Result'], tablefmt='simple'))
+    failed = [r['card'] for r in results if not r['ok']]
+    if failed:
+        print(info + tcolor(f'{len(failed)} card(s) failed: '
+                            f'{", ".join(sorted(failed))}. Remove them and '
+                            'try again', tstyle.rojoroto))
+    else:
+        print(info + tstyle.BOLD + tcolor(
+            f'Successfully formatted {len(results)} card(s). You can now '
+            'remove them', tstyle.teal))
+
+
 # Main
 
 # Make sure paths exist
@@ -54,45 +198,68 @@ if warn_others:
  """, tstyle.rojoroto))
         os._exit(0)
 
+# Register of copied files
+if safe_copy:
+    ledger = CopyLedger()
+
+# Timings of each step (summary: python -m fieldtools.src.metrics)
+metrics = MetricsLogger('format')
+
 # Store volumes that have been already formatted
 already_done = []
 checked_cards = []
-devnull = open(os.devnull, 'wb')
+# Start the privileged helper (asks for the sudo password once)
+helper = get_helper()
+helper.start()
 
 # Clean any mounted volumes
 clean_vols()
 
+# Cards are formatted in parallel through the helper
+format_pool = ThreadPoolExecutor(max_workers=max_concurrent_formats)
+
+# Listen for cards being inserted / removed
+watcher = DeviceWatcher()
+
 # Counter (for progress bar)
 it = 0
 
 while True:
     print(arrow + tcolor('Scanning for cards',
                          tstyle.lightgrey), asterbar[it % len(asterbar)], end="\r")
-    time.sleep(.1)
+    changed = watcher.wait(.1)
     it += 1
 
+    # Only look at devices if a card has been inserted, removed,
+    # mounted or unmounted
+    if not changed:
+        continue
+
     # Mount any cards not already mounted
     # (sometimes automount does not work)
+    volumes = volume_inventory()
     checked_cards = ensure_mount(
-        valid_directories, 0, checked_cards, already_done, verbose)
+        valid_directories, 0, checked_cards, already_done, verbose,
+        volumes=volumes)
 
-    # Now get all valid mounted cards
-    mounted = get_mountedlist()
-    new_paths = [dev for dev in mounted if not dev in already_done]
-    valid_faceplates = [(dev, Path(dev).name)
-                        for dev in new_paths if is_faceplate(dev)]
-    valid_audiomoths = sum([[(drive, card[0]) for drive in new_paths
-                             if card[0] in drive] for card in valid_directories], [])
-    valid = valid_faceplates + valid_audiomoths
+    # Now get all valid mounted cards, as (mount point, name)
+    # (reading the inventory again is cheap; no subprocesses)
+    volumes = volume_inventory()
+    valid = [(vol.mountpoint, label) for label, vol in sorted(volumes.items())
+             if vol.mountpoint is not None
+             and is_card_label(label, valid_vols_list)
+             and label not in already_done]
 
     # Skip if there are no new cards
     if not valid:
         continue
     else:
+        admitted = []  # (card, device) of the cards that can be formatted
         for card in valid:
             if card[1] in already_done:
                 continue
 
+            metrics.emit('card_detected', card=card[1])
             print(
                 tcolor('\n' + f'Trying to format {card[1]} ...', tstyle.mustard))
 
@@ -109,61 +276,45 @@ while True:
 
             # Skip card if any WAV files have not yet been copied
             if safe_copy:
-                wav_files = get_wav_filenames(card)
+                wav_files = [file for file in files if file.endswith('.WAV')]
                 if wav_files:
                     try:
-                        with open(OUT_DIR / 'copied.txt', 'r') as cp:
-                            copied_list = [filedir.rstrip()
-                                           for filedir in cp]
-                        if not set(wav_files).issubset(copied_list):
+                        if ledger.missing(wav_files):
                             print(info +
                                   f'One or more files in {card[1]} have not yet been copied, skipping')
                             continue
-                    except:
-                        if (OUT_DIR / 'copied.txt').is_file():
-                            print(
-                                info + tcolor('There is an issue with /copied.txt, skipping.'), tstyle.rojoroto)
-                        else:
+                        if verify_copies and ledger.unconfirmed(wav_files):
                             print(info +
-                                  tcolor('/copied.txt not found, use the `copy-cards` app at least once. Skipping', tstyle.rojoroto))
+                                  f'One or more files in {card[1]} do not match their copy, skipping')
+                            continue
+                    except Exception as e:
+                        print(info + tcolor(
+                            f'There is an issue with the copy ledger ({e}), skipping.', tstyle.rojoroto))
                         continue
 
             # Get volume name
             try:
                 p = find_sdiskpart(card[0])
             except psutil.Error:
-                print('Something went wrong lol')
-
-            # Unmount card
-            umount = f"sudo umount -l {p.device}*"
-            proc1 = Popen(["/bin/bash", "-c", umount],
-                          stdin=PIPE, stdout=PIPE, stderr=devnull)
-            proc1.communicate()
-
-            # Format card
-            format = f"sudo mkfs.vfat -F32 -v {p.device}"
-            proc2 = Popen(["/bin/bash", "-c", format],
-                          stdin=PIPE, stdout=PIPE)
-            oin, oout = proc2.communicate()
-
-            # Rename card
-            relabel = f"sudo fatlabel {p.device} {card[1]}"
-            proc3 = Popen(["/bin/bash", "-c", relabel],
-                          stdin=PIPE, stdout=PIPE, stderr=devnull)
-            proc3.communicate()
-
-            if proc2.returncode == 0:
-                while os.path.exists(card[0]):
-                    umount_and_rmdir(0, card)
-                    # print('trying to umount again')
-                print(info + tstyle.BOLD + tcolor(
-                      f'Successfully formatted {card[1]}. You can now remove it', tstyle.teal))
-                already_done.append(card[1])
-            else:
                 print(info + tcolor(
-                      f'Error when trying to format {card[1]}. Remove it and try again', tstyle.rojoroto))
-                while os.path.exists(card[0]):
-                    umount_and_rmdir(0, card)
-                already_done.append(card[1])
+                    f'Could not find the device of {card[1]}, skipping',
+                    tstyle.rojoroto))
+                continue
+            admitted.append((card, p.device))
+
+        # Format all the admitted cards at once
+        if admitted:
+            print(info + f'Formatting {len(admitted)} card(s) ...')
+            futures = [format_pool.submit(format_card, *a) for a in admitted]
+            results = []
+            # A card that raises (e.g. the helper died) is reported as
+            # failed, without losing the results of the others
+            for (card, device), future in zip(admitted, futures):
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    results.append(failed_result(card, device, e))
+            print_summary(results)
+            already_done.extend(result['card'] for result in results)
 
     time.sleep(0.5)
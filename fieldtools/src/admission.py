@@ -0,0 +1,188 @@
+# Planning card copies before they start: what needs copying, whether it
+# fits at the destination, and how long it should take
+
+import os
+import shutil
+import threading
+from collections import namedtuple
+
+from fieldtools.src.metrics import read_metrics
+from fieldtools.src.paths import METRICS_PATH
+
+# Free space always left at the destination
+RESERVE_BYTES = 2 * 1024 ** 3
+# Copy speed assumed when there are no timings yet (see src/metrics.py)
+DEFAULT_RATE = 30e6
+
+# A file to copy: source, target directory, target file and size in bytes
+Transfer = namedtuple('Transfer', ['file', 'target', 't_file', 'size'])
+# What to do with a card: status is 'admit', 'defer' or 'reject'
+Decision = namedtuple('Decision', ['status', 'needed', 'available'])
+
+
+def scan_card(mountpoint, suffix):
+    """Files in the top folder of a card that end with `suffix`, with
+    their sizes, in a single os.scandir pass.
+
+    Returns:
+        dict: {path: size in bytes}
+    """
+    files = {}
+    with os.scandir(mountpoint) as entries:
+        for entry in entries:
+            if entry.name.endswith(suffix) and entry.is_file():
+                files[entry.path] = entry.stat().st_size
+    return files
+
+
+def _existing(directory):
+    try:
+        with os.scandir(directory) as entries:
+            return {entry.name for entry in entries}
+    except FileNotFoundError:
+        return set()
+
+
+def plan_transfers(plan, sizes, redo=()):
+    """Leave out the files of a plan that are already at their destination.
+
+    Each target directory is listed once, instead of checking every file.
+
+    Args:
+        plan (list): (file, target directory) pairs.
+        sizes (dict): size of each file (see scan_card()).
+        redo (set, optional): files to copy even if their name is at the
+            destination (e.g. those whose copy failed verification, see
+            CopyLedger.failed()).
+
+    Returns:
+        tuple: (transfers, skipped), a list of Transfer and a list of
+        (file, existing copy) pairs.
+    """
+    existing = {}
+    transfers, skipped = [], []
+    for file, target in plan:
+        if target not in existing:
+            existing[target] = _existing(target)
+        name = os.path.basename(file)
+        t_file = target / name
+        if name in existing[target] and file not in redo:
+            skipped.append((file, t_file))
+        else:
+            transfers.append(Transfer(file, target, t_file, sizes[file]))
+    return transfers, skipped
+
+
+def copy_rate(path=METRICS_PATH, last=20, default=DEFAULT_RATE):
+    """Typical copy speed of a card in bytes/s: the median of the last
+    `last` cards in copy-cards' metrics files, or `default` if there are
+    none. The files are read on every call.
+    """
+    rates = []
+    try:
+        df = read_metrics(path, events=['card_copied'], app='copy')
+    except (OSError, ValueError):
+        return default
+    if len(df) and 'bytes' in df:
+        cards = df[(df['event'] == 'card_copied') & (df['bytes'] > 0)]
+        cards = cards.tail(last)
+        rates = (cards['bytes'] / cards['seconds'].clip(lower=1e-3)).tolist()
+    if not rates:
+        return default
+    rates.sort()
+    return rates[len(rates) // 2]
+
+
+class SpaceAdmission:
+    """Decides whether a card's copy can start, given the free space at
+    the destination and the space promised to cards already being copied.
+
+    A card is admitted if it fits in the free space minus the reserve and
+    minus what admitted cards still have to write; deferred if it would
+    only fit without them (request() then waits until one of them is
+    released, or `recheck` seconds, and looks again); and rejected if it
+    doesn't fit even on its own.
+
+    Args:
+        destination (str or PosixPath): where the copies go.
+        reserve (int, optional): bytes always left free.
+        recheck (float, optional): seconds between checks while deferred.
+    """
+
+    def __init__(self, destination, reserve=RESERVE_BYTES, recheck=30):
+        self.destination = destination
+        self.reserve = reserve
+        self.recheck = recheck
+        self._reserved = {}
+        self._cond = threading.Condition()
+
+    def available(self):
+        return shutil.disk_usage(self.destination).free - self.reserve
+
+    def _decide(self, needed):
+        available = self.available()
+        promised = sum(self._reserved.values())
+        if needed <= available - promised:
+            status = 'admit'
+        elif needed <= available:
+            status = 'defer'
+        else:
+            status = 'reject'
+        return Decision(status, needed, available - promised)
+
+    def request(self, label, needed, on_defer=None):
+        """Ask to copy `needed` bytes for a card; waits while deferred.
+
+        Args:
+            label (str): card name.
+            needed (int): bytes to copy.
+            on_defer (callable, optional): called with the Decision the
+                first time the card is deferred.
+
+        Returns:
+            Decision: 'admit' (and the bytes are reserved until release())
+            or 'reject'.
+        """
+        notified = False
+        with self._cond:
+            while True:
+                decision = self._decide(needed)
+                if decision.status != 'defer':
+                    break
+                if not notified and on_defer is not None:
+                    on_defer(decision)
+                    notified = True
+                self._cond.wait(self.recheck)
+            if decision.status == 'admit':
+                self._reserved[label] = needed
+            return decision
+
+    def written(self, label, nbytes):
+        """Count bytes an admitted card has written: they have left the
+        free space, so they are no longer held in its reservation (which
+        would count them twice).
+        """
+        with self._cond:
+            if label in self._reserved:
+                self._reserved[label] = max(self._reserved[label] - nbytes,
+                                            0)
+
+    def file_callback(self, label):
+        """A callback(copied, total) for funs.copyfile that calls
+        written(). Make a new one for each file.
+        """
+        last = 0
+
+        def callback(copied, total):
+            nonlocal last
+            self.written(label, copied - last)
+            last = copied
+        return callback
+
+    def release(self, label):
+        """Give back a card's reservation (its copies are now on disk, and
+        counted in the free space, or it was abandoned).
+        """
+        with self._cond:
+            self._reserved.pop(label, None)
+            self._cond.notify_all()
@@ -0,0 +1,541 @@
+# Benchmarks for the card pipeline on synthetic cards, so that regressions
+# show up before going into the field: python -m fieldtools.src.benchmark
+#
+# Cards are FAT32 image files filled with AudioMoth-style YYYYMMDD_HHMMSS.WAV
+# recordings and loop-mounted through the privileged helper (backend 'fat'),
+# or plain directories in tmpfs or a temporary folder when images cannot be
+# built or mounted. Results are appended as JSON lines to BENCHMARKS_PATH and
+# compared with the last run of the same benchmark on the same machine.
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from fieldtools.src import fatimage, privhelper
+from fieldtools.src.aesthetics import info, tcolor, tstyle
+from fieldtools.src.devices import volume_inventory
+from fieldtools.src.funs import (DeploymentIndex, copy_with_progress,
+                                 fetch_recorder_info, format_digest,
+                                 get_nestbox_id, new_hasher, plan_nestboxes)
+from fieldtools.src.ledger import CopyLedger
+from fieldtools.src.paths import BENCHMARKS_PATH, safe_makedir
+from fieldtools.src.wavmeta import parse_wav_header
+from fieldtools.version import __version__
+
+BENCHMARKS = ['copy', 'plan', 'inventory', 'format']
+
+# Size of a card at scale 1: a few AudioMoths, each with a morning of
+# recordings (the file count is multiplied by the scale)
+CARDS = 4
+FILES_PER_CARD = 24
+FILE_MB = 4
+
+# A slower result than the last run by more than this is flagged
+REGRESSION_THRESHOLD = .10
+# Synthetic cards in tmpfs (RAM) may take at most this share of the free
+# space in /dev/shm
+TMPFS_SHARE = .5
+
+_COMMENT = ('Recorded at {:%H:%M:%S %d/%m/%Y} (UTC) by AudioMoth '
+            '24F319055FDF2F5B at medium gain setting while battery state '
+            'was 4.2V.')
+
+
+# Synthetic cards -----------------------------------------------------------
+
+def wav_header(data_size, when, sample_rate=48000):
+    """RIFF header of an AudioMoth recording (16-bit mono PCM with an ICMT
+    comment), for `data_size` bytes of samples.
+    """
+    comment = _COMMENT.format(when).encode('ascii') + b'\x00'
+    if len(comment) % 2:
+        comment += b'\x00'
+    info_chunk = b'INFO' + b'ICMT' + struct.pack('<I', len(comment)) + comment
+    fmt = struct.pack('<HHIIHH', 1, 1, sample_rate, sample_rate * 2, 2, 16)
+    body = (b'WAVE' + b'fmt ' + struct.pack('<I', len(fmt)) + fmt +
+            b'LIST' + struct.pack('<I', len(info_chunk)) + info_chunk +
+            b'data' + struct.pack('<I', data_size))
+    return b'RIFF' + struct.pack('<I', len(body) + data_size) + body
+
+
+def recording_times(start, n, interval=datetime.timedelta(hours=1)):
+    return [start + i * interval for i in range(n)]
+
+
+def write_recordings(directory, times, file_mb, block):
+    """Write one .WAV file per timestamp into `directory`.
+
+    Returns:
+        list: paths to the files written.
+    """
+    size = int(file_mb * 1024 * 1024)
+    files = []
+    for when in times:
+        path = os.path.join(directory, f'{when:%Y%m%d_%H%M%S}.WAV')
+        with open(path, 'wb') as f:
+            f.write(wav_header(size, when))
+            left = size
+            while left:
+                chunk = block[:min(left, len(block))]
+                f.write(chunk)
+                left -= len(chunk)
+        files.append(path)
+    return files
+
+
+def _have(*tools):
+    return all(shutil.which(tool) for tool in tools)
+
+
+def choose_backend(requested):
+    """'fat', 'tmpfs' or 'dir' for requested = 'auto' or one of those.
+
+    'auto' only picks 'fat' when running as root, so that the benchmark
+    never stops to ask for a password.
+    """
+    if requested != 'auto':
+        return requested
+    if os.geteuid() == 0 and _have('mkfs.vfat', 'mcopy'):
+        return 'fat'
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return 'tmpfs'
+    return 'dir'
+
+
+class SyntheticCards:
+    """A set of synthetic AudioMoth cards, removed by close().
+
+    Args:
+        backend (str): 'fat', 'tmpfs' or 'dir' (see choose_backend()).
+        n_cards (int): number of cards.
+        files_per_card (int): recordings in each card.
+        file_mb (float): size of each recording.
+        workdir (str, optional): where to build them. Defaults to /dev/shm
+            for 'tmpfs' and the system temporary folder otherwise.
+    """
+
+    def __init__(self, backend, n_cards, files_per_card, file_mb,
+                 start=datetime.datetime(2021, 4, 10, 4), workdir=None):
+        self.backend = backend
+        if workdir is None and backend == 'tmpfs':
+            workdir = '/dev/shm'
+        self.root = tempfile.mkdtemp(prefix='fieldtools-bench-', dir=workdir)
+        self.labels = [f'AM{i:02d}' for i in range(1, n_cards + 1)]
+        self.times = recording_times(start, files_per_card)
+        self.file_mb = file_mb
+        self._helper = None
+        self._mounted = []
+        # Incompressible contents, so that no filesystem can cheat
+        self._block = np.random.default_rng(0).integers(
+            0, 256, 1024 * 1024, dtype=np.uint8).tobytes()
+        self.cards = {}
+        for label in self.labels:
+            if backend == 'fat':
+                self.cards[label] = self._build_image(label)
+            else:
+                directory = os.path.join(self.root, label)
+                os.mkdir(directory)
+                write_recordings(directory, self.times, file_mb, self._block)
+                self.cards[label] = directory
+
+    @property
+    def files(self):
+        """{label: sorted list of recordings in the card}"""
+        return {label: sorted(os.path.join(path, name)
+                              for name in os.listdir(path))
+                for label, path in self.cards.items()}
+
+    @property
+    def total_bytes(self):
+        return sum(os.stat(file).st_size
+                   for files in self.files.values() for file in files)
+
+    def _build_image(self, label):
+        staging = os.path.join(self.root, 'staging-' + label)
+        os.mkdir(staging)
+        files = write_recordings(staging, self.times, self.file_mb,
+                                 self._block)
+        image = os.path.join(self.root, label + '.img')
+        size_kb = int(sum(os.stat(f).st_size for f in files) / 1024 * 1.1
+                      + 64 * 1024)
+        subprocess.run(['mkfs.vfat', '-F32', '-n', label, '-C', image,
+                        str(size_kb)], check=True, stdout=subprocess.DEVNULL)
+        subprocess.run(['mcopy', '-i', image] + files + ['::/'], check=True)
+        shutil.rmtree(staging)
+
+        mountpoint = os.path.join(self.root, label)
+        if self._helper is None:
+            self._helper = privhelper.get_helper()
+        results = self._helper.run(
+            [('mkdir', mountpoint), ('mount', image, mountpoint)])[0]
+        if len(results) < 2 or results[-1]['returncode'] != 0:
+            raise RuntimeError(f'Could not mount {image}: '
+                               f'{results[-1]["stderr"].strip()}')
+        self._mounted.append(mountpoint)
+        return mountpoint
+
+    def close(self):
+        if self._mounted:
+            self._helper.run(*[[('umount', m), ('rmdir', m)]
+                               for m in self._mounted], stop_on_error=False)
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def write_deployments(csv_path, labels, times, deployments_per_am=10,
+                      days=3):
+    """A deployment .csv where each AM went through `deployments_per_am`
+    nest boxes, `days` days each, the last of which holds the recordings.
+    """
+    first = pd.Timestamp(min(times)).normalize() - pd.Timedelta(days=1)
+    last = pd.Timestamp(max(times)).normalize() + pd.Timedelta(days=1)
+    rows = []
+    for i, label in enumerate(labels):
+        deployed, move_by = first, last
+        for d in range(deployments_per_am):
+            rows.append({'Nestbox': f'{chr(65 + i % 26)}{i + 1}{d:02d}',
+                         'AM': label[2:],
+                         'Deployed': deployed.date(),
+                         'Move_by': move_by.date()})
+            deployed, move_by = deployed - pd.Timedelta(days=days), deployed
+    pd.DataFrame(rows).to_csv(csv_path, index=False)
+
+
+def fake_label_dir(directory, n_labels):
+    """A stand-in for /dev/disk/by-label with n labelled 'devices' (links
+    to /dev/null), and a mountinfo file where half of them are mounted.
+
+    Returns:
+        tuple: (label_dir, mountinfo path)
+    """
+    label_dir = os.path.join(directory, 'by-label')
+    os.mkdir(label_dir)
+    for i in range(n_labels):
+        os.symlink('/dev/null', os.path.join(label_dir, f'AM{i + 1:02d}'))
+    rdev = os.stat('/dev/null').st_rdev
+    # A typical desktop has a few dozen mounts; the cards are among them
+    lines = [f'{i} 1 0:{i} / /sys/fs/thing{i} rw - tmpfs tmpfs rw'
+             for i in range(30)]
+    lines += [f'{100 + i} 1 {os.major(rdev)}:{os.minor(rdev)} / '
+              f'/media/bench/AM{i + 1:02d} rw - vfat /dev/null rw'
+              for i in range(n_labels // 2)]
+    mountinfo = os.path.join(directory, 'mountinfo')
+    with open(mountinfo, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return label_dir, mountinfo
+
+
+# Benchmarks ----------------------------------------------------------------
+
+def bench_copy(cards, workdir):
+    """Copy every card to a destination folder, one card per worker, the
+    way copy-cards does (copy_with_progress() with a journal, reading the
+    WAV headers and recording each file in a copy ledger), without and
+    with checksums.
+    """
+    files = cards.files
+    total = cards.total_bytes
+    results = {'bytes': total,
+               'files': sum(len(f) for f in files.values())}
+    for name, checksums in [('plain', False), ('hashed', True)]:
+        dest = tempfile.mkdtemp(prefix='fieldtools-bench-dest-', dir=workdir)
+        ledger = CopyLedger(os.path.join(dest, 'ledger.sqlite'))
+
+        def copy_card(label):
+            target = os.path.join(dest, label)
+            os.mkdir(target)
+            for file in files[label]:
+                hasher = new_hasher() if checksums else None
+                header = []
+                t_file = copy_with_progress(
+                    file, target, callback=lambda copied, total: None,
+                    hasher=hasher, journal=ledger, on_header=header.append)
+                ledger.record(label, file, t_file, digest=format_digest(
+                    hasher) if checksums else None)
+                ledger.record_wav_metadata(label, file, t_file,
+                                           parse_wav_header(
+                                               header[0],
+                                               os.stat(file).st_size))
+
+        start = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(max_workers=len(files)) as pool:
+                list(pool.map(copy_card, files))
+            seconds = time.perf_counter() - start
+        finally:
+            ledger.close()
+            shutil.rmtree(dest, ignore_errors=True)
+        results[f'{name}_seconds'] = round(seconds, 4)
+        results[f'{name}_mb_s'] = round(total / 1e6 / seconds, 2)
+    return results, 'plain_mb_s', True
+
+
+def bench_plan(cards, workdir, legacy_files=200):
+    """Resolve the nest box of every recording: reading the deployment
+    .csv, planning each card at once, and (for comparison) the old per-file
+    lookup on the first `legacy_files` recordings.
+    """
+    files = cards.files
+    csv_path = os.path.join(workdir, 'deployments.csv')
+    write_deployments(csv_path, cards.labels, cards.times)
+
+    start = time.perf_counter()
+    index = DeploymentIndex(csv_path)
+    load = time.perf_counter() - start
+
+    start = time.perf_counter()
+    unmatched = 0
+    for label, card_files in files.items():
+        plan, missing, ambiguous = plan_nestboxes(
+            index, int(label[2:]), card_files)
+        unmatched += len(missing) + len(ambiguous)
+    plan_seconds = time.perf_counter() - start
+    n = sum(len(f) for f in files.values())
+
+    recorders_info = fetch_recorder_info(csv_path)
+    legacy = [(label, file) for label, card_files in files.items()
+              for file in card_files][:legacy_files]
+    start = time.perf_counter()
+    for label, file in legacy:
+        get_nestbox_id(csv_path, recorders_info, (None, label), label[2:],
+                       pd.Timestamp(datetime.datetime.strptime(
+                           os.path.basename(file)[:-4], '%Y%m%d_%H%M%S')))
+    legacy_seconds = time.perf_counter() - start
+
+    return {'files': n, 'unmatched': unmatched,
+            'load_seconds': round(load, 4),
+            'plan_seconds': round(plan_seconds, 4),
+            'plan_us_per_file': round(1e6 * plan_seconds / n, 2),
+            'legacy_us_per_file': round(
+                1e6 * legacy_seconds / max(len(legacy), 1), 2)}, \
+        'plan_us_per_file', False
+
+
+def bench_inventory(cards, workdir, repeat=200):
+    """Read the volume inventory (labels and mount points) of a machine
+    with as many labelled volumes as there are cards.
+    """
+    directory = tempfile.mkdtemp(dir=workdir)
+    label_dir, mountinfo = fake_label_dir(directory, len(cards.labels) * 4)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        volumes = volume_inventory(label_dir, mountinfo)
+    seconds = time.perf_counter() - start
+    shutil.rmtree(directory, ignore_errors=True)
+    return {'volumes': len(volumes), 'calls': repeat,
+            'ms_per_call': round(1e3 * seconds / repeat, 4)}, \
+        'ms_per_call', False
+
+
+def bench_format(cards, workdir):
+    """Format and relabel one image file per card through the helper, all
+    at once, as format-cards does with real devices: first with mkfs.vfat
+    and fatlabel, then from a FAT32 template (see fatimage; building the
+    template is timed separately). The helper runs without sudo, as image
+    files need no privileges.
+    """
+    if not _have('mkfs.vfat', 'fatlabel'):
+        return None, None, None
+    size_kb = max(int(cards.file_mb * len(cards.times) * 1024 * 1.1),
+                  64 * 1024)
+    images = []
+    for label in cards.labels:
+        image = os.path.join(workdir, f'format-{label}.img')
+        with open(image, 'wb') as f:
+            f.truncate(size_kb * 1024)
+        images.append((image, label))
+
+    helper = privhelper.PrivilegedHelper(
+        command=[sys.executable, privhelper.__file__])
+    helper.start()
+    try:
+        start = time.perf_counter()
+        results = helper.run(*[[('mkfs_vfat', image),
+                                ('fatlabel', image, label)]
+                               for image, label in images])
+        seconds = time.perf_counter() - start
+
+        templates = os.path.join(workdir, 'fat-templates')
+        start = time.perf_counter()
+        fatimage.build_template(size_kb * 1024, template_dir=templates)
+        build_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        patched = [fatimage.make_format_image(image, label,
+                                              template_dir=templates)
+                   for image, label in images]
+        results += helper.run(*[[('write_image', patch, image)]
+                                for patch, (image, _) in zip(patched, images)])
+        template_seconds = time.perf_counter() - start
+        failed_labels = sum(fatimage.read_volume_info(image)['label'] !=
+                            label.upper() for image, label in images)
+    finally:
+        helper.close()
+        for image, _ in images:
+            os.remove(image)
+        shutil.rmtree(os.path.join(workdir, 'fat-templates'),
+                      ignore_errors=True)
+    failed = sum(any(r['returncode'] != 0 for r in seq) for seq in results)
+    return {'cards': len(images), 'image_mb': round(size_kb / 1024, 1),
+            'failed': failed + failed_labels, 'seconds': round(seconds, 4),
+            'seconds_per_card': round(seconds / len(images), 4),
+            'template_build_seconds': round(build_seconds, 4),
+            'template_seconds': round(template_seconds, 4)}, \
+        'seconds', False
+
+
+_FUNCS = {'copy': bench_copy, 'plan': bench_plan,
+          'inventory': bench_inventory, 'format': bench_format}
+
+
+# Results -------------------------------------------------------------------
+
+def _commit():
+    try:
+        out = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=5)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    return out.stdout.decode().strip() or None
+
+
+def previous_result(path, record):
+    """The last result of the same benchmark, scale, card size, backend
+    and machine.
+    """
+    last = None
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    old = json.loads(line)
+                except ValueError:
+                    continue
+                if all(old.get(k) == record[k] for k in
+                       ['benchmark', 'scale', 'backend', 'host', 'params']):
+                    last = old
+    except OSError:
+        pass
+    return last
+
+
+def compare(record, previous):
+    """Relative change of the main metric, positive if it got worse.
+    """
+    if previous is None:
+        return None
+    key = record['metric']
+    new, old = record['results'].get(key), previous['results'].get(key)
+    if not new or not old:
+        return None
+    change = (new - old) / old
+    return -change if record['higher_is_better'] else change
+
+
+def run(benchmarks, scales, backend, workdir=None, out=BENCHMARKS_PATH,
+        cards=CARDS, files_per_card=FILES_PER_CARD, file_mb=FILE_MB):
+    """Run the benchmarks at each scale and append the results to `out`.
+
+    Returns:
+        list: the records written.
+    """
+    backend = choose_backend(backend)
+    safe_makedir(out)
+    records = []
+    for scale in scales:
+        if backend == 'tmpfs':
+            needed = cards * files_per_card * scale * file_mb * 1024 ** 2
+            free = shutil.disk_usage(workdir or '/dev/shm').free
+            if needed > TMPFS_SHARE * free:
+                print(info + tcolor(
+                    f'Scale {scale}x skipped: its cards need '
+                    f'{needed / 1024 ** 3:.1f} GB, more than '
+                    f'{TMPFS_SHARE:.0%} of the {free / 1024 ** 3:.1f} GB '
+                    'free in /dev/shm (use --backend dir)', tstyle.mustard))
+                continue
+        print(info + f'Building {cards} cards of {files_per_card * scale} '
+              f'files ({backend}, scale {scale}x)')
+        synthetic = SyntheticCards(backend, cards, files_per_card * scale,
+                                   file_mb, workdir=workdir)
+        scratch = tempfile.mkdtemp(prefix='fieldtools-bench-', dir=workdir)
+        try:
+            for name in benchmarks:
+                results, metric, higher = _FUNCS[name](synthetic, scratch)
+                if results is None:
+                    print(info + tcolor(f'{name}: skipped (missing tools)',
+                                        tstyle.mustard))
+                    continue
+                record = {
+                    'ts': datetime.datetime.now().isoformat(
+                        timespec='seconds'),
+                    'version': __version__, 'commit': _commit(),
+                    'host': platform.node(), 'backend': backend,
+                    'scale': scale, 'benchmark': name,
+                    'params': {'cards': cards,
+                               'files_per_card': files_per_card * scale,
+                               'file_mb': file_mb},
+                    'metric': metric, 'higher_is_better': higher,
+                    'results': results}
+                change = compare(record, previous_result(out, record))
+                with open(out, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+                records.append(record)
+                _report(record, change)
+        finally:
+            synthetic.close()
+            shutil.rmtree(scratch, ignore_errors=True)
+    return records
+
+
+def _report(record, change):
+    line = (f'{record["benchmark"]:>9} {record["scale"]:>3}x  '
+            f'{record["metric"]} = {record["results"][record["metric"]]}')
+    if change is not None:
+        colour = (tstyle.rojoroto if change > REGRESSION_THRESHOLD
+                  else tstyle.teal)
+        line += tcolor(f'  ({abs(change):.0%} '
+                       f'{"worse" if change > 0 else "better"} than last run)',
+                       colour)
+    print(info + line)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark copying, planning and formatting on '
+                    'synthetic AudioMoth cards')
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help=f'any of {", ".join(BENCHMARKS)} (default: all)')
+    parser.add_argument('--scales', nargs='+', type=int, default=[1],
+                        help='multiples of the realistic card size '
+                        '(e.g. 1 10)')
+    parser.add_argument('--backend', default='auto',
+                        choices=['auto', 'fat', 'tmpfs', 'dir'])
+    parser.add_argument('--cards', type=int, default=CARDS)
+    parser.add_argument('--files', type=int, default=FILES_PER_CARD,
+                        help='recordings per card at scale 1')
+    parser.add_argument('--file-mb', type=float, default=FILE_MB)
+    parser.add_argument('--workdir', default=None)
+    parser.add_argument('--out', default=str(BENCHMARKS_PATH))
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f'unknown benchmark(s): {", ".join(sorted(unknown))}')
+
+    run(args.benchmarks or BENCHMARKS, args.scales, args.backend, workdir=args.workdir,
+        out=args.out, cards=args.cards, files_per_card=args.files,
+        file_mb=args.file_mb)
+
+
+if __name__ == '__main__':
+    main()
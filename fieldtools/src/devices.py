@@ -0,0 +1,226 @@
+# Card detection without subprocesses: labelled volumes and their mount
+# points from /dev and /proc, and kernel events when they change
+
+import ctypes
+import ctypes.util
+import os
+import re
+import select
+import time
+from collections import namedtuple
+
+# inotify(7) constants
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE_SELF = 0x00000400
+IN_IGNORED = 0x00008000
+
+LABEL_DIR = '/dev/disk/by-label'
+MOUNTINFO = '/proc/self/mountinfo'
+
+
+# A labelled volume; mountpoint is None if it is not mounted
+Volume = namedtuple('Volume', ['label', 'device', 'mountpoint'])
+
+
+def _unescape_label(name):
+    # udev hex-escapes unsafe characters in by-label names, e.g. 'MY\x20CARD'
+    return re.sub(r'\\x([0-9a-fA-F]{2})',
+                  lambda m: chr(int(m.group(1), 16)), name)
+
+
+def _unescape_mount(field):
+    # mountinfo octal-escapes spaces, tabs, newlines and backslashes
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+
+def read_labels(label_dir=LABEL_DIR):
+    """Labelled block devices, as a dict {label: device path}.
+    """
+    labels = {}
+    try:
+        entries = list(os.scandir(label_dir))
+    except OSError:
+        return labels
+    for entry in entries:
+        try:
+            device = os.path.realpath(entry.path)
+        except OSError:
+            continue
+        labels[_unescape_label(entry.name)] = device
+    return labels
+
+
+def read_mounts(mountinfo=MOUNTINFO):
+    """Mounted block devices, as a dict {(major, minor): mount point}.
+
+    Only the first mount point of each device is kept.
+    """
+    mounts = {}
+    try:
+        with open(mountinfo, 'r') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return mounts
+    for line in lines:
+        fields = line.split(' ')
+        if len(fields) < 5:
+            continue
+        major, minor = fields[2].split(':')
+        mounts.setdefault((int(major), int(minor)),
+                          _unescape_mount(fields[4]))
+    return mounts
+
+
+def volume_inventory(label_dir=LABEL_DIR, mountinfo=MOUNTINFO):
+    """All labelled volumes and where they are mounted.
+
+    Reads /dev/disk/by-label and /proc/self/mountinfo directly, so it needs
+    no subprocesses or root privileges.
+
+    Returns:
+        dict: {label: Volume}
+    """
+    mounts = read_mounts(mountinfo)
+    volumes = {}
+    for label, device in read_labels(label_dir).items():
+        try:
+            rdev = os.stat(device).st_rdev
+        except OSError:
+            continue
+        mountpoint = mounts.get((os.major(rdev), os.minor(rdev)))
+        volumes[label] = Volume(label, device, mountpoint)
+    return volumes
+
+
+def is_card_label(label, valid_names):
+    """Whether a volume label is that of a card: an AudioMoth name in
+    valid_names or a faceplate (F + 4 characters, three of them digits).
+    """
+    return (label in valid_names or
+            (len(label) == 5 and label[0] == 'F' and label[1:4].isnumeric()))
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class DeviceWatcher:
+    """Waits for cards to be plugged in, removed, mounted or unmounted.
+
+    Labelled volumes appear and disappear as symlinks in /dev/disk/by-label,
+    which is watched with inotify; (un)mounts are signalled by the kernel
+    on /proc/self/mountinfo. Waiting costs no subprocesses or scans, so the
+    apps only look at devices when something has changed. If inotify is not
+    available it falls back to reporting a change every `fallback_interval`
+    seconds.
+    """
+
+    def __init__(self, fallback_interval=1):
+        self.fallback_interval = fallback_interval
+        self._libc = _load_libc()
+        self._poll = select.poll()
+        self._inotify = None
+        self._label_wd = None
+        self._mountinfo = None
+        self._last_fallback = 0
+        # Make the first call to wait() trigger a full scan
+        self._pending = True
+
+        if self._libc is not None:
+            fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self._inotify = fd
+                self._poll.register(fd, select.POLLIN)
+                # by-label is created by udev with the first labelled volume
+                self._add_watch(os.path.dirname(LABEL_DIR), IN_CREATE)
+                self._watch_labels()
+        try:
+            self._mountinfo = open(MOUNTINFO, 'rb')
+            self._mountinfo.read()
+            self._poll.register(self._mountinfo, select.POLLPRI)
+        except OSError:
+            self._mountinfo = None
+
+    @property
+    def event_driven(self):
+        return self._inotify is not None and self._mountinfo is not None
+
+    def _add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(
+            self._inotify, os.fsencode(path), mask)
+        return wd if wd >= 0 else None
+
+    def _watch_labels(self):
+        if self._label_wd is None:
+            self._label_wd = self._add_watch(
+                LABEL_DIR,
+                IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO |
+                IN_DELETE_SELF)
+
+    def _drain_inotify(self):
+        while True:
+            try:
+                buf = os.read(self._inotify, 4096)
+            except BlockingIOError:
+                break
+            if not buf:
+                break
+            # Parse struct inotify_event to notice when by-label goes away
+            i = 0
+            while i + 16 <= len(buf):
+                wd = int.from_bytes(buf[i:i + 4], 'little', signed=True)
+                mask = int.from_bytes(buf[i + 4:i + 8], 'little')
+                length = int.from_bytes(buf[i + 12:i + 16], 'little')
+                if wd == self._label_wd and mask & (IN_IGNORED |
+                                                    IN_DELETE_SELF):
+                    self._label_wd = None
+                i += 16 + length
+        self._watch_labels()
+
+    def wait(self, timeout):
+        """Wait up to `timeout` seconds for a device change.
+
+        Returns:
+            bool: whether something may have changed since the last call.
+        """
+        if self._pending:
+            self._pending = False
+            return True
+
+        changed = False
+        for fd, event in self._poll.poll(timeout * 1000):
+            changed = True
+            if fd == self._inotify:
+                self._drain_inotify()
+            elif self._mountinfo is not None and \
+                    fd == self._mountinfo.fileno():
+                # Re-read the table to re-arm the notification
+                self._mountinfo.seek(0)
+                self._mountinfo.read()
+
+        if not self.event_driven:
+            now = time.monotonic()
+            if now - self._last_fallback >= self.fallback_interval:
+                self._last_fallback = now
+                changed = True
+        return changed
+
+    def close(self):
+        if self._inotify is not None:
+            os.close(self._inotify)
+            self._inotify = None
+        if self._mountinfo is not None:
+            self._mountinfo.close()
+            self._mountinfo = None
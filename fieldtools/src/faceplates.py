@@ -0,0 +1,230 @@
+# Reading RFID faceplate logs (RT.TXT)
+
+import io
+import os
+import uuid
+import warnings
+
+import numpy as np
+import pandas as pd
+from fieldtools.src.paths import FACEPLATE_STORE
+from pathlib2 import Path
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+# Format of the Date column of RT files
+RT_DATE_FORMAT = '%d/%m/%Y'
+
+
+def _fields(line):
+    # Columns are tab-separated, with stray spaces around the tabs
+    return [field.strip() for field in line.rstrip('\r\n').split('\t')]
+
+
+def tag_column(columns):
+    """Name of the TagID column of an RT file (its exact header varies
+    between faceplate firmwares), or None.
+    """
+    for col in columns:
+        if 'TagID' in col:
+            return col
+    return None
+
+
+def read_rt_file(path):
+    """Read a faceplate RT.TXT log with the C parser of pandas.
+
+    The header rows that the faceplate repeats every time it restarts are
+    dropped from the text before it is parsed, so the fast C engine can be
+    used with a plain tab separator (instead of sep='\\s*\\t\\s*', which
+    needs the slow Python engine). All columns are read as strings, without
+    the spaces around the tabs; rows without a tag are dropped and a
+    'Datetime' column is added (see parse_rt_datetimes()).
+
+    Args:
+        path (str or PosixPath): path to the RT.TXT file.
+
+    Returns:
+        DataFrame or None: the reads, or None if the file has no TagID
+        column.
+    """
+    with open(path, 'r', errors='replace') as f:
+        lines = f.read().splitlines()
+    first = next((i for i, line in enumerate(lines) if line.strip()), None)
+    if first is None:
+        return None
+    header = _fields(lines[first])
+    tag = tag_column(header)
+    if tag is None:
+        return None
+    # Repeated header rows start with the name of the first column
+    repeated = header[0]
+    body = [line for line in lines[first + 1:]
+            if line and not line.lstrip().startswith(repeated)]
+
+    data = pd.read_csv(io.StringIO('\n'.join(body)), sep='\t', header=None,
+                       names=header, usecols=range(len(header)), dtype=str,
+                       skipinitialspace=True, keep_default_na=False,
+                       na_values=[''], engine='c')
+    for col in data.columns:
+        data[col] = data[col].str.rstrip()
+    data = data[data[tag].notna() & (data[tag] != '')].reset_index(drop=True)
+    data['Datetime'] = parse_rt_datetimes(data)
+    return data
+
+
+def _parse_distinct(values, parse):
+    # Parse each distinct value once and broadcast the results back
+    # (missing values have code -1 and become NaT)
+    codes, distinct = pd.factorize(values)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        parsed = parse(pd.Series(distinct, dtype=object)).to_numpy()
+    nat = parsed.dtype.type('NaT')
+    out = np.full(len(codes), nat, dtype=parsed.dtype)
+    out[codes >= 0] = parsed[codes[codes >= 0]]
+    return pd.Series(out, index=values.index)
+
+
+def _to_datetimes(distinct):
+    # Faceplates write day-first dates; the whole column is parsed with
+    # that format (never guessed per value, which mixes up 01/04 and 13/04)
+    parsed = pd.to_datetime(distinct, format=RT_DATE_FORMAT, errors='coerce')
+    rest = parsed.isna() & (distinct != '')
+    if rest.any():
+        # e.g. two-digit years or dashes, still day first
+        parsed[rest] = pd.to_datetime(distinct[rest], dayfirst=True,
+                                      errors='coerce')
+    return parsed.astype('datetime64[ns]')
+
+
+def _to_timedeltas(distinct):
+    return pd.to_timedelta(distinct, errors='coerce').astype(
+        'timedelta64[ns]')
+
+
+def parse_rt_datetimes(data):
+    """Timestamps of the rows of an RT file, NaT where they can't be read.
+
+    Faceplates log a handful of distinct dates per season (and many reads
+    per second), so each distinct Date and Time string is parsed only once.
+    """
+    if 'Date' not in data or len(data) == 0:
+        return pd.Series(pd.NaT, index=data.index, dtype='datetime64[ns]')
+    datetimes = _parse_distinct(data['Date'], _to_datetimes)
+    if 'Time' in data:
+        datetimes = datetimes + _parse_distinct(data['Time'], _to_timedeltas)
+    return datetimes
+
+
+def last_read_date(data):
+    """Date of the last read in an RT file (used to name its copy), or
+    None if no date can be read.
+    """
+    if 'Date' not in data or len(data) == 0:
+        return None
+    dates = _parse_distinct(data['Date'], _to_datetimes).dropna()
+    if len(dates) == 0:
+        return None
+    return dates.iloc[-1].date()
+
+
+# Season-wide store of reads ------------------------------------------------
+
+# Columns that identify a read
+READ_KEY = ['faceplate', 'Datetime', 'TagID']
+
+
+class FaceplateStore:
+    """All faceplate reads, as a Parquet dataset partitioned by day and
+    faceplate (root/date=YYYY-MM-DD/faceplate=F1234/*.parquet).
+
+    Appending only writes the reads that are not already in their
+    partition, so the same RT file can be added any number of times.
+    Queries only open the partitions and columns they need. Needs pyarrow.
+
+    Args:
+        root (str or PosixPath, optional): dataset directory.
+    """
+
+    def __init__(self, root=FACEPLATE_STORE):
+        if pa is None:
+            raise ImportError('The faceplate store needs pyarrow')
+        self.root = Path(root)
+
+    def _partition(self, day, faceplate):
+        return self.root / f'date={day}' / f'faceplate={faceplate}'
+
+    def _stored_keys(self, partition):
+        files = sorted(partition.glob('*.parquet'))
+        if not files:
+            return None
+        keys = pa.concat_tables(
+            [pq.read_table(f, columns=['Datetime', 'TagID']) for f in files])
+        return keys.to_pandas()
+
+    def append(self, faceplate, reads):
+        """Add the reads from an RT file (see read_rt_file()).
+
+        Reads without a readable date and time are left out.
+
+        Args:
+            faceplate (str): faceplate name (the card label).
+            reads (DataFrame): as returned by read_rt_file().
+
+        Returns:
+            int: number of new reads written.
+        """
+        reads = reads.rename(columns={tag_column(reads.columns): 'TagID'})
+        reads = reads.dropna(subset=['Datetime']).drop_duplicates(
+            subset=['Datetime', 'TagID'])
+        written = 0
+        for day, rows in reads.groupby(reads['Datetime'].dt.date):
+            partition = self._partition(day, faceplate)
+            stored = self._stored_keys(partition)
+            if stored is not None:
+                seen = rows.merge(stored, on=['Datetime', 'TagID'],
+                                  how='left', indicator=True)['_merge']
+                rows = rows[(seen == 'left_only').to_numpy()]
+            if not len(rows):
+                continue
+            partition.mkdir(parents=True, exist_ok=True)
+            table = pa.Table.from_pandas(
+                rows.astype({col: object for col in rows.columns
+                             if col != 'Datetime'}),
+                preserve_index=False)
+            name = f'{rows["Datetime"].min():%H%M%S}-{uuid.uuid4().hex[:8]}'
+            tmp = partition / f'.{name}.tmp'
+            pq.write_table(table, str(tmp))
+            os.replace(tmp, partition / f'{name}.parquet')
+            written += len(rows)
+        return written
+
+    def read(self, columns=None, faceplates=None, start=None, end=None):
+        """Reads in the store, optionally only some columns, faceplates
+        and days (start and end are inclusive dates).
+
+        Returns:
+            DataFrame
+        """
+        if not self.root.exists():
+            return pd.DataFrame(columns=columns or READ_KEY)
+        dataset = ds.dataset(str(self.root), format='parquet',
+                             partitioning='hive')
+        expr = None
+        conditions = []
+        if faceplates is not None:
+            conditions.append(ds.field('faceplate').isin(list(faceplates)))
+        if start is not None:
+            conditions.append(ds.field('date') >= str(start))
+        if end is not None:
+            conditions.append(ds.field('date') <= str(end))
+        for condition in conditions:
+            expr = condition if expr is None else expr & condition
+        return dataset.to_table(columns=columns, filter=expr).to_pandas()
@@ -0,0 +1,686 @@
+# FAT32 volumes: fast formatting from cached templates, and imaging cards
+#
+# mkfs.vfat is run once per card geometry, on a sparse image file, and only
+# the part of the result that mkfs actually writes (boot sectors, FATs and
+# the root directory) is kept. Formatting a card is then a single write of
+# that template, with the volume label and serial number patched in.
+#
+# Imaging reads a card in large sequential blocks into a sparse image file,
+# skipping the clusters that the FAT marks as free, and the files are then
+# extracted from the image without the card.
+#
+# Works the same on image files, e.g.:
+#   python -m fieldtools.src.fatimage format card.img AM01
+#   python -m fieldtools.src.fatimage info card.img
+#   python -m fieldtools.src.fatimage extract card.img out/AM01
+
+import argparse
+import array
+import calendar
+import datetime
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+
+from fieldtools.src.paths import FAT_TEMPLATE_DIR, safe_makedir
+from fieldtools.src.privhelper import copy_ranges
+
+# Label the templates are built with, replaced when they are used
+PLACEHOLDER_LABEL = 'FTEMPLATE'
+# Directory entry attribute of the volume label
+ATTR_VOLUME_ID = 0x08
+ATTR_LFN = 0x0F
+
+
+def parse_boot_sector(data):
+    """Layout of a FAT32 volume from its boot sector.
+
+    Args:
+        data (bytes): at least the first 512 bytes of the volume.
+
+    Returns:
+        dict: bytes_per_sector, sectors_per_cluster, reserved_sectors,
+        num_fats, hidden_sectors, total_sectors, fat_sectors, root_cluster,
+        backup_boot_sector, serial and label.
+    """
+    if len(data) < 512 or data[510:512] != b'\x55\xaa':
+        raise ValueError('Not a boot sector')
+    (bps, spc, reserved, nfats) = struct.unpack_from('<HBHB', data, 0x0B)
+    (hidden, total, fat_sectors) = struct.unpack_from('<III', data, 0x1C)
+    (root_cluster,) = struct.unpack_from('<I', data, 0x2C)
+    (backup,) = struct.unpack_from('<H', data, 0x32)
+    if data[0x52:0x5A] != b'FAT32   ' or not bps or not spc:
+        raise ValueError('Not a FAT32 volume')
+    (serial,) = struct.unpack_from('<I', data, 0x43)
+    return {'bytes_per_sector': bps, 'sectors_per_cluster': spc,
+            'reserved_sectors': reserved, 'num_fats': nfats,
+            'hidden_sectors': hidden, 'total_sectors': total,
+            'fat_sectors': fat_sectors, 'root_cluster': root_cluster,
+            'backup_boot_sector': backup, 'serial': serial,
+            'label': data[0x47:0x52].decode('ascii', 'replace').rstrip()}
+
+
+def root_dir_offset(boot):
+    """Byte offset of the first cluster of the root directory."""
+    bps = boot['bytes_per_sector']
+    data_start = (boot['reserved_sectors'] +
+                  boot['num_fats'] * boot['fat_sectors']) * bps
+    return data_start + (boot['root_cluster'] - 2) * \
+        boot['sectors_per_cluster'] * bps
+
+
+def metadata_length(boot):
+    """Bytes mkfs.vfat writes: reserved sectors, FATs and the first
+    cluster of the root directory."""
+    return root_dir_offset(boot) + \
+        boot['sectors_per_cluster'] * boot['bytes_per_sector']
+
+
+def _label_field(label):
+    name = label.upper().encode('ascii')
+    if len(name) > 11:
+        raise ValueError(f'Volume label {label} is longer than 11 characters')
+    return name.ljust(11, b' ')
+
+
+def _label_entry(buf, boot):
+    # Offset of the volume label entry in the root directory, or None
+    start = root_dir_offset(boot)
+    end = min(len(buf), start + boot['sectors_per_cluster'] *
+              boot['bytes_per_sector'])
+    for pos in range(start, end, 32):
+        first, attr = buf[pos], buf[pos + 11]
+        if first == 0:
+            break
+        if first != 0xE5 and attr != ATTR_LFN and attr & ATTR_VOLUME_ID:
+            return pos
+    return None
+
+
+def patch_volume(buf, label, serial, hidden_sectors=0):
+    """Set the label, serial number and partition offset of a template.
+
+    Patches the boot sector (label at 0x47, serial at 0x43, hidden sectors
+    at 0x1C), its backup copy and the volume label entry of the root
+    directory.
+
+    Args:
+        buf (bytearray): template (see build_template()), changed in place.
+        label (str): up to 11 characters.
+        serial (int): 32-bit volume serial number.
+        hidden_sectors (int, optional): sectors before the partition.
+    """
+    boot = parse_boot_sector(buf)
+    name = _label_field(label)
+    sectors = [0]
+    if boot['backup_boot_sector'] not in (0, 0xFFFF):
+        sectors.append(boot['backup_boot_sector'])
+    for sector in sectors:
+        base = sector * boot['bytes_per_sector']
+        struct.pack_into('<I', buf, base + 0x1C, hidden_sectors)
+        struct.pack_into('<I', buf, base + 0x43, serial)
+        buf[base + 0x47:base + 0x52] = name
+    entry = _label_entry(buf, boot)
+    if entry is None:
+        raise ValueError('The template has no volume label entry')
+    buf[entry:entry + 11] = name
+
+
+def read_volume_info(path):
+    """Label and serial number of a FAT32 volume (device or image file).
+
+    The label is read from the root directory, as blkid and udev do,
+    falling back to the one in the boot sector.
+
+    Returns:
+        dict: label, boot_label, serial (as XXXX-XXXX)
+    """
+    with open(path, 'rb') as f:
+        boot = parse_boot_sector(f.read(512))
+        f.seek(root_dir_offset(boot))
+        root = bytearray(root_dir_offset(boot)) + f.read(
+            boot['sectors_per_cluster'] * boot['bytes_per_sector'])
+    entry = _label_entry(root, boot)
+    label = (root[entry:entry + 11].decode('ascii', 'replace').rstrip()
+             if entry is not None else boot['label'])
+    return {'label': label, 'boot_label': boot['label'],
+            'serial': format_serial(boot['serial'])}
+
+
+def format_serial(serial):
+    """Volume serial number as shown by blkid (and in /dev/disk/by-uuid),
+    e.g. 1234-ABCD."""
+    return f'{serial >> 16:04X}-{serial & 0xFFFF:04X}'
+
+
+def new_serial():
+    """A random 32-bit volume serial number."""
+    return int.from_bytes(os.urandom(4), 'little')
+
+
+def read_device_volume_info(device, reader=None):
+    """read_volume_info() of a device that only root can read.
+
+    The boot sector and the root directory are copied to a scratch file
+    first, by `reader` (see image_card()), so this reads what is on the
+    device itself, not what udev remembers about it.
+    """
+    if reader is None:
+        def reader(device, image, ranges):
+            copy_ranges(device, image, ranges)
+    fd, scratch = tempfile.mkstemp(suffix='.img')
+    os.close(fd)
+    try:
+        reader(device, scratch, [[0, 512]])
+        with open(scratch, 'rb') as f:
+            boot = parse_boot_sector(f.read(512))
+        start = root_dir_offset(boot)
+        reader(device, scratch, [[start, start + boot['sectors_per_cluster'] *
+                                  boot['bytes_per_sector']]])
+        return read_volume_info(scratch)
+    finally:
+        os.remove(scratch)
+
+
+def device_geometry(path):
+    """Size in bytes, logical sector size and first sector of a block
+    device (from /sys) or of an image file (512-byte sectors, offset 0).
+    """
+    st = os.stat(path)
+    if not os.path.stat.S_ISBLK(st.st_mode):
+        return st.st_size, 512, 0
+    sys_dir = f'/sys/dev/block/{os.major(st.st_rdev)}:{os.minor(st.st_rdev)}'
+
+    def read(name, default=None):
+        try:
+            with open(os.path.join(sys_dir, name)) as f:
+                return int(f.read())
+        except OSError:
+            if default is None:
+                raise
+            return default
+
+    size = read('size') * 512
+    start = read('start', 0)
+    # Partitions don't have a queue/ folder; their disk does
+    sector = read('queue/logical_block_size', 0) or \
+        read('../queue/logical_block_size', 512)
+    return size, sector, start
+
+
+def build_template(size, sector_size=512, template_dir=FAT_TEMPLATE_DIR):
+    """Path to the FAT32 template for a volume of `size` bytes, building
+    it with mkfs.vfat (on a sparse image file) if it is not cached yet.
+    """
+    template = os.path.join(str(template_dir),
+                            f'fat32-{size}-{sector_size}.img')
+    if os.path.exists(template):
+        return template
+    safe_makedir(template_dir)
+    fd, scratch = tempfile.mkstemp(dir=str(template_dir), suffix='.tmp')
+    try:
+        os.ftruncate(fd, size)
+        os.close(fd)
+        subprocess.run(['mkfs.vfat', '-F32', '-S', str(sector_size),
+                        '-n', PLACEHOLDER_LABEL, scratch], check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        with open(scratch, 'rb') as f:
+            boot = parse_boot_sector(f.read(512))
+            f.seek(0)
+            data = f.read(metadata_length(boot))
+        with open(scratch, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(scratch, template)
+    finally:
+        if os.path.exists(scratch):
+            os.remove(scratch)
+    return template
+
+
+def make_format_image(device, label, serial=None,
+                      template_dir=FAT_TEMPLATE_DIR):
+    """Write the template for `device`, patched with its label, to a new
+    file, ready to be written to the start of the device.
+
+    Args:
+        device (str): block device or image file to be formatted.
+        label (str): new volume label.
+        serial (int, optional): volume serial; random by default.
+
+    Returns:
+        str: path to the image (the caller removes it).
+    """
+    size, sector_size, start = device_geometry(device)
+    with open(build_template(size, sector_size, template_dir), 'rb') as f:
+        buf = bytearray(f.read())
+    if serial is None:
+        serial = new_serial()
+    patch_volume(buf, label, serial, hidden_sectors=start)
+    fd, path = tempfile.mkstemp(dir=str(template_dir), suffix='.img')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(buf)
+    return path
+
+
+def write_image(image, target):
+    """Write an image to the start of a device or file, without truncating
+    it, and flush it to disk (what the privileged helper does for devices).
+    """
+    with open(image, 'rb') as src, open(target, 'r+b') as dst:
+        while True:
+            chunk = src.read(4 * 1024 * 1024)
+            if not chunk:
+                break
+            dst.write(chunk)
+        dst.flush()
+        os.fsync(dst.fileno())
+
+
+def format_image_file(path, label, serial=None,
+                      template_dir=FAT_TEMPLATE_DIR):
+    """Format an image file you own from a template (no privileges needed).
+    """
+    image = make_format_image(path, label, serial, template_dir)
+    try:
+        write_image(image, path)
+    finally:
+        os.remove(image)
+    return read_volume_info(path)
+
+
+# Imaging ---------------------------------------------------------------
+
+# Reads of a card are aligned to, and made in, blocks of this size
+IMAGE_BLOCK = 4 * 1024 * 1024
+# FAT32 entries only use their lower 28 bits
+_CLUSTER_MASK = 0x0FFFFFFF
+_BAD_CLUSTER = 0x0FFFFFF7
+_END_OF_CHAIN = 0x0FFFFFF8
+
+
+def data_start(boot):
+    """Byte offset of the data region (cluster 2)."""
+    return (boot['reserved_sectors'] +
+            boot['num_fats'] * boot['fat_sectors']) * boot['bytes_per_sector']
+
+
+def read_fat(f, boot):
+    """The first FAT of a volume, as an array of cluster entries.
+
+    Args:
+        f (file): volume opened in binary mode.
+    """
+    bps = boot['bytes_per_sector']
+    f.seek(boot['reserved_sectors'] * bps)
+    fat = array.array('I')
+    fat.frombytes(f.read(boot['fat_sectors'] * bps))
+    if sys.byteorder == 'big':
+        fat.byteswap()
+    clusters = (boot['total_sectors'] * bps - data_start(boot)) // \
+        (boot['sectors_per_cluster'] * bps)
+    del fat[clusters + 2:]
+    return fat
+
+
+def _aligned(ranges, block, limit):
+    # Round byte ranges out to whole blocks and merge those that touch
+    merged = []
+    for start, end in ranges:
+        start = start // block * block
+        end = min(-(-end // block) * block, limit)
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def allocated_ranges(boot, fat, block=IMAGE_BLOCK, limit=None):
+    """Byte ranges of a volume that hold data: the metadata region and
+    every run of clusters that is in use, aligned to `block`.
+
+    Args:
+        boot (dict): see parse_boot_sector().
+        fat (array): see read_fat().
+        block (int, optional): alignment of the ranges.
+        limit (int, optional): size of the volume.
+
+    Returns:
+        list: [start, end] byte offsets, in increasing order.
+    """
+    cluster = boot['sectors_per_cluster'] * boot['bytes_per_sector']
+    base = data_start(boot)
+    limit = limit or boot['total_sectors'] * boot['bytes_per_sector']
+    ranges = [(0, base)]
+    run = None
+    for n in range(2, len(fat)):
+        value = fat[n] & _CLUSTER_MASK
+        used = value != 0 and value != _BAD_CLUSTER
+        if used and run is None:
+            run = n
+        elif not used and run is not None:
+            ranges.append((base + (run - 2) * cluster,
+                           base + (n - 2) * cluster))
+            run = None
+    if run is not None:
+        ranges.append((base + (run - 2) * cluster,
+                       base + (len(fat) - 2) * cluster))
+    return _aligned(ranges, block, limit)
+
+
+def image_card(device, image, reader=None, block=IMAGE_BLOCK):
+    """Copy the used part of a FAT32 card to a sparse image file.
+
+    The metadata region is read first, to find the clusters in use; those
+    are then read in one sequential pass, in blocks of `block` bytes.
+
+    Args:
+        device (str): block device (or image file) of the card.
+        image (str): image file to create.
+        reader (callable, optional): called with the device, the image
+            and a list of [start, end] byte ranges to copy from one to the
+            same offsets of the other; by default privhelper.copy_ranges(),
+            in this process (copy-cards runs it through the helper, as
+            reading a card device needs root).
+        block (int, optional): bytes per read.
+
+    Returns:
+        dict: size of the card, bytes read and clusters in use.
+    """
+    if reader is None:
+        def reader(device, image, ranges):
+            copy_ranges(device, image, ranges, block)
+    size = device_geometry(device)[0]
+    with open(image, 'wb') as f:
+        f.truncate(size)
+    first = min(block, size)
+    reader(device, image, [[0, first]])
+    with open(image, 'rb') as f:
+        boot = parse_boot_sector(f.read(512))
+        metadata = _aligned([(0, data_start(boot))], block, size)[0][1]
+        if metadata > first:
+            reader(device, image, [[first, metadata]])
+        fat = read_fat(f, boot)
+    # The rest of the used clusters (the metadata region is already read)
+    ranges = [[max(start, metadata), end]
+              for start, end in allocated_ranges(boot, fat, block, size)
+              if end > metadata]
+    if ranges:
+        reader(device, image, ranges)
+    return {'size': size,
+            'bytes_read': max(first, metadata) +
+            sum(end - start for start, end in ranges),
+            'clusters_used': sum(1 for entry in fat[2:]
+                                 if entry & _CLUSTER_MASK)}
+
+
+# Extracting files from an image -------------------------------------------
+
+def _utc_offset():
+    """Seconds the local time zone is ahead of UTC now."""
+    return int(datetime.datetime.now().astimezone().utcoffset()
+               .total_seconds())
+
+
+def mount_utc_offset(image, mountpoint, step=900):
+    """Seconds the vfat driver shifts the FAT times of a mounted card by,
+    found by comparing a file in `mountpoint` with its entry in `image`
+    (an image of the same card), or None if there are no files to compare.
+
+    The driver (mounted without tz=, as ensure_mount does) uses the
+    kernel's time zone, which is set at boot and does not follow daylight
+    saving time, so the local offset now can be another one. The result is
+    rounded to `step` seconds.
+    """
+    with FatReader(image, utc_offset=0) as fat:
+        for relpath, entry in fat.walk():
+            try:
+                st = os.stat(os.path.join(str(mountpoint), relpath))
+            except OSError:
+                continue
+            return int(round((entry['mtime'] - st.st_mtime) / step) * step)
+    return None
+
+
+def _fat_time(date, time, offset=0):
+    # FAT timestamps have no time zone. The vfat driver shifts them all by
+    # the kernel's time zone offset (see mount_utc_offset()); extracted
+    # files have to get the same mtime as on the mounted card to match the
+    # same ledger rows.
+    try:
+        return calendar.timegm(((date >> 9) + 1980, (date >> 5) & 0xF,
+                                date & 0x1F, time >> 11, (time >> 5) & 0x3F,
+                                (time & 0x1F) * 2, 0, 0, 0)) - offset
+    except (ValueError, OverflowError):
+        return calendar.timegm((1980, 1, 1, 0, 0, 0, 0, 0, 0)) - offset
+
+
+def _short_name(entry):
+    base = entry[0:8].replace(b'\x05', b'\xe5', 1) if entry[0] == 5 \
+        else entry[0:8]
+    base = base.decode('cp437').rstrip()
+    ext = entry[8:11].decode('cp437').rstrip()
+    # Windows NT flags for all-lowercase names and extensions
+    if entry[12] & 0x08:
+        base = base.lower()
+    if entry[12] & 0x10:
+        ext = ext.lower()
+    return f'{base}.{ext}' if ext else base
+
+
+def _lfn_checksum(short):
+    total = 0
+    for byte in short:
+        total = (((total & 1) << 7) + (total >> 1) + byte) & 0xFF
+    return total
+
+
+class FatReader:
+    """Read the files in a FAT32 image (or device).
+
+    Args:
+        path (str): image file.
+        utc_offset (int, optional): seconds FAT times are ahead of UTC
+            (see mount_utc_offset()); by default that of the local time
+            zone now.
+    """
+
+    def __init__(self, path, utc_offset=None):
+        self.utc_offset = _utc_offset() if utc_offset is None else utc_offset
+        self._f = open(path, 'rb')
+        self.boot = parse_boot_sector(self._f.read(512))
+        self.fat = read_fat(self._f, self.boot)
+        self.cluster_size = self.boot['sectors_per_cluster'] * \
+            self.boot['bytes_per_sector']
+        self._data = data_start(self.boot)
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def runs(self, cluster):
+        """Runs of consecutive clusters in the chain that starts at
+        `cluster`, as (byte offset, length) pairs."""
+        runs = []
+        seen = 0
+        while 2 <= cluster < len(self.fat) and seen < len(self.fat):
+            offset = self._data + (cluster - 2) * self.cluster_size
+            if runs and runs[-1][0] + runs[-1][1] == offset:
+                runs[-1][1] += self.cluster_size
+            else:
+                runs.append([offset, self.cluster_size])
+            seen += 1
+            cluster = self.fat[cluster] & _CLUSTER_MASK
+            if cluster >= _END_OF_CHAIN or cluster == _BAD_CLUSTER:
+                break
+        return runs
+
+    def _read_chain(self, cluster):
+        data = bytearray()
+        for offset, length in self.runs(cluster):
+            self._f.seek(offset)
+            data += self._f.read(length)
+        return bytes(data)
+
+    def list_dir(self, cluster=None):
+        """Entries of a directory (the root directory by default), as
+        dicts with name, is_dir, cluster, size and mtime."""
+        if cluster is None:
+            cluster = self.boot['root_cluster']
+        data = self._read_chain(cluster)
+        entries, lfn, checksum = [], {}, None
+        for pos in range(0, len(data) - 31, 32):
+            entry = data[pos:pos + 32]
+            if entry[0] == 0:
+                break
+            if entry[0] == 0xE5:
+                lfn = {}
+                continue
+            attr = entry[11]
+            if attr == ATTR_LFN:
+                if entry[0] & 0x40:
+                    lfn, checksum = {}, entry[13]
+                lfn[entry[0] & 0x1F] = entry[1:11] + entry[14:26] + \
+                    entry[28:32]
+                continue
+            if attr & ATTR_VOLUME_ID:
+                lfn = {}
+                continue
+            name = _short_name(entry)
+            if lfn and checksum == _lfn_checksum(entry[0:11]):
+                raw = b''.join(lfn[i] for i in sorted(lfn))
+                name = raw.decode('utf-16-le', 'replace').split('\x00')[0]
+            lfn = {}
+            if name in ('.', '..'):
+                continue
+            (time, date, high) = (struct.unpack_from('<H', entry, 22)[0],
+                                  struct.unpack_from('<H', entry, 24)[0],
+                                  struct.unpack_from('<H', entry, 20)[0])
+            entries.append({
+                'name': name, 'is_dir': bool(attr & 0x10),
+                'cluster': (high << 16) | struct.unpack_from('<H', entry,
+                                                             26)[0],
+                'size': struct.unpack_from('<I', entry, 28)[0],
+                'mtime': _fat_time(date, time, self.utc_offset)})
+        return entries
+
+    def walk(self, cluster=None, prefix=''):
+        """Yield (relative path, entry) for every file in the volume."""
+        for entry in self.list_dir(cluster):
+            path = os.path.join(prefix, entry['name'])
+            if entry['is_dir']:
+                yield from self.walk(entry['cluster'], path)
+            else:
+                yield path, entry
+
+    def extract(self, entry, target):
+        """Write a file of the volume to `target`, with its mtime."""
+        remaining = entry['size']
+        with open(target, 'wb') as out:
+            if remaining and entry['cluster'] >= 2:
+                src = self._f.fileno()
+                for offset, length in self.runs(entry['cluster']):
+                    length = min(length, remaining)
+                    while length:
+                        chunk = os.pread(src, min(length, IMAGE_BLOCK),
+                                         offset)
+                        if not chunk:
+                            break
+                        out.write(chunk)
+                        offset += len(chunk)
+                        length -= len(chunk)
+                        remaining -= len(chunk)
+                    if not remaining:
+                        break
+        os.utime(target, (entry['mtime'], entry['mtime']))
+        return entry['size'] - remaining
+
+
+def extract_image(image, destination, utc_offset=None):
+    """Extract all the files in a FAT32 image to a folder, keeping their
+    names, folders and modification times (see FatReader for utc_offset).
+
+    Returns:
+        dict: {path of each extracted file: its size}; files whose data
+        ends early (a broken cluster chain) are extracted as far as it goes
+        and reported with the size they should have had in 'short'.
+    """
+    files, short = {}, {}
+    with FatReader(image, utc_offset) as fat:
+        for relpath, entry in fat.walk():
+            target = os.path.join(str(destination), relpath)
+            safe_makedir(os.path.dirname(target))
+            written = fat.extract(entry, target)
+            files[target] = written
+            if written != entry['size']:
+                short[target] = entry['size']
+    return {'files': files, 'short': short}
+
+
+def image_and_extract(device, workdir, label, reader=None,
+                      block=IMAGE_BLOCK, mountpoint=None):
+    """Image a card and extract its files to workdir/label, which can then
+    be used in place of the card's mount point. The image is removed once
+    the files are out. If the card is mounted at `mountpoint`, the files
+    get the same mtimes as there (see mount_utc_offset()).
+
+    Returns:
+        dict: the output of image_card() and extract_image(), plus the
+        path of the folder.
+    """
+    staging = os.path.join(str(workdir), label)
+    image = os.path.join(str(workdir), f'{label}.img')
+    shutil.rmtree(staging, ignore_errors=True)
+    safe_makedir(staging)
+    try:
+        result = image_card(device, image, reader, block)
+        offset = None
+        if mountpoint is not None:
+            offset = mount_utc_offset(image, mountpoint)
+        result.update(extract_image(image, staging, offset))
+    finally:
+        if os.path.exists(image):
+            os.remove(image)
+    result['path'] = staging
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Format FAT32 image files from cached templates, or '
+                    'extract the files in an image')
+    sub = parser.add_subparsers(dest='command', required=True)
+    fmt = sub.add_parser('format', help='format an image file')
+    fmt.add_argument('image')
+    fmt.add_argument('label')
+    show = sub.add_parser('info', help='show the label and serial number')
+    show.add_argument('path')
+    ext = sub.add_parser('extract', help='extract the files in an image')
+    ext.add_argument('image')
+    ext.add_argument('destination')
+    args = parser.parse_args()
+
+    if args.command == 'format':
+        print(format_image_file(args.image, args.label))
+    elif args.command == 'extract':
+        result = extract_image(args.image, args.destination)
+        print(f'{len(result["files"])} files extracted to {args.destination}')
+        for path, size in result['short'].items():
+            print(f'{path} is incomplete: {os.path.getsize(path)} of '
+                  f'{size} bytes')
+    else:
+        print(read_volume_info(args.path))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,37 @@
 import datetime
-import glob
+import errno
+import hashlib
 import inspect
+import io
 import os
-import re
 import shutil
 import sys
+import threading
 import time
 import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from getpass import getuser
-from subprocess import PIPE, Popen, check_output
 
+import numpy as np
 import pandas as pd
 import psutil
 import pygsheets
 from fieldtools.src.aesthetics import arrow, info, tcolor, tstyle
+from fieldtools.src.devices import is_card_label, volume_inventory
 from fieldtools.src.paths import OUT_DIR, PROJECT_DIR, safe_makedir
+from fieldtools.src.privhelper import get_helper
+from fieldtools.src.sheetcache import GoogleSheetSource, SheetCache
+from fieldtools.src.wavmeta import HEADER_BYTES
+from google.oauth2 import service_account
 from openpyxl.reader.excel import load_workbook
 from pathlib2 import Path, PosixPath
 from tqdm.auto import tqdm
 
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 warnings.simplefilter(action='ignore', category=UserWarning)
 
 
@@ -202,14 +215,85 @@ def order(frame, var):
     return frame
 
 
+# Google sheets
+
+GSHEETS_SECRET = PROJECT_DIR / "private" / "client_secret.json"
+GSHEETS_SCOPES = ('https://www.googleapis.com/auth/spreadsheets',
+                  'https://www.googleapis.com/auth/drive')
+# Maximum number of sheets downloaded at the same time
+GSHEETS_WORKERS = 8
+
+_gsheets_credentials = None
+_gsheets_lock = threading.Lock()
+_gsheets_local = threading.local()
+
+
+def gsheets_client():
+    """A pygsheets client for the calling thread.
+
+    The service account credentials are read (and their token fetched)
+    once and shared by every client; each thread gets its own client, as
+    their HTTP connections can't be used by two threads at once.
+    """
+    global _gsheets_credentials
+    with _gsheets_lock:
+        if _gsheets_credentials is None:
+            _gsheets_credentials = \
+                service_account.Credentials.from_service_account_file(
+                    str(GSHEETS_SECRET), scopes=GSHEETS_SCOPES)
+    client = getattr(_gsheets_local, 'client', None)
+    if client is None:
+        client = pygsheets.authorize(custom_credentials=_gsheets_credentials)
+        _gsheets_local.client = client
+    return client
+
+
+# Sheets are only downloaded again if they have changed; fieldwork-helper
+# sets how long copies are trusted for and whether to work offline
+sheet_cache = SheetCache(GoogleSheetSource(gsheets_client))
+
+
+def fetch_gsheet(key, has_header=True):
+    """First worksheet of a Google sheet, as a DataFrame of strings (from
+    sheet_cache if it has not changed).
+    """
+    return sheet_cache.get(key, has_header)
+
+
+def fetch_gsheets(keys, has_header=True, desc=None):
+    """Download several Google sheets at the same time, so that it takes
+    about as long as the slowest one.
+
+    Args:
+        keys (dict): {name: sheet key}
+        has_header (bool or dict, optional): passed to fetch_gsheet(); a
+            dict {name: bool} if the sheets differ.
+        desc (str, optional): show a progress bar with this description.
+
+    Returns:
+        dict: {name: DataFrame}, in the order of `keys`.
+    """
+    if not keys:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(GSHEETS_WORKERS, len(keys)),
+                            thread_name_prefix='gsheets') as pool:
+        futures = {pool.submit(fetch_gsheet, key,
+                               has_header.get(name, True)
+                               if isinstance(has_header, dict)
+                               else has_header): name
+                   for name, key in keys.items()}
+        done = as_completed(futures)
+        if desc is not None:
+            done = tqdm(done, total=len(futures), desc=desc, position=0,
+                        leave=True, bar_format='{desc}: {percentage:3.0f}%')
+        sheets = {futures[future]: future.result() for future in done}
+    return {name: sheets[name] for name in keys}
+
+
 def get_faceplate_update():
-    gc = pygsheets.authorize(
-        service_file=str(PROJECT_DIR / "private" / "client_secret.json")
-    )
     googlekey = 'ABCDEF'  # The faceplating sheet, substitute your own
     faceplate_info = (
-        gc.open_by_key(googlekey)[0]
-        .get_as_df(has_header=True, include_tailing_empty=False)
+        fetch_gsheet(googlekey)
         .filter(['Nestbox', 'Species'])
         .query('Species == "g" or Species == "G" or Species == "sp=g"')
     )
@@ -217,14 +301,21 @@ def get_faceplate_update():
     return faceplate_info['Nestbox'].tolist()
 
 
-def get_comments_update():
-    gc = pygsheets.authorize(
-        service_file=str(PROJECT_DIR / "private" / "client_secret.json")
-    )
-    googlekey = '1Mz8zK6l3G_C3nQLexLflr71atGn_YrTqPH6rxUTp3IE'  # The faceplating sheet
+# The faceplating sheet
+comments_key = '1Mz8zK6l3G_C3nQLexLflr71atGn_YrTqPH6rxUTp3IE'
+
+
+def get_comments_update(sheet=None):
+    """Nestboxes to visit again, with their comments.
+
+    Args:
+        sheet (DataFrame, optional): the comments sheet, if it has already
+            been downloaded (see get_nestbox_update(with_comments=True)).
+    """
+    if sheet is None:
+        sheet = fetch_gsheet(comments_key)
     comments_df = (
-        gc.open_by_key(googlekey)[0]
-        .get_as_df(has_header=True, include_tailing_empty=False)
+        sheet
         .query('Again == "YES" or Again == "TRUE"')
         .filter(['Nestbox', 'Comments'])
     )
@@ -257,74 +348,72 @@ class workers:
     }
 
 
-def get_nestbox_update():
-    gc = pygsheets.authorize(
-        service_file=str(PROJECT_DIR / "private" / "client_secret.json")
-    )
+def _worker_sheet(worker, clutch='Clutch'):
+    # Tidy up a fieldworker's sheet (the header is in its first row)
+    worker = worker.rename(
+        columns=worker.iloc[0]).drop(worker.index[0])
+    if "" in worker.columns:
+        worker = worker.drop([""], axis=1)
+    return worker.query("Pnum == Pnum").rename(
+        columns={"Pnum": "Nestbox",
+                 "weigh eggs (optional)": "Eggs",
+                 "Clutch size": clutch,
+                 "State code": "Nest", "Fieldworker": "웃"})
+
+
+def get_nestbox_update(with_comments=False):
+    """Great tit nestboxes in the fieldworkers' sheets, downloaded at the
+    same time.
+
+    Args:
+        with_comments (bool, optional): also download the comments sheet
+            (alongside the others) and return get_comments_update() too.
+    """
     # Download and append personal sheets
-    workerdict = workers.gdict
-    which_greti = pd.DataFrame(columns=["Nestbox", "웃"])
-
-    for worker, googlekey in tqdm(
-        workerdict.items(),
-        desc=arrow + "Downloading field worker data",
-        position=0,
-        leave=True,
-        bar_format='{desc}: {percentage:3.0f}%'
-    ):
-        name = worker
-        if name == "Sam":
-            pass
-        else:
-            worker = gc.open_by_key(googlekey)[0].get_as_df(
-                has_header=False, include_tailing_empty=False)
-            worker = worker.rename(
-                columns=worker.iloc[0]).drop(worker.index[0])
-            if "" in worker.columns:
-                worker = worker.drop([""], axis=1)
-            worker = (worker.query("Pnum == Pnum").rename(
-                columns={"Pnum": "Nestbox",
-                         "weigh eggs (optional)": "Eggs",
-                         "Clutch size": "Clutch",
-                         "State code": "Nest", "Fieldworker": "웃"}).filter(
-                ["Nestbox", "웃", "Eggs", "Clutch", 'Nest', 'Species']).replace("", "no"))
-
-            which_greti = which_greti.append(worker)
+    keys = {name: key for name, key in workers.gdict.items()
+            if name != "Sam"}
+    has_header = {name: False for name in keys}
+    if with_comments:
+        # As get_comments_update() fetches it, so that it is cached once
+        keys["_comments"] = comments_key
+        has_header["_comments"] = True
+    sheets = fetch_gsheets(keys, has_header=has_header,
+                           desc=arrow + "Downloading field worker data")
+    comments = sheets.pop("_comments", None)
+
+    frames = [pd.DataFrame(columns=["Nestbox", "웃"])]
+    for worker in sheets.values():
+        frames.append(_worker_sheet(worker).filter(
+            ["Nestbox", "웃", "Eggs", "Clutch", 'Nest', 'Species']).replace(
+            "", "no"))
+    which_greti = pd.concat(frames)
 
     # Now get faceplating info and join
     # greti_faceplated = get_faceplate_update()
     combined = which_greti.query(
         'Species == "g" or Species == "G" or '
-        'Species == "sp=g"').drop('Species', 1)
+        'Species == "sp=g"').drop('Species', axis=1)
 
+    if with_comments:
+        return combined, get_comments_update(comments)
     return combined
 
 
 def get_single_gsheet(name, key):
-    gc = pygsheets.authorize(
-        service_file=str(PROJECT_DIR / "private" /
-                         "client_secret.json")
-    )
     if name == "Sam":
         pass
     else:
-        worker = gc.open_by_key(key)[0].get_as_df(
-            has_header=False, include_tailing_empty=False)
-        worker = worker.rename(
-            columns=worker.iloc[0]).drop(worker.index[0])
-        if "" in worker.columns:
-            worker = worker.drop([""], axis=1)
-        worker = (worker.query("Pnum == Pnum").rename(
-            columns={"Pnum": "Nestbox",
-                     "weigh eggs (optional)": "Eggs",
-                     "Clutch size": "Eggs1",
-                     "State code": "Nest", "Fieldworker": "웃"}).filter(
+        worker = (_worker_sheet(fetch_gsheet(key, has_header=False),
+                                clutch="Eggs1").filter(
             ["Nestbox", "웃", "Eggs", 'Nest', 'Species']).replace("", "no"))
 
         return worker.query("Nestbox != 'no'")
 
 
-def get_recorded_gretis(recorded_csv, nestbox_coords, which_greti):
+def get_recorded_gretis(recorded_csv, nestbox_coords, which_greti,
+                        comments=None):
+    # comments: output of get_comments_update(), if already downloaded
+    # (see get_nestbox_update(with_comments=True)); otherwise fetched here
     picklename = OUT_DIR / (str(
         f"allrounds_{str(pd.Timestamp('today', tz='UTC').strftime('%Y%m%d'))}.pkl"))
     if len(which_greti) == 0:
@@ -385,7 +474,8 @@ def get_recorded_gretis(recorded_csv, nestbox_coords, which_greti):
         already_recorded = []
         diff_df = which_greti_1
     try:
-        comments = get_comments_update()
+        if comments is None:
+            comments = get_comments_update()
         diff_df = pd.merge(
             diff_df, comments, how="left", on=["Nestbox"])
         diff_df.fillna('', inplace=True)
@@ -430,11 +520,6 @@ def reconstruct_path(folders):
 
 # Format cards
 
-def get_mountedlist():
-    return [card[card.find("/"):] for card in check_output(
-            ["/bin/bash", "-c", "lsblk"]).decode("utf-8").split("\n") if "/" in card]
-
-
 def is_faceplate(dev):
     try:
         nm = Path(dev).name
@@ -477,86 +562,58 @@ def get_wav_filenames(card):
             ]
 
 
-def parse_blkid(valid_directories, output):
-    valid_devices = []
-    output = [str(i).split(' ') for i in output.split(b'\n') if b'LABEL' in i]
-    for ls in output:
-        for sbls in ls:
-            if sbls.startswith('LABEL'):
-                try:
-                    name = re.findall(r'"(.*?)"', sbls)[0]
-                    if (
-                        name[0] == 'F' and len(name) == 5 and
-                        name[1:4].isnumeric() or
-                        name in [am[0] for am in valid_directories]
-                    ):
-                        devpath = str(ls[0]).replace(
-                            ':', '').replace('b\'', '')
-                        valid_devices.append([name, devpath])
-                except:
-                    return None
-    return valid_devices
+def ensure_mount(
+        valid_directories, password, checked_cards, already_done, verbose,
+        volumes=None):
+    """Mount any card that is plugged in but not mounted under /media/<user>.
 
+    Args:
+        volumes (dict, optional): output of devices.volume_inventory(), if
+            the caller already has it.
+    """
+    if volumes is None:
+        volumes = volume_inventory()
+    valid_names = [am[0] for am in valid_directories]
+    sequences, labels = [], []
+    for label, vol in volumes.items():
+        if not is_card_label(label, valid_names):
+            continue
+        elif vol.mountpoint is not None:
+            continue
+        elif label in already_done:
+            continue
+        else:
 
-def ensure_mount(
-        valid_directories, password, checked_cards, already_done, verbose):
-    devnull = open(os.devnull, 'wb')
-    mounted = get_mountedlist()
-    blkid = "sudo blkid"
-    proc1 = Popen(["/bin/bash", "-c", blkid],
-                  stdin=PIPE, stdout=PIPE)
-    output, err = proc1.communicate()
-    valid_devices = parse_blkid(valid_directories, output)
-    if not valid_devices:
-        pass
-    else:
-        for dev in valid_devices:
-            if any(dev[0] in s for s in mounted):
-                continue
-            elif dev[0] in already_done:
-                continue
-            else:
-
-                # Mkdir
-                target_dir = os.path.join(os.sep, 'media', getuser(), dev[0])
-
-                if os.path.exists(target_dir):
-                    if verbose:
-                        print(
-                            tcolor(
-                                f'The mount point {target_dir} already exists',
-                                tstyle.rojoroto))
-                    # Delete mount point
-                    delmount = f"sudo rmdir {target_dir}"
-                    proc5 = Popen(["/bin/bash", "-c", delmount],
-                                  stdin=PIPE, stdout=PIPE, stderr=devnull)
-                    proc5.communicate()
-
-                mkdir = f"sudo mkdir -p {target_dir}"
-                proc2 = Popen(["/bin/bash", "-c", mkdir],
-                              stdin=PIPE, stdout=PIPE, stderr=devnull)
-                out2, err2 = proc2.communicate()
-                # Mount
-                dmount = f"sudo mount {dev[1]} {target_dir}"
-                proc3 = Popen(["/bin/bash", "-c", dmount],
-                              stdin=PIPE, stdout=PIPE, stderr=devnull)
-                out3, err3 = proc3.communicate()
-                checked_cards.append(dev[0])
+            # Mkdir
+            target_dir = os.path.join(os.sep, 'media', getuser(), label)
+            sequence = []
+
+            if os.path.exists(target_dir):
+                if verbose:
+                    print(
+                        tcolor(
+                            f'The mount point {target_dir} already exists',
+                            tstyle.rojoroto))
+                # Delete mount point
+                sequence.append(('rmdir', target_dir))
+
+            sequence.append(('mkdir', target_dir))
+            # Mount
+            sequence.append(('mount', vol.device, target_dir))
+            sequences.append(sequence)
+            labels.append(label)
+
+    # All cards are mounted in one go by the privileged helper
+    if sequences:
+        get_helper().run(*sequences, stop_on_error=False)
+        checked_cards.extend(labels)
     return checked_cards
 
 
 def umount_and_rmdir(password, card):
-    devnull = open(os.devnull, 'wb')
-    umount = f"sudo umount {card[0]}"
-    proc4 = Popen(["/bin/bash", "-c", umount],
-                  stdin=PIPE, stdout=PIPE, stderr=devnull)
-    proc4.communicate()
-    # Delete mount point
-    delmount = f"sudo rmdir {card[0]}"
-    proc5 = Popen(["/bin/bash", "-c", delmount],
-                  stdin=PIPE, stdout=PIPE, stderr=devnull)
-    proc5.communicate()
-    # print(f'delete mountpoint returned {proc5.returncode}')
+    # Unmount and delete mount point
+    get_helper().run([('umount', card[0]), ('rmdir', card[0])],
+                     stop_on_error=False)
 
 
 def any_mounted(mountdir):
@@ -570,7 +627,6 @@ def any_mounted(mountdir):
 
 
 def clean_vols():
-    devnull = open(os.devnull, 'wb')
     print(info + 'Cleaning mounted volumes')
     mountdir = os.path.join(os.sep, 'media', getuser()) + os.sep
     while any_mounted(mountdir):
@@ -582,16 +638,11 @@ def clean_vols():
             end="\r")
         time.sleep(1)
 
-        umount = f"sudo umount {mountdir}F* {mountdir}AM*"
-        proc4 = Popen(["/bin/bash", "-c", umount],
-                      stdin=PIPE, stdout=PIPE, stderr=devnull)
-        proc4.communicate()
-
-        # Delete mount point
-        delmount = f"sudo rmdir {mountdir}F* {mountdir}AM*"
-        proc5 = Popen(["/bin/bash", "-c", delmount],
-                      stdin=PIPE, stdout=PIPE, stderr=devnull)
-        proc5.communicate()
+        # Unmount and delete mount points
+        mountpoints = [mountdir + nm for nm in os.listdir(mountdir)
+                       if nm.startswith('F') or nm.startswith('AM')]
+        get_helper().run(*[[('umount', mp), ('rmdir', mp)]
+                           for mp in mountpoints], stop_on_error=False)
 
 # Copy cards
 
@@ -653,6 +704,12 @@ def copy_progress(copied, total):
 
 
 def fetch_recorder_info(recorders_dir):
+    """Deployment .csv as a DataFrame with parsed dates, for
+    get_nestbox_id().
+
+    Only used by the benchmark (src/benchmark.py), to compare the old
+    per-file lookup with DeploymentIndex.
+    """
     try:
         recorders_info = pd.read_csv(
             recorders_dir).query('Nestbox != "Nestbox"')
@@ -670,11 +727,111 @@ def fetch_recorder_info(recorders_dir):
     return recorders_info
 
 
-def copyfile(src, dst, *, follow_symlinks=True):
+# Size of the windows handed to the kernel (or read into memory) when copying
+COPY_WINDOW = 8 * 1024 * 1024
+# Errors that mean a kernel-side copy is not supported for this pair of files
+_NO_KERNEL_COPY = {errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                   errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF, errno.EPERM}
+# Suffix of files that are still being copied
+PARTIAL_SUFFIX = '.part'
+# How often the progress of a copy is made durable and journaled
+CHECKPOINT_BYTES = 64 * 1024 * 1024
+# Bytes hashed at each end of a file to find copies of the same content
+FINGERPRINT_BLOCK = 1024 * 1024
+# Hash used to check copies against their source
+DIGEST_ALGORITHM = 'xxh3_128' if xxhash is not None else 'blake2b'
+
+
+def new_hasher(algorithm=DIGEST_ALGORITHM):
+    """Fast hash (xxh3_128 if the xxhash package is installed, else
+    BLAKE2b) to check that copies match their source.
+    """
+    if algorithm == 'xxh3_128':
+        if xxhash is None:
+            raise ValueError('xxhash is not installed')
+        return xxhash.xxh3_128()
+    elif algorithm == 'blake2b':
+        return hashlib.blake2b(digest_size=16)
+    raise ValueError(f'Unknown hash algorithm {algorithm}')
+
+
+def format_digest(hasher, algorithm=DIGEST_ALGORITHM):
+    """Digest as stored in the copy ledger, e.g. 'blake2b:3f0a...'
+    """
+    return f'{algorithm}:{hasher.hexdigest()}'
+
+
+def file_digest(path, algorithm=DIGEST_ALGORITHM, length=COPY_WINDOW,
+                drop_cache=False):
+    """Hash a file with new_hasher(); returns it in format_digest() form.
+
+    With drop_cache, cached pages of the file are dropped before it is read
+    (so the data really comes from the disk) and as it is read (so hashing
+    gigabytes of recordings does not push everything else out of the page
+    cache). Only clean pages can be dropped: fsync recent copies first.
+    """
+    hasher = new_hasher(algorithm)
+    buf = bytearray(length)
+    view = memoryview(buf)
+    advise = drop_cache and hasattr(os, 'posix_fadvise')
+    with open(path, 'rb', buffering=0) as f:
+        fd = f.fileno()
+        if advise:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        offset = 0
+        while True:
+            n = f.readinto(view)
+            if not n:
+                break
+            hasher.update(view[:n])
+            if advise:
+                os.posix_fadvise(fd, offset, n, os.POSIX_FADV_DONTNEED)
+            offset += n
+    return format_digest(hasher, algorithm)
+
+
+def file_fingerprint(path, algorithm=DIGEST_ALGORITHM,
+                     block=FINGERPRINT_BLOCK):
+    """Quick content key of a file: a hash of its size and of its first and
+    last `block` bytes, in format_digest() form.
+
+    Files with different fingerprints differ; files with the same one are
+    very likely identical, which file_digest() can confirm.
+    """
+    size = os.stat(path).st_size
+    hasher = new_hasher(algorithm)
+    hasher.update(size.to_bytes(8, 'little'))
+    with open(path, 'rb', buffering=0) as f:
+        hasher.update(os.pread(f.fileno(), block, 0))
+        if size > block:
+            hasher.update(os.pread(f.fileno(), block,
+                                   max(block, size - block)))
+    return format_digest(hasher, algorithm)
+
+
+def copyfile(src, dst, *, follow_symlinks=True, callback=copy_progress,
+             hasher=None, journal=None, on_header=None):
     """Copy data from src to dst.
 
     If follow_symlinks is not set and src is a symbolic link, a new
     symlink will be created instead of copying the file it points to.
+    callback(copied, total) is called as data is written; pass None to
+    copy silently (e.g. when several cards are being copied at once).
+    If a hasher (see new_hasher()) is given it is updated with the data as
+    it is copied, so the checksum costs no extra read.
+
+    Data is written to dst + PARTIAL_SUFFIX, which is fsynced and renamed
+    to dst once complete. If a journal (see ledger.CopyLedger) is given,
+    progress is recorded every CHECKPOINT_BYTES with a digest of the data
+    written so far, and an interrupted copy of the same source resumes
+    from its last checkpoint: the partial file is hashed and checked
+    against that digest, without reading the source again. If it doesn't
+    match, the copy starts over, or, as a given hasher already holds the
+    damaged data, OSError is raised once the partial file is removed.
+
+    If on_header is given it is called with the first HEADER_BYTES of the
+    file (see wavmeta.parse_wav_header()) as soon as they have been read.
 
     """
     # By flutefreak7,
@@ -697,38 +854,285 @@ def copyfile(src, dst, *, follow_symlinks=True):
     if not follow_symlinks and os.path.islink(src):
         os.symlink(os.readlink(src), dst)
     else:
-        size = os.stat(src).st_size
-        with open(src, 'rb') as fsrc:
-            with open(dst, 'wb') as fdst:
-                copyfileobj(fsrc, fdst, callback=copy_progress, total=size)
+        _atomic_copy(src, dst, callback, hasher, journal, on_header)
     return dst
 
 
-def copyfileobj(fsrc, fdst, callback, total, length=16*1024):
+def _atomic_copy(src, dst, callback, hasher, journal, on_header=None):
+    # Data goes to a temporary file that only gets the final name once it
+    # is complete and on disk, so an interrupted copy never looks finished.
+    st = os.stat(src)
+    size = st.st_size
+    tmp = str(dst) + PARTIAL_SUFFIX
+    # Each checkpoint journals a digest of the data written so far, which
+    # is what a resumed copy checks its partial file against
+    running = hasher
+    if journal is not None and running is None:
+        running = new_hasher()
+
+    offset, digest = 0, None
+    if journal is not None:
+        offset, digest = journal.begin_transfer(src, dst, st)
+        try:
+            if os.stat(tmp).st_size < offset:
+                offset = 0
+        except OSError:
+            offset = 0
+
+    with open(src, 'rb') as fsrc:
+        with open(tmp, 'r+b' if offset else 'wb') as fdst:
+            if offset:
+                # Only the partial file is read (not the card), and the
+                # checksum carries on from its data once it matches
+                _hash_range(fdst.fileno(), 0, offset, running,
+                            memoryview(bytearray(COPY_WINDOW)))
+                if format_digest(running) != digest:
+                    if running is hasher:
+                        # The caller's hasher has taken the damaged data
+                        fdst.close()
+                        os.remove(tmp)
+                        journal.end_transfer(dst)
+                        raise OSError(
+                            errno.EIO, 'Partial copy does not match its '
+                            'checkpoint and has been removed', str(dst))
+                    running = new_hasher()
+                    offset = 0
+            if offset and on_header is not None:
+                # The header has already been copied
+                on_header(os.pread(fdst.fileno(), HEADER_BYTES, 0))
+                on_header = None
+            fdst.truncate(offset)
+            fdst.seek(offset)
+            fsrc.seek(offset)
+
+            synced = offset
+
+            def on_window(copied, total):
+                nonlocal synced
+                done = offset + copied
+                # Only journal data that is known to be on disk
+                if journal is not None and done - synced >= CHECKPOINT_BYTES:
+                    fdst.flush()
+                    os.fdatasync(fdst.fileno())
+                    journal.checkpoint_transfer(
+                        dst, done, format_digest(running))
+                    synced = done
+                if callback is not None:
+                    callback(done, total=total)
+
+            copyfileobj(fsrc, fdst, callback=on_window, total=size,
+                        hasher=running, on_header=on_header)
+            fdst.flush()
+            os.fsync(fdst.fileno())
+
+    os.replace(tmp, dst)
+    _fsync_dir(os.path.dirname(os.path.abspath(dst)))
+    if journal is not None:
+        journal.end_transfer(dst)
+
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _kernel_copy_funcs():
+    funcs = []
+    if hasattr(os, 'copy_file_range'):
+        funcs.append(lambda infd, outfd, n: os.copy_file_range(infd, outfd, n))
+    if hasattr(os, 'sendfile'):
+        funcs.append(lambda infd, outfd, n: os.sendfile(outfd, infd, None, n))
+    return funcs
+
+
+def copyfileobj(fsrc, fdst, callback, total, length=COPY_WINDOW, hasher=None,
+                on_header=None):
+    """Copy the contents of fsrc to fdst, starting at their current positions.
+
+    Data is moved by the kernel (copy_file_range, then sendfile) in windows
+    of `length` bytes, so it never passes through Python. If there is a
+    hasher, each window is then read back from the source, which is still
+    in the page cache, into a preallocated buffer and hashed (the card is
+    not read twice). If neither call works for these files, the data is
+    read into that buffer and written from it instead. callback(copied,
+    total) is called once per window. If on_header is given, the first
+    HEADER_BYTES are read in Python and passed to it before the rest is
+    copied.
+
+    Returns:
+        int: number of bytes copied.
+    """
     copied = 0
+    try:
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        infd = None
+    if on_header is not None:
+        if infd is not None:
+            # Read past the file object's buffer, then move it along
+            start = fsrc.tell()
+            head = os.pread(infd, HEADER_BYTES, start)
+            fsrc.seek(start + len(head))
+        else:
+            head = fsrc.read(HEADER_BYTES)
+        fdst.write(head)
+        if hasher is not None:
+            hasher.update(head)
+        copied = len(head)
+        on_header(head)
+        if callback is not None and copied:
+            callback(copied, total=total)
+
+    if infd is None:
+        funcs = []
+    else:
+        funcs = _kernel_copy_funcs()
+        fdst.flush()
+
+    buf = bytearray(length)
+    view = memoryview(buf)
+    for func in funcs:
+        try:
+            while True:
+                start = os.lseek(infd, 0, os.SEEK_CUR)
+                n = func(infd, outfd, length)
+                if not n:
+                    return copied
+                if hasher is not None:
+                    _hash_range(infd, start, n, hasher, view)
+                copied += n
+                if callback is not None:
+                    callback(copied, total=total)
+        except OSError as e:
+            if e.errno not in _NO_KERNEL_COPY:
+                raise
+            # Carry on from wherever this method stopped
+
     while True:
-        buf = fsrc.read(length)
-        if not buf:
+        n = fsrc.readinto(view)
+        if not n:
             break
-        fdst.write(buf)
-        copied += len(buf)
-        callback(copied, total=total)
+        fdst.write(view[:n])
+        if hasher is not None:
+            hasher.update(view[:n])
+        copied += n
+        if callback is not None:
+            callback(copied, total=total)
+    return copied
+
+
+def _hash_range(fd, offset, nbytes, hasher, view):
+    # Hash nbytes of a file from offset, through a preallocated buffer
+    while nbytes:
+        n = os.preadv(fd, [view[:min(len(view), nbytes)]], offset)
+        if not n:
+            raise OSError(errno.EIO, 'File shrank while it was copied')
+        hasher.update(view[:n])
+        offset += n
+        nbytes -= n
+
+
+def sweep_partial_copies(roots, journal=None, max_age=7 * 24 * 3600):
+    """Remove what interrupted copies left behind under `roots`.
+
+    A partial copy (dst + PARTIAL_SUFFIX) is kept while its journal row can
+    still resume it; rows without a partial file, or older than `max_age`
+    seconds (their card was never inserted again), are dropped with their
+    file, and partial files without a row are removed, as no copy can
+    resume them. Only run it when nothing is being copied to `roots`.
 
+    Args:
+        roots (list): destination folders of the copies (str or
+            PosixPath), i.e. every folder copies are journaled under.
+        journal (CopyLedger, optional): see copyfile().
+        max_age (float, optional): seconds a resumable copy is kept.
 
-def copy_with_progress(src, dst, *, follow_symlinks=True):
+    Returns:
+        tuple: (removed partial files, number of journal rows dropped)
+    """
+    now = time.time()
+    removed, dropped, kept = [], 0, set()
+    rows = journal.pending_transfers() if journal is not None else []
+    for row in rows:
+        tmp = row['destination'] + PARTIAL_SUFFIX
+        started = datetime.datetime.fromisoformat(row['started_at'])
+        if os.path.exists(tmp) and now - started.timestamp() <= max_age:
+            kept.add(os.path.abspath(tmp))
+            continue
+        journal.end_transfer(row['destination'])
+        dropped += 1
+        if os.path.exists(tmp):
+            os.remove(tmp)
+            removed.append(os.path.abspath(tmp))
+    for root in roots:
+        for dirpath, _, filenames in os.walk(str(root)):
+            for name in filenames:
+                path = os.path.abspath(os.path.join(dirpath, name))
+                if (name.endswith(PARTIAL_SUFFIX) and path not in kept and
+                        path not in removed):
+                    os.remove(path)
+                    removed.append(path)
+    return removed, dropped
+
+
+def copy_with_progress(src, dst, *, follow_symlinks=True, callback=copy_progress,
+                       hasher=None, journal=None, on_header=None):
 
     if type(dst) == PosixPath:
         dst = str(dst)
     if os.path.isdir(dst):
         dst = os.path.join(dst, os.path.basename(src))
-        print(f'\n{Path(dst).name}')
+        if callback is copy_progress:
+            print(f'\n{Path(dst).name}')
 
-    copyfile(src, dst, follow_symlinks=follow_symlinks)
+    copyfile(src, dst, follow_symlinks=follow_symlinks, callback=callback,
+             hasher=hasher, journal=journal, on_header=on_header)
     shutil.copymode(src, dst)
     return dst
 
 
+def link_file(src, dst, hasher=None, on_header=None):
+    """Give a file a second name instead of copying it (src and dst must be
+    on the same filesystem), e.g. to move files extracted from a card
+    image into place without writing their data again.
+
+    src is flushed to disk first, and the link is made under
+    dst + PARTIAL_SUFFIX and renamed to dst. hasher and on_header are as
+    in copyfile(); the data is read from src to hash it.
+    """
+    dst = str(dst)
+    with open(src, 'rb', buffering=0) as f:
+        fd = f.fileno()
+        os.fsync(fd)
+        if on_header is not None:
+            on_header(os.pread(fd, HEADER_BYTES, 0))
+        if hasher is not None:
+            _hash_range(fd, 0, os.fstat(fd).st_size, hasher,
+                        memoryview(bytearray(COPY_WINDOW)))
+    tmp = dst + PARTIAL_SUFFIX
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.link(src, tmp)
+    os.replace(tmp, dst)
+    _fsync_dir(os.path.dirname(os.path.abspath(dst)))
+    return dst
+
+
 def get_nestbox_id(recorders_dir, recorders_info, card, am, filedate):
+    """Nest box where an AM was when a file was recorded, filtering the
+    whole table for each file.
+
+    Replaced by DeploymentIndex.lookup() / plan_nestboxes(); only used by
+    the benchmark (src/benchmark.py) as the old per-file lookup.
+    """
     try:
         nestbox = recorders_info[(recorders_info['AM'] == str(am)) | (
             recorders_info['AM'] == int(am)) | (recorders_info['AM'] == '0' + str(am))]
@@ -754,13 +1158,207 @@ def get_nestbox_id(recorders_dir, recorders_info, card, am, filedate):
                 {recorders_dir}"""), tstyle.rojoroto))
 
 
+class DeploymentIndex:
+    """Recorder deployments read from the deployment .csv, indexed by AM.
+
+    The .csv is only parsed again when its modification time or size
+    changes (see refresh()). AM codes ('01', 1, '1') are normalised to a
+    single integer key, and each AM keeps its deployment intervals as
+    sorted arrays so that any timestamp can be resolved with a binary search.
+    Rows are also grouped by their Move_by day, for due_on().
+    """
+
+    def __init__(self, csv_path):
+        self.csv_path = Path(csv_path)
+        self.rows = None
+        self.frame = None
+        self._due = {}
+        self._stamp = None
+        self._ams = {}
+        self.refresh()
+
+    def refresh(self):
+        """Rebuild the index if the .csv has changed since it was last read.
+
+        Raises FileNotFoundError if the .csv can't be read; one with only a
+        header gives an empty index, and rows with dates that can't be read
+        are left out of lookup() (with a warning).
+
+        Returns:
+            bool: whether the index was rebuilt.
+        """
+        try:
+            st = os.stat(self.csv_path)
+        except OSError:
+            raise FileNotFoundError
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp == self._stamp:
+            return False
+
+        try:
+            rows = pd.read_csv(self.csv_path).query('Nestbox != "Nestbox"')
+        except Exception:
+            raise FileNotFoundError
+        # Dates as typed, for due_on()
+        typed = rows['Move_by'].astype(str).str.strip()
+        # A mistyped date only makes its own row unusable. The rows keep
+        # their dates as typed (due_on() returns them); lookup() uses a
+        # parsed copy
+        parsed = rows.assign(**{
+            column: pd.to_datetime(rows[column], format='%Y-%m-%d',
+                                   errors='coerce')
+            for column in ['Deployed', 'Move_by']})
+        bad = parsed[parsed['Deployed'].isna() | parsed['Move_by'].isna()]
+        if len(bad):
+            print(info + tcolor(
+                f'{len(bad)} row(s) of {self.csv_path.name} have a date that '
+                'is not YYYY-MM-DD (nest boxes '
+                f'{", ".join(bad["Nestbox"].astype(str))}); their '
+                'recordings cannot be matched', tstyle.rojoroto))
+
+        # Rows with a valid AM and interval, for lookup()
+        frame = parsed.copy()
+        frame['AM'] = pd.to_numeric(frame['AM'], errors='coerce')
+        frame = frame.dropna(subset=['AM']).astype({'AM': int})
+        frame['start'] = frame['Deployed'] + datetime.timedelta(hours=10)
+        frame['end'] = frame['Move_by'] + datetime.timedelta(hours=10)
+        # Intervals that end before they start can never match a file
+        frame = frame[frame['start'] <= frame['end']]
+
+        ams = {}
+        for am, deployments in frame.groupby('AM'):
+            deployments = deployments.sort_values('start')
+            ends = deployments['end'].to_numpy()
+            ams[am] = {
+                'starts': deployments['start'].to_numpy(),
+                'sorted_ends': np.sort(ends),
+                # Deployment with the latest end among the first i + 1
+                'argmax_ends': _running_argmax(ends),
+                'nestboxes': deployments['Nestbox'].to_numpy(),
+            }
+        # Row positions by Move_by day (as typed if it can't be read), for
+        # due_on()
+        days = parsed['Move_by'].dt.strftime('%Y-%m-%d').where(
+            parsed['Move_by'].notna(), typed)
+        self._due = days.groupby(days.to_numpy()).indices
+
+        self.rows = rows
+        self.frame = frame
+        self._ams = ams
+        self._stamp = stamp
+        return True
+
+    def lookup(self, am, filedates):
+        """Find the deployments of an AM that contain each timestamp.
+
+        A deployment contains t if Deployed + 10h < t <= Move_by + 10h.
+
+        Args:
+            am (int or str): AudioMoth number.
+            filedates (array-like): datetime64 timestamps (NaT allowed).
+
+        Returns:
+            tuple: (nestboxes, counts), where counts is the number of
+            deployments that contain each timestamp and nestboxes holds the
+            matching nest box where that number is exactly one (else None).
+        """
+        filedates = np.asarray(filedates, dtype='datetime64[ns]')
+        nestboxes = np.full(len(filedates), None, dtype=object)
+        idx = self._ams.get(int(am))
+        if idx is None:
+            return nestboxes, np.zeros(len(filedates), dtype=int)
+
+        # Every interval has start <= end, so the number of intervals
+        # containing t is #(start < t) - #(end < t)
+        n_started = np.searchsorted(idx['starts'], filedates, side='left')
+        n_ended = np.searchsorted(idx['sorted_ends'], filedates, side='left')
+        counts = n_started - n_ended
+        counts[np.isnat(filedates)] = 0
+
+        single = counts == 1
+        # If only one started interval is still open, it is the one that
+        # ends last
+        which = idx['argmax_ends'][n_started[single] - 1]
+        nestboxes[single] = idx['nestboxes'][which]
+        return nestboxes, counts
+
+    def nestbox_at(self, am, when):
+        """Nest box where an AM was at a given time, or None.
+        """
+        nestboxes, counts = self.lookup(am, [pd.Timestamp(when)])
+        return nestboxes[0]
+
+    def due_on(self, day):
+        """Deployments whose recorders have to be moved on a given day.
+
+        Taken from all the rows in the .csv, including those that lookup()
+        can't use (e.g. a mistyped AM): their recorders still have to be
+        collected. A Move_by that can't be read as a date only matches if
+        it is typed exactly as str(day). The rows are returned as read from
+        the .csv, with their dates as typed.
+        """
+        day = str(pd.Timestamp(day).date())
+        return self.rows.iloc[self._due.get(day, [])]
+
+    @property
+    def empty(self):
+        return len(self.rows) == 0
+
+
+def _running_argmax(values):
+    best = np.zeros(len(values), dtype=int)
+    for i in range(1, len(values)):
+        best[i] = i if values[i] >= values[best[i - 1]] else best[i - 1]
+    return best
+
+
+_deployment_indexes = {}
+
+
+def get_deployment_index(csv_path):
+    """Return an up-to-date DeploymentIndex for csv_path.
+
+    Indexes are kept for the lifetime of the process and only rebuilt when
+    the file changes.
+    """
+    key = str(csv_path)
+    if key not in _deployment_indexes:
+        _deployment_indexes[key] = DeploymentIndex(csv_path)
+    else:
+        _deployment_indexes[key].refresh()
+    return _deployment_indexes[key]
+
+
+def plan_nestboxes(index, am, files):
+    """Work out the destination nest box of every recording in a card at once.
+
+    All filename timestamps are parsed in a single call and resolved against
+    the deployment intervals of this AM with a binary search, instead of
+    filtering the whole deployment table once per file.
+
+    Args:
+        index (DeploymentIndex): see get_deployment_index().
+        am (int): AudioMoth number.
+        files (list): paths to .WAV files named YYYYMMDD_HHMMSS.WAV.
+
+    Returns:
+        tuple: (plan, unmatched, ambiguous) where plan is a dict mapping
+        each file to its nest box, and unmatched / ambiguous are lists of
+        files with zero / more than one compatible deployment (files whose
+        name is not a valid date are counted as unmatched).
+    """
+    filedates = pd.to_datetime(
+        pd.Series([Path(file).stem for file in files], dtype=object),
+        format='%Y%m%d_%H%M%S', errors='coerce')
+    nestboxes, counts = index.lookup(am, filedates)
+
+    plan = {file: nestbox for file, nestbox, n
+            in zip(files, nestboxes, counts) if n == 1}
+    unmatched = [file for file, n in zip(files, counts) if n == 0]
+    ambiguous = [file for file, n in zip(files, counts) if n > 1]
+    return plan, unmatched, ambiguous
+
+
 def get_full_faceplate_info():
-    gc = pygsheets.authorize(
-        service_file=str(PROJECT_DIR / "private" /
-                         "client_secret.json")
-    )
     facekey = '1NToFktrKMan-jlGYnASMM_AXSv1gwG2dYqjTGCY-6lw'  # The faceplating sheet
-    faceplate_info = (
-        gc.open_by_key(facekey)[0]
-        .get_as_df(has_header=True, include_tailing_empty=False))
-    return faceplate_info
+    return fetch_gsheet(facekey)
@@ -0,0 +1,388 @@
+# Register of files copied from cards, shared by copy-cards and format-cards
+
+import argparse
+import datetime
+import os
+import sqlite3
+import threading
+
+from fieldtools.src.funs import file_digest
+from fieldtools.src.paths import LEDGER_PATH, safe_makedir
+from pathlib2 import Path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS copies (
+    id INTEGER PRIMARY KEY,
+    card TEXT NOT NULL,
+    relpath TEXT NOT NULL,
+    size INTEGER,
+    mtime INTEGER,
+    destination TEXT,
+    status TEXT NOT NULL,
+    season INTEGER,
+    recorded_at TEXT NOT NULL,
+    digest TEXT,
+    fingerprint TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS copies_file
+    ON copies (relpath, ifnull(size, -1), ifnull(mtime, -1),
+               ifnull(season, -1));
+CREATE INDEX IF NOT EXISTS copies_content ON copies (size, fingerprint);
+CREATE TABLE IF NOT EXISTS transfers (
+    destination TEXT PRIMARY KEY,
+    source TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    digest TEXT,
+    started_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS wav_metadata (
+    id INTEGER PRIMARY KEY,
+    card TEXT NOT NULL,
+    relpath TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    destination TEXT,
+    sample_rate INTEGER,
+    channels INTEGER,
+    bits_per_sample INTEGER,
+    data_size INTEGER,
+    duration_s REAL,
+    recorded_at TEXT,
+    timezone TEXT,
+    device_id TEXT,
+    gain TEXT,
+    battery_v REAL,
+    temperature_c REAL,
+    comment TEXT,
+    problems TEXT,
+    checked_at TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS wav_metadata_file
+    ON wav_metadata (relpath, size, mtime);
+"""
+
+# Fields of wavmeta.parse_wav_header() stored in wav_metadata
+WAV_FIELDS = ['sample_rate', 'channels', 'bits_per_sample', 'data_size',
+              'duration_s', 'recorded_at', 'timezone', 'device_id', 'gain',
+              'battery_v', 'temperature_c', 'comment']
+
+# Statuses of files whose data is safely at the destination
+STORED = ('copied', 'duplicate')
+
+
+def ledger_relpath(path):
+    """Card-relative name of a file, e.g. AM01/20210401_060000.WAV
+    """
+    return os.sep.join(os.path.normpath(str(path)).split(os.sep)[-2:])
+
+
+def _season(mtime_ns):
+    return datetime.datetime.fromtimestamp(mtime_ns / 1e9).year
+
+
+class CopyLedger:
+    """SQLite register of the files that have been copied from cards.
+
+    Each copy is stored with its source card, card-relative path, size,
+    modification time, destination and status, so that two files that
+    share a name (e.g. the same AudioMoth in different years) are not
+    confused. Lookups use an index on (relpath, size, mtime).
+
+    Rows imported from old copied.txt files have no size or modification
+    time; they match any file with the same relative path recorded in the
+    same season.
+
+    The ledger also journals copies in progress (see funs.copyfile), so
+    that an interrupted copy can be resumed.
+    """
+
+    def __init__(self, path=LEDGER_PATH):
+        self.path = Path(path)
+        safe_makedir(self.path)
+        self._lock = threading.Lock()
+        self._con = sqlite3.connect(
+            str(self.path), timeout=30, check_same_thread=False)
+        self._con.execute('PRAGMA journal_mode=WAL')
+        self._con.execute('PRAGMA synchronous=NORMAL')
+        with self._con:
+            self._con.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._con.close()
+
+    def record(self, card, src, destination, status='copied', digest=None,
+               fingerprint=None):
+        """Register a file that has been copied from a card.
+
+        Args:
+            card (str): volume name of the card, e.g. AM01.
+            src (str or PosixPath): path to the file in the card.
+            destination (str or PosixPath): path to the copy.
+            status (str, optional): Defaults to 'copied'. 'duplicate' means
+                that the file was not copied because `destination` already
+                holds the same data.
+            digest (str, optional): checksum of the data, as returned by
+                funs.format_digest().
+            fingerprint (str, optional): see funs.file_fingerprint().
+        """
+        st = os.stat(src)
+        with self._lock, self._con:
+            self._con.execute(
+                'INSERT OR REPLACE INTO copies (card, relpath, size, mtime, '
+                'destination, status, season, recorded_at, digest, '
+                'fingerprint) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (card, ledger_relpath(src), st.st_size, st.st_mtime_ns,
+                 str(destination), status, _season(st.st_mtime_ns),
+                 datetime.datetime.now().isoformat(timespec='seconds'),
+                 digest, fingerprint))
+
+    def lookup(self, src):
+        """Copy record for a file in a card, as a dict, or None.
+        """
+        st = os.stat(src)
+        with self._lock:
+            cur = self._con.execute(
+                'SELECT * FROM copies WHERE relpath = ? AND size = ? '
+                'AND mtime = ? AND status IN (?, ?)',
+                (ledger_relpath(src), st.st_size, st.st_mtime_ns) + STORED)
+            row = cur.fetchone()
+            if row is None:
+                return None
+            return dict(zip([col[0] for col in cur.description], row))
+
+    def is_copied(self, src):
+        """Whether a file in a card has already been copied.
+        """
+        st = os.stat(src)
+        with self._lock:
+            row = self._con.execute(
+                'SELECT 1 FROM copies WHERE relpath = ? AND ('
+                '(size = ? AND mtime = ? AND status IN (?, ?)) OR '
+                "(size IS NULL AND season = ? AND status = 'imported')) "
+                'LIMIT 1',
+                (ledger_relpath(src), st.st_size, st.st_mtime_ns) + STORED +
+                (_season(st.st_mtime_ns),)).fetchone()
+        return row is not None
+
+    def copies(self, card=None, season=None):
+        """Copy records, optionally of one card and/or season, as dicts.
+        """
+        query = "SELECT * FROM copies WHERE status = 'copied'"
+        params = []
+        if card is not None:
+            query += ' AND card = ?'
+            params.append(card)
+        if season is not None:
+            query += ' AND season = ?'
+            params.append(season)
+        with self._lock:
+            cur = self._con.execute(query + ' ORDER BY card, relpath', params)
+            cols = [col[0] for col in cur.description]
+            return [dict(zip(cols, row)) for row in cur.fetchall()]
+
+    def find_duplicate(self, src, fingerprint):
+        """An earlier copy with the same data as a file in a card, or None.
+
+        Candidates are found by size and fingerprint (see
+        funs.file_fingerprint()) and confirmed by hashing the whole file
+        and comparing it with their digest, whatever their name, card or
+        nest box.
+
+        Returns:
+            dict: the copy record of the original, or None.
+        """
+        size = os.stat(src).st_size
+        with self._lock:
+            cur = self._con.execute(
+                'SELECT * FROM copies WHERE size = ? AND fingerprint = ? '
+                "AND status = 'copied' AND digest IS NOT NULL",
+                (size, fingerprint))
+            cols = [col[0] for col in cur.description]
+            candidates = [dict(zip(cols, row)) for row in cur.fetchall()]
+        digests = {}
+        for row in candidates:
+            if not os.path.exists(row['destination']):
+                continue
+            algorithm = row['digest'].split(':')[0]
+            if algorithm not in digests:
+                digests[algorithm] = file_digest(src, algorithm)
+            if digests[algorithm] == row['digest']:
+                return row
+        return None
+
+    def missing(self, files):
+        """Files (paths in a card) that have not been copied yet.
+        """
+        return [file for file in files if not self.is_copied(file)]
+
+    def failed(self, files):
+        """Files in a card whose last copy failed verification. They must
+        be copied again even if a file with their name is at the
+        destination.
+        """
+        failed = set()
+        for file in files:
+            st = os.stat(file)
+            with self._lock:
+                row = self._con.execute(
+                    "SELECT 1 FROM copies WHERE relpath = ? AND size = ? "
+                    "AND mtime = ? AND status = 'failed' LIMIT 1",
+                    (ledger_relpath(file), st.st_size,
+                     st.st_mtime_ns)).fetchone()
+            if row is not None:
+                failed.add(file)
+        return failed
+
+    def unconfirmed(self, files):
+        """Files in a card whose copy can't be confirmed byte for byte.
+
+        A copy is confirmed if it exists, has the same size as the file in
+        the card and hashes to the digest recorded when it was copied.
+        """
+        failed = []
+        for file in files:
+            row = self.lookup(file)
+            if row is None or row['digest'] is None:
+                failed.append(file)
+                continue
+            destination = row['destination']
+            algorithm = row['digest'].split(':')[0]
+            try:
+                if (os.stat(destination).st_size != row['size'] or
+                        file_digest(destination, algorithm) != row['digest']):
+                    failed.append(file)
+            except (OSError, ValueError):
+                failed.append(file)
+        return failed
+
+    def begin_transfer(self, src, destination, st):
+        """Start journaling a copy.
+
+        Returns:
+            tuple: (offset, digest) the copy can resume from: the last
+            checkpoint of an interrupted copy of the same source (same size
+            and mtime), with the digest of the data written up to it, or
+            (0, None).
+        """
+        destination = str(destination)
+        with self._lock, self._con:
+            row = self._con.execute(
+                'SELECT size, mtime, offset, digest FROM transfers '
+                'WHERE destination = ?', (destination,)).fetchone()
+            if (row is not None and row[:2] == (st.st_size, st.st_mtime_ns)
+                    and row[3] is not None):
+                return row[2], row[3]
+            self._con.execute(
+                'INSERT OR REPLACE INTO transfers (destination, source, '
+                'size, mtime, offset, started_at) VALUES (?, ?, ?, ?, 0, ?)',
+                (destination, str(src), st.st_size, st.st_mtime_ns,
+                 datetime.datetime.now().isoformat(timespec='seconds')))
+            return 0, None
+
+    def checkpoint_transfer(self, destination, offset, digest):
+        """Record that the first `offset` bytes of a copy are on disk, with
+        their digest (see funs.format_digest()).
+        """
+        with self._lock, self._con:
+            self._con.execute(
+                'UPDATE transfers SET offset = ?, digest = ? '
+                'WHERE destination = ?', (offset, digest, str(destination)))
+
+    def end_transfer(self, destination):
+        with self._lock, self._con:
+            self._con.execute(
+                'DELETE FROM transfers WHERE destination = ?',
+                (str(destination),))
+
+    def pending_transfers(self):
+        """Copies that were interrupted, as a list of dicts.
+        """
+        with self._lock:
+            cur = self._con.execute(
+                'SELECT * FROM transfers ORDER BY started_at')
+            cols = [col[0] for col in cur.description]
+            return [dict(zip(cols, row)) for row in cur.fetchall()]
+
+    def record_wav_metadata(self, card, src, destination, meta):
+        """Register the header fields of a recording.
+
+        Args:
+            card (str): volume name of the card, e.g. AM01.
+            src (str or PosixPath): path to the file in the card.
+            destination (str or PosixPath): path to the copy.
+            meta (dict): as returned by wavmeta.parse_wav_header().
+        """
+        st = os.stat(src)
+        columns = ['card', 'relpath', 'size', 'mtime', 'destination'] + \
+            WAV_FIELDS + ['problems', 'checked_at']
+        values = [card, ledger_relpath(src), st.st_size, st.st_mtime_ns,
+                  str(destination)] + [meta.get(f) for f in WAV_FIELDS] + \
+            ['; '.join(meta['problems']) or None,
+             datetime.datetime.now().isoformat(timespec='seconds')]
+        with self._lock, self._con:
+            self._con.execute(
+                f'INSERT OR REPLACE INTO wav_metadata ({", ".join(columns)}) '
+                f'VALUES ({", ".join("?" * len(columns))})', values)
+
+    def flagged_recordings(self, card=None):
+        """Recordings whose header had problems, as a list of dicts.
+        """
+        query = 'SELECT * FROM wav_metadata WHERE problems IS NOT NULL'
+        params = ()
+        if card is not None:
+            query += ' AND card = ?'
+            params = (card,)
+        with self._lock:
+            cur = self._con.execute(query + ' ORDER BY card, relpath', params)
+            cols = [col[0] for col in cur.description]
+            return [dict(zip(cols, row)) for row in cur.fetchall()]
+
+    def import_copied_txt(self, txt_path, season=None):
+        """Import a copied.txt file written by older versions of copy-cards.
+
+        Args:
+            txt_path (str or PosixPath): path to copied.txt
+            season (int, optional): year the file belongs to. Defaults to
+                the name of the folder that contains it, if it is a year.
+
+        Returns:
+            int: number of new rows.
+        """
+        txt_path = Path(txt_path)
+        if season is None and txt_path.parent.name.isnumeric():
+            season = int(txt_path.parent.name)
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+        with open(txt_path, 'r') as cp:
+            relpaths = {line.strip() for line in cp if line.strip()}
+        with self._lock, self._con:
+            before = self._con.total_changes
+            self._con.executemany(
+                'INSERT OR IGNORE INTO copies (card, relpath, status, season, '
+                "recorded_at) VALUES (?, ?, 'imported', ?, ?)",
+                [(relpath.split(os.sep)[0], relpath, season, now)
+                 for relpath in sorted(relpaths)])
+            return self._con.total_changes - before
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Import copied.txt files into the copy ledger')
+    parser.add_argument('files', nargs='+', help='copied.txt file(s)')
+    parser.add_argument('--season', type=int, default=None,
+                        help='year the files belong to '
+                        '(default: name of their folder)')
+    parser.add_argument('--ledger', default=str(LEDGER_PATH))
+    args = parser.parse_args()
+
+    ledger = CopyLedger(args.ledger)
+    for txt in args.files:
+        n = ledger.import_copied_txt(txt, season=args.season)
+        print(f'{txt}: imported {n} new file(s)')
+    ledger.close()
+
+
+if __name__ == '__main__':
+    main()
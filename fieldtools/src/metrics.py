@@ -0,0 +1,200 @@
+# Timing events from copy-cards and format-cards, as JSON lines, and a
+# summary of them: python -m fieldtools.src.metrics
+
+import argparse
+import datetime
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+
+import pandas as pd
+from fieldtools.src.paths import METRICS_PATH, safe_makedir
+from tabulate import tabulate
+
+
+def app_metrics_path(app, path=METRICS_PATH):
+    """File an app writes its events to, e.g. metrics-copy.jsonl for
+    app='copy'. Only one process writes to each file, so that rotating it
+    can't lose or mix up the events of another.
+    """
+    path = str(path)
+    root, ext = os.path.splitext(path)
+    return f'{root}-{app}{ext}'
+
+
+class MetricsLogger:
+    """Writes the timing events of an app to a rotating JSON-lines file
+    (see app_metrics_path()).
+
+    Each line is {"ts": ISO time, "event": name, ...fields}. Event names
+    used by the apps: card_detected, mount, file_copied, card_copied,
+    unmount and format. Times are in seconds, sizes in bytes.
+    """
+
+    def __init__(self, app, path=METRICS_PATH, max_bytes=10 * 1024 * 1024,
+                 backups=10):
+        path = app_metrics_path(app, path)
+        safe_makedir(path)
+        self._logger = logging.getLogger(f'fieldtools.metrics.{path}')
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        if not self._logger.handlers:
+            handler = RotatingFileHandler(
+                str(path), maxBytes=max_bytes, backupCount=backups)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self._logger.addHandler(handler)
+        self._lock = threading.Lock()
+
+    def emit(self, event, **fields):
+        record = {'ts': datetime.datetime.now().isoformat(
+            timespec='milliseconds'), 'event': event}
+        record.update(fields)
+        with self._lock:
+            self._logger.info(json.dumps(record, default=str))
+
+    @contextmanager
+    def timed(self, event, **fields):
+        """Emit `event` with the time taken by the block, in 'seconds'.
+
+        The block can add fields to the dict it is given.
+        """
+        start = time.perf_counter()
+        try:
+            yield fields
+        finally:
+            self.emit(event, seconds=round(time.perf_counter() - start, 4),
+                      **fields)
+
+
+def metric_files(path=METRICS_PATH, app=None):
+    """The metrics files of every app (see app_metrics_path()), or only of
+    `app`, and their rotated backups. Each app's files are listed oldest
+    first (file.10 before file.9 ... file.1, and file last).
+    """
+    root, ext = os.path.splitext(str(path))
+    if app is not None:
+        currents = [app_metrics_path(app, path)]
+    else:
+        currents = [str(path)] + sorted(
+            glob.glob(glob.escape(root) + '-*' + glob.escape(ext)))
+    files = []
+    for current in currents:
+        backups = []
+        for fn in glob.glob(glob.escape(current) + '.*'):
+            suffix = fn[len(current) + 1:]
+            if suffix.isdigit():
+                backups.append((int(suffix), fn))
+        files += [fn for _, fn in sorted(backups, reverse=True)]
+        if os.path.exists(current):
+            files.append(current)
+    return files
+
+
+def read_metrics(path=METRICS_PATH, events=None, app=None):
+    """Events in the metrics files of every app and their rotated backups,
+    as a DataFrame sorted by time.
+
+    Args:
+        path (str or PosixPath, optional): the metrics file the apps'
+            files are named after (see app_metrics_path()).
+        events (list, optional): only keep these events (lines of other
+            events are not parsed).
+        app (str, optional): only read the files of this app.
+    """
+    records = []
+    tags = None if events is None else [f'"event": "{event}"'
+                                        for event in events]
+    for fn in metric_files(path, app):
+        with open(fn, 'r') as f:
+            for line in f:
+                if tags is not None and not any(tag in line for tag in tags):
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    df = pd.DataFrame(records)
+    if len(df):
+        if events is not None:
+            df = df[df['event'].isin(events)]
+        df['ts'] = pd.to_datetime(df['ts'])
+        df = df.sort_values('ts', kind='stable').reset_index(drop=True)
+        df['day'] = df['ts'].dt.date
+    return df
+
+
+def _p50_p95(grouped, column):
+    return grouped[column].quantile([.5, .95]).unstack().rename(
+        columns={.5: 'p50', .95: 'p95'})
+
+
+def summarise(df):
+    """Tables with latencies and throughput from read_metrics() output.
+
+    Returns:
+        dict: {title: DataFrame}
+    """
+    tables = {}
+    if not len(df):
+        return tables
+
+    timed = df.dropna(subset=['seconds']) if 'seconds' in df else df[:0]
+    if len(timed):
+        lat = _p50_p95(timed.groupby('event'), 'seconds')
+        lat.insert(0, 'n', timed.groupby('event').size())
+        tables['Latency by event (s)'] = lat
+
+    cards = df[df['event'] == 'card_copied'].copy()
+    if len(cards):
+        cards['mb_s'] = cards['bytes'] / 1e6 / cards['seconds'].clip(
+            lower=1e-6)
+        tables['Copy throughput by card (MB/s)'] = cards[
+            ['ts', 'card', 'files', 'bytes', 'seconds', 'mb_s']].round(
+                {'seconds': 2, 'mb_s': 2})
+        cards['am'] = cards['card'].where(cards['card'].str.startswith('AM'))
+        per_am = cards.dropna(subset=['am']).groupby('am')
+        if len(cards.dropna(subset=['am'])):
+            tables['Copy throughput by AM (MB/s)'] = _p50_p95(
+                per_am, 'mb_s').round(2)
+        per_day = cards.groupby('day')
+        day = _p50_p95(per_day, 'mb_s').round(2)
+        day.insert(0, 'cards', per_day.size())
+        day.insert(1, 'GB', (per_day['bytes'].sum() / 1e9).round(2))
+        day.insert(2, 'copy hours', per_day['seconds'].sum() / 3600)
+        tables['Copy throughput by day (MB/s)'] = day.round(2)
+
+    files = df[df['event'] == 'file_copied']
+    if len(files):
+        files = files.assign(mb_s=files['bytes'] / 1e6 /
+                             files['seconds'].clip(lower=1e-6))
+        tables['File copy throughput by card (MB/s)'] = _p50_p95(
+            files.groupby('card'), 'mb_s').round(2)
+    return tables
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Summarise card copy / format timings')
+    parser.add_argument('--path', default=str(METRICS_PATH))
+    parser.add_argument('--day', default=None,
+                        help='only this day (YYYY-MM-DD)')
+    args = parser.parse_args()
+
+    df = read_metrics(args.path)
+    if args.day and len(df):
+        df = df[df['day'] == pd.Timestamp(args.day).date()]
+    tables = summarise(df)
+    if not tables:
+        print('No metrics recorded yet')
+    for title, table in tables.items():
+        print(f'\n{title}\n')
+        print(tabulate(table, headers='keys', tablefmt='simple'))
+
+
+if __name__ == '__main__':
+    main()
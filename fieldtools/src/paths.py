@@ -23,6 +23,19 @@ RESOURCES_DIR = PROJECT_DIR / "resources"
 EGO_DIR = Path(__file__).parents[2] / 'fieldtools' / 'src'
 OUT_DIR = PROJECT_DIR / "resources" / "fieldwork" / \
     str(date.today().year)  # Where to output files other than raw data
+# Register of files copied from cards (kept across seasons)
+LEDGER_PATH = RESOURCES_DIR / "fieldwork" / "copy-ledger.sqlite"
+# Faceplate reads from every RT file copied (see src/faceplates.py)
+FACEPLATE_STORE = RESOURCES_DIR / "fieldwork" / "faceplate-reads"
+# Timings of card copies / formats (see src/metrics.py); each app writes
+# its own metrics-<app>.jsonl next to it
+METRICS_PATH = OUT_DIR / "metrics.jsonl"
+# Results of python -m fieldtools.src.benchmark (kept across seasons)
+BENCHMARKS_PATH = RESOURCES_DIR / "fieldwork" / "benchmarks.jsonl"
+# FAT32 templates used to format cards quickly (see src/fatimage.py)
+FAT_TEMPLATE_DIR = RESOURCES_DIR / "fieldwork" / "fat-templates"
+# Last downloaded copy of each Google sheet (see src/sheetcache.py)
+SHEET_CACHE_DIR = RESOURCES_DIR / "fieldwork" / "sheet-cache"
 
 # Volume names to listen for:
 # (Here AudioMoth codes)
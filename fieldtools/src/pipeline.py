@@ -0,0 +1,99 @@
+# Minimal asyncio pipeline: a source feeding a chain of stages through
+# bounded queues
+
+import asyncio
+
+
+class Stage:
+    """A step of a Pipeline.
+
+    Args:
+        name (str): used in error reports.
+        func (callable): takes an item and returns the item for the next
+            stage (or None to drop it). Blocking functions are run in the
+            pipeline's executor; coroutine functions are awaited directly.
+        workers (int, optional): items this stage can work on at once.
+            Defaults to 1.
+    """
+
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = workers
+
+
+class Pipeline:
+    """Runs items from an async source through a list of stages.
+
+    Stages are connected by queues of `maxsize` items, so a slow stage
+    makes the stages before it wait (backpressure) rather than piling up
+    work, while the source keeps being read as long as there is room.
+
+    Args:
+        stages (list): Stage objects, in order.
+        maxsize (int, optional): size of the queue in front of each stage.
+        executor (Executor, optional): where blocking stage functions run.
+            Defaults to the event loop's default executor.
+        on_error (callable, optional): called as on_error(stage_name, item,
+            exception) when a stage fails; whatever it returns is passed on
+            to the next stage (None drops the item). By default the
+            exception is raised.
+    """
+
+    def __init__(self, stages, maxsize=1, executor=None, on_error=None):
+        self.stages = stages
+        self.maxsize = maxsize
+        self.executor = executor
+        self.on_error = on_error
+
+    async def _call(self, stage, item):
+        if asyncio.iscoroutinefunction(stage.func):
+            return await stage.func(item)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, stage.func, item)
+
+    async def _work(self, stage, inbox, outbox):
+        while True:
+            item = await inbox.get()
+            try:
+                try:
+                    result = await self._call(stage, item)
+                except Exception as e:
+                    if self.on_error is None:
+                        raise
+                    result = self.on_error(stage.name, item, e)
+                if result is not None and outbox is not None:
+                    await outbox.put(result)
+            finally:
+                inbox.task_done()
+
+    async def run(self, source):
+        """Feed every item of the async iterable `source` through the stages.
+
+        Returns once the source is exhausted and every item has gone through
+        the last stage. Exceptions not handled by on_error stop the pipeline.
+        """
+        queues = [asyncio.Queue(maxsize=self.maxsize) for _ in self.stages]
+        workers = []
+        for i, stage in enumerate(self.stages):
+            outbox = queues[i + 1] if i + 1 < len(queues) else None
+            workers += [asyncio.ensure_future(
+                self._work(stage, queues[i], outbox))
+                for _ in range(stage.workers)]
+
+        async def feed():
+            async for item in source:
+                await queues[0].put(item)
+            for queue in queues:
+                await queue.join()
+
+        feeder = asyncio.ensure_future(feed())
+        try:
+            # Stop as soon as the feeder finishes or any worker fails
+            done, _ = await asyncio.wait(
+                [feeder] + workers, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            for task in [feeder] + workers:
+                task.cancel()
@@ -0,0 +1,334 @@
+# Long-lived root helper for mounting, unmounting and formatting cards.
+#
+# The apps start it once with sudo (see get_helper()) and send it batches of
+# operations as JSON lines over its stdin/stdout, instead of launching a
+# `/bin/bash -c "sudo ..."` for every mkdir, mount, umount, mkfs and fatlabel.
+# Only the operations in OPERATIONS can be run. This file must only import
+# from the standard library, as it is run by path under sudo.
+
+import atexit
+import itertools
+import json
+import os
+import subprocess
+import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as ReplyTimeout
+
+# Seconds an operation can take before it is killed and reported as failed
+DEFAULT_TIMEOUT = 600
+# Seconds the client waits for a reply on top of the timeouts of the
+# operations it sent
+REPLY_MARGIN = 30
+
+
+# Operations ---------------------------------------------------------------
+
+def _run(cmd, timeout, input=None):
+    try:
+        proc = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            stdin=subprocess.DEVNULL if input is None else subprocess.PIPE)
+    except OSError as e:
+        return {'returncode': e.errno or -1, 'stdout': '', 'stderr': str(e)}
+    try:
+        stdout, stderr = proc.communicate(input, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        # A process stuck in uninterruptible I/O only dies once that I/O
+        # returns: reap it in the background instead of waiting here
+        threading.Thread(target=proc.communicate, daemon=True).start()
+        return {'returncode': -1, 'stdout': '',
+                'stderr': f'timed out after {timeout} s'}
+    return {'returncode': proc.returncode,
+            'stdout': stdout.decode('utf-8', 'replace'),
+            'stderr': stderr.decode('utf-8', 'replace')}
+
+
+def _native(func, *args):
+    try:
+        func(*args)
+    except OSError as e:
+        return {'returncode': e.errno or -1, 'stdout': '', 'stderr': str(e)}
+    return {'returncode': 0, 'stdout': '', 'stderr': ''}
+
+
+def _mkdir(path, timeout):
+    return _native(os.makedirs, path, 0o755, True)
+
+
+def _rmdir(path, timeout):
+    return _native(os.rmdir, path)
+
+
+def _mount(device, target, timeout):
+    return _run(['mount', device, target], timeout)
+
+
+def _umount(target, lazy=False, timeout=DEFAULT_TIMEOUT):
+    return _run(['umount'] + (['-l'] if lazy else []) + [target], timeout)
+
+
+def _mkfs_vfat(device, serial=None, timeout=DEFAULT_TIMEOUT):
+    # serial: volume ID to use (an int), so the result can be checked
+    volume_id = ['-i', f'{serial:08X}'] if serial is not None else []
+    return _run(['mkfs.vfat', '-F32', '-v'] + volume_id + [device], timeout)
+
+
+def _fatlabel(device, label, timeout):
+    return _run(['fatlabel', device, label], timeout)
+
+
+def _write_image(image, device, timeout):
+    # Writes a format image (see src/fatimage.py) over the start of the
+    # device, leaving the rest of it as it is
+    return _run(['dd', f'if={image}', f'of={device}', 'bs=4M',
+                 'conv=notrunc,fsync', 'status=none'], timeout)
+
+
+def copy_ranges(source, target, ranges, block=4 * 1024 * 1024):
+    """Copy byte ranges of a device or file to the same offsets of an
+    existing file (leaving the rest of it sparse).
+
+    Args:
+        ranges (list): [start, end] byte offsets, in increasing order.
+        block (int, optional): bytes read at a time.
+    """
+    src = os.open(source, os.O_RDONLY)
+    try:
+        dst = os.open(target, os.O_WRONLY)
+        try:
+            os.posix_fadvise(src, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            for start, end in ranges:
+                pos = start
+                while pos < end:
+                    chunk = os.pread(src, min(block, end - pos), pos)
+                    if not chunk:
+                        break
+                    os.pwrite(dst, chunk, pos)
+                    pos += len(chunk)
+        finally:
+            os.close(dst)
+    finally:
+        os.close(src)
+
+
+def _read_ranges(device, image, ranges, timeout):
+    # Raw reads of a card for imaging (see src/fatimage.py), in a process
+    # of their own that can be killed if the card stops answering
+    return _run([sys.executable, os.path.abspath(__file__), 'copy_ranges',
+                 device, image], timeout,
+                input=json.dumps(ranges).encode('ascii'))
+
+
+OPERATIONS = {
+    'mkdir': _mkdir,
+    'rmdir': _rmdir,
+    'mount': _mount,
+    'umount': _umount,
+    'mkfs_vfat': _mkfs_vfat,
+    'fatlabel': _fatlabel,
+    'write_image': _write_image,
+    'read_ranges': _read_ranges,
+}
+
+
+# Server (runs as root) ----------------------------------------------------
+
+def _run_sequence(sequence, stop_on_error):
+    results = []
+    for op in sequence:
+        name, args = op.get('op'), op.get('args', [])
+        timeout = op.get('timeout', DEFAULT_TIMEOUT)
+        if name not in OPERATIONS:
+            result = {'returncode': -1, 'stdout': '',
+                      'stderr': f'unknown operation {name}'}
+        else:
+            try:
+                result = OPERATIONS[name](*args, timeout=timeout)
+            except Exception as e:
+                # Bad arguments, or a native operation that failed in an
+                # unexpected way: still a result, so the request gets a reply
+                result = {'returncode': -1, 'stdout': '',
+                          'stderr': f'{type(e).__name__}: {e}'}
+        result['op'] = name
+        result['args'] = args
+        results.append(result)
+        if stop_on_error and result['returncode'] != 0:
+            break
+    return results
+
+
+def serve(stdin=sys.stdin, stdout=sys.stdout, max_workers=16):
+    """Answer requests from stdin until it is closed.
+
+    Each request is a JSON line {"id": int, "sequences": [[op, ...], ...],
+    "stop_on_error": bool}, where op is {"op": name, "args": [...],
+    "timeout": seconds}. The operations within a sequence run in order;
+    different sequences (and requests) run concurrently. The reply is
+    {"id": int, "results": [[result, ...], ...]} with one result per
+    operation run: {"op", "args", "returncode", "stdout", "stderr"}.
+    """
+    write_lock = threading.Lock()
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+
+    def reply(message):
+        with write_lock:
+            stdout.write(json.dumps(message) + '\n')
+            stdout.flush()
+
+    def handle(request):
+        # Every request gets a reply, whatever goes wrong, or its client
+        # would wait for it forever
+        try:
+            sequences = request.get('sequences', [])
+            stop = request.get('stop_on_error', True)
+            futures = [pool.submit(_run_sequence, seq, stop)
+                       for seq in sequences]
+            results = [future.result() for future in futures]
+        except Exception as e:
+            results = [[{'op': None, 'args': [], 'returncode': -1,
+                         'stdout': '', 'stderr': f'{type(e).__name__}: {e}'}]
+                       for _ in request.get('sequences', [None])]
+        reply({'id': request.get('id'), 'results': results})
+
+    # One thread per request, so a slow request doesn't hold up the others
+    threads = []
+    for line in stdin:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError:
+            continue
+        if not isinstance(request, dict):
+            continue
+        thread = threading.Thread(target=handle, args=(request,), daemon=True)
+        thread.start()
+        threads = [t for t in threads if t.is_alive()] + [thread]
+    # Requests sent before stdin was closed still get their reply
+    for thread in threads:
+        thread.join()
+    pool.shutdown(wait=True)
+
+
+# Client -------------------------------------------------------------------
+
+class HelperError(RuntimeError):
+    pass
+
+
+class PrivilegedHelper:
+    """Client for a root helper process started once with sudo.
+
+    Thread-safe: several threads can have requests in flight at once.
+    """
+
+    def __init__(self, command=None):
+        self.command = command or ['sudo', sys.executable,
+                                   os.path.abspath(__file__)]
+        self._proc = None
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._waiting = {}
+
+    def start(self):
+        with self._lock:
+            if self._proc is not None and self._proc.poll() is None:
+                return
+            self._proc = subprocess.Popen(
+                self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                universal_newlines=True, bufsize=1)
+            threading.Thread(target=self._read_replies, daemon=True).start()
+
+    def _read_replies(self):
+        proc = self._proc
+        for line in proc.stdout:
+            message = json.loads(line)
+            future = self._waiting.pop(message['id'], None)
+            if future is not None:
+                future.set_result(message['results'])
+        # The helper is gone: fail anything still waiting
+        for key in list(self._waiting):
+            self._waiting.pop(key).set_exception(
+                HelperError('The privileged helper exited'))
+
+    def submit(self, *sequences, stop_on_error=True):
+        """Send sequences of operations; returns a Future with the results.
+
+        Args:
+            *sequences: lists of operations, each a tuple
+                (name, *args) or a dict {"op", "args", "timeout"}.
+            stop_on_error (bool): stop a sequence at its first failure.
+        """
+        self.start()
+        request_id = next(self._ids)
+        future = Future()
+        self._waiting[request_id] = future
+        request = {'id': request_id, 'stop_on_error': stop_on_error,
+                   'sequences': [[_as_op(op) for op in seq]
+                                 for seq in sequences]}
+        with self._lock:
+            try:
+                self._proc.stdin.write(json.dumps(request) + '\n')
+                self._proc.stdin.flush()
+            except (BrokenPipeError, ValueError):
+                self._waiting.pop(request_id, None)
+                raise HelperError('The privileged helper is not running')
+        return future
+
+    def run(self, *sequences, stop_on_error=True):
+        """Like submit(), but waits and returns the results.
+
+        Raises HelperError if there is no reply within the timeouts of the
+        longest sequence plus REPLY_MARGIN seconds.
+        """
+        timeout = max((sum(_as_op(op).get('timeout', DEFAULT_TIMEOUT)
+                           for op in seq) for seq in sequences),
+                      default=0) + REPLY_MARGIN
+        future = self.submit(*sequences, stop_on_error=stop_on_error)
+        try:
+            return future.result(timeout=timeout)
+        except ReplyTimeout:
+            raise HelperError(
+                f'No reply from the privileged helper after {timeout} s')
+
+    def run_one(self, name, *args, timeout=DEFAULT_TIMEOUT):
+        """Run a single operation and return its result dict.
+        """
+        op = {'op': name, 'args': list(args), 'timeout': timeout}
+        return self.run([op])[0][0]
+
+    def close(self):
+        with self._lock:
+            if self._proc is not None and self._proc.poll() is None:
+                self._proc.stdin.close()
+                self._proc.wait()
+
+
+def _as_op(op):
+    if isinstance(op, dict):
+        return op
+    return {'op': op[0], 'args': list(op[1:])}
+
+
+_helper = None
+
+
+def get_helper():
+    """The helper shared by the whole app, started on first use.
+    """
+    global _helper
+    if _helper is None:
+        _helper = PrivilegedHelper()
+        atexit.register(_helper.close)
+    return _helper
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['copy_ranges']:
+        # Run by _read_ranges(), with the ranges as JSON on stdin
+        copy_ranges(sys.argv[2], sys.argv[3], json.load(sys.stdin))
+    else:
+        serve()
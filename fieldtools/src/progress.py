@@ -0,0 +1,127 @@
+# One progress line for all the transfers in progress
+
+import os
+import sys
+import threading
+import time
+
+from fieldtools.src.aesthetics import tcolor, tstyle
+
+
+def human_bytes(n):
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if abs(n) < 1000:
+            return f'{n:.0f} {unit}' if unit == 'B' else f'{n:.1f} {unit}'
+        n /= 1000
+    return f'{n:.1f} TB'
+
+
+def human_time(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f'{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
+    return f'{seconds // 60}:{seconds % 60:02d}'
+
+
+class _Transfer:
+    def __init__(self, total_bytes, total_files):
+        self.total_bytes = total_bytes
+        self.total_files = total_files
+        self.bytes = 0
+        self.files = 0
+        self.start = time.monotonic()
+
+
+class TransferProgress:
+    """Progress of several concurrent transfers (e.g. one per card).
+
+    Copy workers only add to byte counters, which costs next to nothing per
+    chunk; a background thread samples the counters `rate` times per second
+    and draws a single line with the progress, throughput and number of
+    files of each transfer, plus the total throughput and ETA.
+    """
+
+    def __init__(self, rate=10, stream=sys.stdout):
+        self.interval = 1 / rate
+        self.stream = stream
+        self._transfers = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._drawn = False
+
+    def add(self, name, total_bytes, total_files):
+        with self._lock:
+            self._transfers[name] = _Transfer(total_bytes, total_files)
+
+    def remove(self, name):
+        with self._lock:
+            self._transfers.pop(name, None)
+            if not self._transfers:
+                self._clear()
+
+    def advance(self, name, nbytes):
+        self._transfers[name].bytes += nbytes
+
+    def file_done(self, name):
+        self._transfers[name].files += 1
+
+    def file_callback(self, name):
+        """A callback(copied, total) for funs.copyfile that feeds `name`.
+
+        Make a new one for each file.
+        """
+        last = 0
+
+        def callback(copied, total):
+            nonlocal last
+            self.advance(name, copied - last)
+            last = copied
+        return callback
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                if self._transfers:
+                    self._draw()
+
+    def _clear(self):
+        if self._drawn:
+            self.stream.write('\r\x1b[K')
+            self.stream.flush()
+            self._drawn = False
+
+    def _draw(self):
+        now = time.monotonic()
+        parts = []
+        remaining = speed = 0
+        for name, t in self._transfers.items():
+            rate = t.bytes / max(now - t.start, 1e-6)
+            perc = 100 * t.bytes / t.total_bytes if t.total_bytes else 100
+            parts.append(f'{name} {perc:3.0f}% {human_bytes(rate)}/s '
+                         f'{t.files}/{t.total_files}')
+            remaining += max(t.total_bytes - t.bytes, 0)
+            speed += rate
+        eta = human_time(remaining / speed) if speed > 0 else '--:--'
+        line = (' | '.join(parts) +
+                f' | total {human_bytes(speed)}/s ETA {eta}')
+        try:
+            width = os.get_terminal_size().columns
+        except OSError:
+            width = 120
+        if len(line) >= width:
+            line = line[:width - 2] + '…'
+        self.stream.write('\r\x1b[K' + tcolor(line, tstyle.lightgrey))
+        self.stream.flush()
+        self._drawn = True
@@ -0,0 +1,184 @@
+# On-disk cache of Google sheets, so that progress reports don't download
+# sheets that have not changed, and still work without a connection
+
+import datetime
+import json
+import numbers
+import os
+import pickle
+import time
+import uuid
+
+import pandas as pd
+from fieldtools.src.aesthetics import info
+from fieldtools.src.paths import SHEET_CACHE_DIR, safe_makedir
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+class SheetUnavailable(RuntimeError):
+    pass
+
+
+class GoogleSheetSource:
+    """Reads the first worksheet of Google sheets, and their last modified
+    time (a single, cheap Drive API request).
+
+    Args:
+        client (callable): returns a pygsheets client for the calling
+            thread (see funs.gsheets_client()).
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def revision(self, key):
+        return self.client().drive.service.files().get(
+            fileId=key, fields='modifiedTime',
+            supportsAllDrives=True).execute()['modifiedTime']
+
+    def fetch(self, key, has_header=True):
+        return self.client().open_by_key(key)[0].get_as_df(
+            has_header=has_header, include_tailing_empty=False)
+
+
+class LocalSheetSource:
+    """Stand-in for Google sheets: each sheet is a CSV file named after its
+    key in `directory`, and its revision is the file's modification time.
+    Cells are read as strings, as they come from Google sheets.
+    """
+
+    def __init__(self, directory):
+        self.directory = str(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.csv')
+
+    def revision(self, key):
+        try:
+            return str(os.stat(self._path(key)).st_mtime_ns)
+        except FileNotFoundError:
+            raise SheetUnavailable(f'No sheet {key} in {self.directory}')
+
+    def fetch(self, key, has_header=True):
+        return pd.read_csv(self._path(key), header=0 if has_header else None,
+                           dtype=str, keep_default_na=False)
+
+
+class SheetCache:
+    """Last downloaded copy of each sheet, with the revision it was
+    downloaded at.
+
+    A sheet younger than `ttl` seconds is served from the cache. Older ones
+    are only downloaded again if their revision has changed; if the source
+    can't be reached, the last copy is used. With `offline`, the source is
+    never contacted. Sheets are stored as Parquet files if pyarrow is
+    installed (and the columns allow it), and pickled otherwise.
+
+    Args:
+        source: GoogleSheetSource, LocalSheetSource or anything with
+            revision(key) and fetch(key, has_header) methods.
+        root (str or PosixPath, optional): cache directory.
+        ttl (float, optional): seconds a copy is used without checking.
+        offline (bool, optional): only use cached copies.
+    """
+
+    def __init__(self, source, root=SHEET_CACHE_DIR, ttl=600, offline=False):
+        self.source = source
+        self.root = str(root)
+        self.ttl = ttl
+        self.offline = offline
+
+    def _entry(self, key, has_header):
+        return os.path.join(self.root, f'{key}-{"h" if has_header else "n"}')
+
+    def _load_meta(self, entry):
+        try:
+            with open(entry + '.json', 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _save_meta(self, entry, meta):
+        tmp = f'{entry}.{uuid.uuid4().hex[:8]}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, entry + '.json')
+
+    def _load(self, entry, meta):
+        path = entry + '.' + meta['format']
+        if meta['format'] == 'parquet':
+            data = pd.read_parquet(path)
+            data.columns = meta['columns']
+            return data
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def _store(self, entry, data, revision):
+        safe_makedir(self.root)
+        tmp = f'{entry}.{uuid.uuid4().hex[:8]}.tmp'
+        fmt = 'pickle'
+        if pa is not None and data.columns.is_unique:
+            try:
+                data.set_axis([str(col) for col in data.columns],
+                              axis=1).to_parquet(tmp, index=False)
+                fmt = 'parquet'
+            except (pa.ArrowException, ValueError, TypeError):
+                pass
+        if fmt == 'pickle':
+            with open(tmp, 'wb') as f:
+                pickle.dump(data, f)
+        os.replace(tmp, f'{entry}.{fmt}')
+        other = f'{entry}.{"pickle" if fmt == "parquet" else "parquet"}'
+        if os.path.exists(other):
+            os.remove(other)
+        now = time.time()
+        self._save_meta(entry, {
+            'revision': revision, 'format': fmt, 'fetched_at': now,
+            'checked_at': now, 'columns': [
+                int(col) if isinstance(col, numbers.Integral) else str(col)
+                for col in data.columns]})
+
+    def get(self, key, has_header=True):
+        """A sheet as a DataFrame, from the cache or the source.
+
+        Raises:
+            SheetUnavailable: offline, or the source can't be reached, and
+                the sheet has never been downloaded.
+        """
+        entry = self._entry(key, has_header)
+        meta = self._load_meta(entry)
+        if meta is not None and (
+                self.offline or time.time() - meta['checked_at'] < self.ttl):
+            return self._load(entry, meta)
+        if self.offline:
+            raise SheetUnavailable(f'Sheet {key} has not been downloaded '
+                                   'yet; it is not available offline')
+        try:
+            revision = self.source.revision(key)
+            if meta is not None and revision is not None and \
+                    revision == meta['revision']:
+                meta['checked_at'] = time.time()
+                self._save_meta(entry, meta)
+                return self._load(entry, meta)
+            data = self.source.fetch(key, has_header)
+        except Exception as e:
+            # No connection, expired credentials...: use the last copy
+            if meta is None:
+                raise SheetUnavailable(f'Could not download sheet {key}: {e}')
+            fetched = datetime.datetime.fromtimestamp(meta['fetched_at'])
+            print(info + f'Could not download sheet {key} ({e}); using the '
+                  f'copy from {fetched:%Y-%m-%d %H:%M}')
+            return self._load(entry, meta)
+        self._store(entry, data, revision)
+        return data
+
+    def snapshot_time(self, key, has_header=True):
+        """When the cached copy of a sheet was downloaded, or None."""
+        meta = self._load_meta(self._entry(key, has_header))
+        if meta is None:
+            return None
+        return datetime.datetime.fromtimestamp(meta['fetched_at'])
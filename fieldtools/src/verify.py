@@ -0,0 +1,156 @@
+# Checking copies against their source card or the digests in the copy
+# ledger: used by copy-cards before a card is released, and on its own:
+# python -m fieldtools.src.verify
+
+import argparse
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from fieldtools.src.aesthetics import info, tcolor, tstyle
+from fieldtools.src.funs import file_digest
+from fieldtools.src.ledger import CopyLedger
+from fieldtools.src.paths import LEDGER_PATH
+from tabulate import tabulate
+
+# Result of checking one copy; reason is None if it passed
+Check = namedtuple('Check', ['source', 'destination', 'ok', 'reason'])
+
+
+def check_copy(source, destination, digest=None, size=None):
+    """Compare a copy with its source.
+
+    The sizes are compared first. Then the copy is re-read from disk
+    (see funs.file_digest(drop_cache=True)) and its hash compared with
+    `digest`; without a digest the source is hashed too.
+
+    Args:
+        source (str): path to the file in the card (may be None if
+            digest and size are given).
+        destination (str): path to the copy.
+        digest (str, optional): digest taken when the file was copied.
+        size (int, optional): size of the source, if it is not available.
+
+    Returns:
+        Check
+    """
+    try:
+        if size is None:
+            size = os.stat(source).st_size
+        if os.stat(destination).st_size != size:
+            return Check(source, destination, False, 'size differs')
+        if digest is None:
+            digest = file_digest(source, drop_cache=True)
+        algorithm = digest.split(':')[0]
+        if file_digest(destination, algorithm, drop_cache=True) != digest:
+            return Check(source, destination, False, 'hash differs')
+    except FileNotFoundError as e:
+        which = 'copy' if e.filename == destination else 'source'
+        return Check(source, destination, False, f'{which} is missing')
+    except (OSError, ValueError) as e:
+        return Check(source, destination, False, str(e))
+    return Check(source, destination, True, None)
+
+
+class Verifier:
+    """A pool of threads that re-read copies and check them.
+
+    Several cards can be checked at once (and while others are still being
+    copied); each call to verify() waits only for its own files.
+
+    Args:
+        workers (int, optional): files checked at the same time.
+    """
+
+    def __init__(self, workers=4):
+        self._pool = ThreadPoolExecutor(max_workers=workers,
+                                        thread_name_prefix='verify')
+
+    def verify(self, copies):
+        """Check a list of copies, each a tuple of check_copy() arguments:
+        (source, destination, digest or None[, size]).
+
+        Returns:
+            list: Check for each copy, in the same order.
+        """
+        futures = [self._pool.submit(check_copy, *copy) for copy in copies]
+        return [future.result() for future in futures]
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+
+
+def report(label, checks):
+    """Print whether a card passed and which of its copies failed.
+
+    Returns:
+        bool: whether all copies passed.
+    """
+    failed = [check for check in checks if not check.ok]
+    if not failed:
+        print(info + tcolor(f'{label}: all {len(checks)} copies verified',
+                            tstyle.teal))
+        return True
+    print(info + tcolor(f'{label}: {len(failed)} of {len(checks)} copies '
+                        'FAILED verification', tstyle.rojoroto))
+    print(tabulate([(os.path.basename(c.destination), c.reason)
+                    for c in failed], headers=['File', 'Problem'],
+                   tablefmt='simple'))
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check copies against their card, or against the '
+                    'digests recorded in the copy ledger')
+    parser.add_argument('cards', nargs='*',
+                        help='mount point(s) of cards to check; if none, '
+                        'check the ledger records instead')
+    parser.add_argument('--card', default=None,
+                        help='only ledger records of this card (e.g. AM01)')
+    parser.add_argument('--season', type=int, default=None,
+                        help='only ledger records of this year')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--ledger', default=str(LEDGER_PATH))
+    args = parser.parse_args()
+
+    ledger = CopyLedger(args.ledger)
+    verifier = Verifier(args.workers)
+    jobs = {}
+    if args.cards:
+        for mountpoint in args.cards:
+            label = os.path.basename(os.path.normpath(mountpoint))
+            for entry in sorted(os.scandir(mountpoint), key=lambda e: e.name):
+                if not entry.is_file():
+                    continue
+                row = ledger.lookup(entry.path)
+                if row is None:
+                    print(info + f'{label}/{entry.name} has not been copied')
+                    continue
+                jobs.setdefault(label, []).append(
+                    (entry.path, row['destination'], row['digest']))
+    else:
+        rows = ledger.copies(card=args.card, season=args.season)
+        unchecked = 0
+        for row in rows:
+            if row['digest'] is None:
+                # Copied without checksums
+                unchecked += 1
+                continue
+            jobs.setdefault(row['card'], []).append(
+                (None, row['destination'], row['digest'], row['size']))
+        if unchecked:
+            print(info + f'{unchecked} copies have no digest and were not '
+                  'checked (pass the card mount point to compare them with '
+                  'the card)')
+
+    all_ok = True
+    for label, copies in sorted(jobs.items()):
+        all_ok &= report(label, verifier.verify(copies))
+    verifier.close()
+    ledger.close()
+    raise SystemExit(0 if all_ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+# WAV header and AudioMoth comment parsing, from the first bytes of a file
+# (funs.copyfile hands them over while copying, so this costs no extra read)
+
+import re
+import struct
+
+# Bytes at the start of a recording that are handed to parse_wav_header().
+# AudioMoth headers are under 500 bytes; this leaves room for other chunks.
+HEADER_BYTES = 64 * 1024
+
+_RECORDED = re.compile(
+    r'Recorded at (\d{2}:\d{2}:\d{2}) (\d{2})/(\d{2})/(\d{4}) \((UTC[^)]*)\)')
+_DEVICE = re.compile(r'by AudioMoth ([0-9A-Fa-f]{16})')
+_GAIN = re.compile(r'at ([a-z-]+) gain|gain setting (\d)')
+_BATTERY = re.compile(r'battery (?:state )?was (less than |greater than )?'
+                      r'(\d+(?:\.\d+)?)V')
+_TEMPERATURE = re.compile(r'temperature was (-?\d+(?:\.\d+)?)C')
+
+
+def parse_audiomoth_comment(comment):
+    """Fields of the comment AudioMoth firmware writes in each recording,
+    e.g. 'Recorded at 05:00:00 17/04/2021 (UTC) by AudioMoth
+    24F319055FDF2F5B at medium gain setting while battery state was 4.2V.'
+
+    Returns:
+        dict: recorded_at (ISO string), timezone, device_id, gain,
+        battery_v and temperature_c; missing fields are None.
+    """
+    fields = dict.fromkeys(['recorded_at', 'timezone', 'device_id', 'gain',
+                            'battery_v', 'temperature_c'])
+    if not comment:
+        return fields
+    m = _RECORDED.search(comment)
+    if m:
+        time, day, month, year, tz = m.groups()
+        fields['recorded_at'] = f'{year}-{month}-{day}T{time}'
+        fields['timezone'] = tz
+    m = _DEVICE.search(comment)
+    if m:
+        fields['device_id'] = m.group(1).upper()
+    m = _GAIN.search(comment)
+    if m:
+        fields['gain'] = m.group(1) or m.group(2)
+    m = _BATTERY.search(comment)
+    if m:
+        # 'less than 3.6V' / 'greater than 4.9V' are kept as the bound
+        fields['battery_v'] = float(m.group(2))
+    m = _TEMPERATURE.search(comment)
+    if m:
+        fields['temperature_c'] = float(m.group(1))
+    return fields
+
+
+def parse_wav_header(head, file_size):
+    """Read the RIFF header of a recording and check it against its size.
+
+    Args:
+        head (bytes): the first bytes of the file (up to HEADER_BYTES).
+        file_size (int): size of the whole file.
+
+    Returns:
+        dict: sample_rate, channels, bits_per_sample, data_size,
+        duration_s, comment and the fields of parse_audiomoth_comment(),
+        plus 'problems', a list of what is wrong with the file (empty if
+        the header is sound). Fields that could not be read are None.
+    """
+    meta = dict.fromkeys(['sample_rate', 'channels', 'bits_per_sample',
+                          'data_size', 'duration_s', 'comment'])
+    problems = []
+    meta['problems'] = problems
+    meta.update(parse_audiomoth_comment(None))
+
+    if file_size == 0:
+        problems.append('empty file')
+        return meta
+    if len(head) < 12:
+        problems.append('truncated header')
+        return meta
+    riff, riff_size, wave = struct.unpack_from('<4sI4s', head)
+    if riff != b'RIFF' or wave != b'WAVE':
+        problems.append('not a RIFF/WAVE file')
+        return meta
+    if riff_size + 8 != file_size:
+        problems.append(f'RIFF size {riff_size + 8} != file size {file_size}')
+
+    pos = 12
+    byte_rate = None
+    data_offset = None
+    while pos + 8 <= len(head):
+        chunk, size = struct.unpack_from('<4sI', head, pos)
+        body = head[pos + 8:pos + 8 + size]
+        if chunk == b'fmt ' and len(body) >= 16:
+            (_, meta['channels'], meta['sample_rate'], byte_rate, _,
+             meta['bits_per_sample']) = struct.unpack_from('<HHIIHH', body)
+        elif chunk == b'LIST' and body[:4] == b'INFO':
+            meta['comment'] = _info_comment(body[4:])
+        elif chunk == b'data':
+            meta['data_size'] = size
+            data_offset = pos + 8
+            break
+        pos += 8 + size + (size & 1)
+
+    if data_offset is None:
+        problems.append('truncated header' if len(head) >= file_size
+                        else f'no data chunk in the first {len(head)} bytes')
+    else:
+        if meta['sample_rate'] is None:
+            problems.append('no fmt chunk')
+        if meta['data_size'] == 0:
+            problems.append('no audio data')
+        if data_offset + meta['data_size'] != file_size:
+            problems.append(f'data size {meta["data_size"]} != '
+                            f'{file_size - data_offset} bytes in the file')
+        if byte_rate:
+            meta['duration_s'] = round(meta['data_size'] / byte_rate, 3)
+    meta.update(parse_audiomoth_comment(meta['comment']))
+    return meta
+
+
+def _info_comment(info):
+    pos = 0
+    while pos + 8 <= len(info):
+        sub, size = struct.unpack_from('<4sI', info, pos)
+        if sub == b'ICMT':
+            text = info[pos + 8:pos + 8 + size]
+            return text.split(b'\x00')[0].decode('ascii', 'replace')
+        pos += 8 + size + (size & 1)
+    return None
@@ -0,0 +1,130 @@
+import os
+
+import pytest
+from fieldtools.src import funs
+from fieldtools.src.funs import (PARTIAL_SUFFIX, copyfile, file_digest,
+                                 format_digest, link_file, new_hasher,
+                                 sweep_partial_copies)
+from fieldtools.src.ledger import CopyLedger
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    ledger = CopyLedger(tmp_path / 'ledger.sqlite')
+    yield ledger
+    ledger.close()
+
+
+@pytest.fixture
+def src(tmp_path):
+    path = tmp_path / 'card' / 'AM01' / '20210401_060000.WAV'
+    path.parent.mkdir(parents=True)
+    path.write_bytes(os.urandom(3 * 1024 * 1024 + 123))
+    return str(path)
+
+
+def interrupted_copy(src, dst, ledger, offset, corrupt=None):
+    # What an interrupted copy leaves behind: a partial file and a
+    # journal row with its last checkpoint
+    with open(src, 'rb') as f:
+        data = bytearray(f.read(offset))
+    hasher = new_hasher()
+    hasher.update(data)
+    if corrupt is not None:
+        data[corrupt] ^= 0xFF
+    with open(dst + PARTIAL_SUFFIX, 'wb') as f:
+        f.write(data)
+    ledger.begin_transfer(src, dst, os.stat(src))
+    ledger.checkpoint_transfer(dst, offset, format_digest(hasher))
+
+
+def copy(src, dst, ledger):
+    hasher = new_hasher()
+    calls = []
+    copyfile(src, dst, callback=lambda copied, total: calls.append(copied),
+             hasher=hasher, journal=ledger)
+    return format_digest(hasher), calls
+
+
+def test_resume(tmp_path, src, ledger):
+    dst = str(tmp_path / 'copy.WAV')
+    interrupted_copy(src, dst, ledger, 2 * 1024 * 1024)
+    digest, calls = copy(src, dst, ledger)
+    assert calls[0] > 2 * 1024 * 1024  # Not copied again from the start
+    assert open(dst, 'rb').read() == open(src, 'rb').read()
+    assert digest == file_digest(src)
+    assert not os.path.exists(dst + PARTIAL_SUFFIX)
+    assert ledger.pending_transfers() == []
+
+
+def test_resume_does_not_read_the_card_again(tmp_path, src, ledger):
+    dst = str(tmp_path / 'copy.WAV')
+    interrupted_copy(src, dst, ledger, 2 * 1024 * 1024)
+    expected = open(src, 'rb').read()
+    # Change the copied part of the source, keeping its size and mtime
+    st = os.stat(src)
+    with open(src, 'r+b') as f:
+        f.write(b'\0' * 1024)
+    os.utime(src, ns=(st.st_atime_ns, st.st_mtime_ns))
+    digest, _ = copy(src, dst, ledger)
+    assert open(dst, 'rb').read() == expected
+    assert digest == file_digest(dst)
+
+
+def test_resume_damaged_partial_copy(tmp_path, src, ledger):
+    dst = str(tmp_path / 'copy.WAV')
+    interrupted_copy(src, dst, ledger, 2 * 1024 * 1024, corrupt=10)
+    with pytest.raises(OSError):
+        copy(src, dst, ledger)
+    assert not os.path.exists(dst + PARTIAL_SUFFIX)
+    assert ledger.pending_transfers() == []
+    # The next copy starts over
+    digest, _ = copy(src, dst, ledger)
+    assert open(dst, 'rb').read() == open(src, 'rb').read()
+    assert digest == file_digest(src) == file_digest(dst)
+
+
+def test_resume_damaged_partial_copy_without_hasher(tmp_path, src, ledger):
+    dst = str(tmp_path / 'copy.WAV')
+    interrupted_copy(src, dst, ledger, 2 * 1024 * 1024, corrupt=10)
+    copyfile(src, dst, callback=None, journal=ledger)
+    assert open(dst, 'rb').read() == open(src, 'rb').read()
+
+
+def test_kernel_copy_with_checksum(tmp_path, src, monkeypatch):
+    windows = []
+
+    def kernel_copy(infd, outfd, n):
+        windows.append(n)
+        return os.copy_file_range(infd, outfd, n)
+    monkeypatch.setattr(funs, '_kernel_copy_funcs', lambda: [kernel_copy])
+    dst = str(tmp_path / 'copy.WAV')
+    hasher = new_hasher()
+    copyfile(src, dst, callback=None, hasher=hasher)
+    assert windows  # The data went through the kernel
+    assert open(dst, 'rb').read() == open(src, 'rb').read()
+    assert format_digest(hasher) == file_digest(src)
+
+
+def test_link_file(tmp_path, src):
+    dst = str(tmp_path / 'copy.WAV')
+    hasher = new_hasher()
+    header = []
+    link_file(src, dst, hasher=hasher, on_header=header.append)
+    assert os.path.samefile(src, dst)
+    assert format_digest(hasher) == file_digest(src)
+    assert header[0] == open(src, 'rb').read(len(header[0]))
+    assert not os.path.exists(dst + PARTIAL_SUFFIX)
+
+
+def test_sweep_every_root(tmp_path, src, ledger):
+    raw, faceplates = tmp_path / 'raw', tmp_path / 'faceplates'
+    raw.mkdir()
+    faceplates.mkdir()
+    resumable = str(raw / 'copy.WAV')
+    interrupted_copy(src, resumable, ledger, 1024 * 1024)
+    orphan = faceplates / ('RT.TXT' + PARTIAL_SUFFIX)
+    orphan.write_bytes(b'reads')
+    removed, dropped = sweep_partial_copies([raw, faceplates], ledger)
+    assert removed == [str(orphan)] and dropped == 0
+    assert os.path.exists(resumable + PARTIAL_SUFFIX)
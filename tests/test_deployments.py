@@ -0,0 +1,56 @@
+import os
+
+import pandas as pd
+from fieldtools.src.funs import DeploymentIndex, plan_nestboxes
+
+CSV = ('Nestbox,AM,Deployed,Move_by\n'
+       'W12,01,2021-04-10,2021-04-13\n'
+       'Nestbox,AM,Deployed,Move_by\n'
+       'C3,xx,2021-04-10,2021-04-13\n'
+       'SW84,02,2021-04-10,2021-4-31\n'
+       'B15,03,2021-04-12,2021-04-14\n')
+
+
+def index(tmp_path, text):
+    path = tmp_path / 'already-recorded-append.csv'
+    path.write_text(text)
+    return DeploymentIndex(path)
+
+
+def test_bad_rows_are_still_due(tmp_path, capsys):
+    deployments = index(tmp_path, CSV)
+    assert 'SW84' in capsys.readouterr().out
+    assert list(deployments.due_on('2021-04-13')['Nestbox']) == ['W12', 'C3']
+    assert list(deployments.due_on(pd.Timestamp('2021-04-14'))['Nestbox']) \
+        == ['B15']
+    # Dates as typed in the .csv
+    assert list(deployments.due_on('2021-04-14')['Move_by']) == \
+        ['2021-04-14']
+
+
+def test_lookup(tmp_path):
+    deployments = index(tmp_path, CSV)
+    assert deployments.nestbox_at(1, '2021-04-12 06:00') == 'W12'
+    assert deployments.nestbox_at('01', '2021-04-10 06:00') is None
+    assert deployments.nestbox_at(2, '2021-04-12 06:00') is None
+    plan, unmatched, ambiguous = plan_nestboxes(
+        deployments, 3, ['20210413_060000.WAV', 'notadate.WAV'])
+    assert plan == {'20210413_060000.WAV': 'B15'}
+    assert unmatched == ['notadate.WAV'] and ambiguous == []
+
+
+def test_header_only(tmp_path):
+    deployments = index(tmp_path, CSV.split('\n')[0] + '\n')
+    assert deployments.empty
+    assert len(deployments.due_on('2021-04-13')) == 0
+    assert deployments.nestbox_at(1, '2021-04-12') is None
+
+
+def test_refresh(tmp_path):
+    deployments = index(tmp_path, CSV)
+    assert not deployments.refresh()
+    with open(deployments.csv_path, 'a') as f:
+        f.write('E7,04,2021-04-13,2021-04-16\n')
+    os.utime(deployments.csv_path, ns=(0, 0))
+    assert deployments.refresh()
+    assert deployments.nestbox_at(4, '2021-04-15') == 'E7'
@@ -0,0 +1,41 @@
+import pandas as pd
+import pytest
+from fieldtools.src.faceplates import (FaceplateStore, last_read_date, pa,
+                                        read_rt_file)
+
+RT = ('Date\tTime\tTagID\n'
+      '01/04/2021\t06:00:00\t0700EE1B11\n'
+      '02/04/2021\t07:30:00\t0700EE1B12\n'
+      'Date\tTime\tTagID\n'
+      '13/04/2021\t08:15:00\t0700EE1B11\n')
+
+
+@pytest.fixture
+def reads(tmp_path):
+    path = tmp_path / 'RT.TXT'
+    path.write_text(RT)
+    return read_rt_file(path)
+
+
+def test_dates_are_day_first(reads):
+    assert reads['Datetime'].tolist() == [
+        pd.Timestamp('2021-04-01 06:00:00'),
+        pd.Timestamp('2021-04-02 07:30:00'),
+        pd.Timestamp('2021-04-13 08:15:00')]
+    assert str(last_read_date(reads)) == '2021-04-13'
+
+
+@pytest.mark.skipif(pa is None, reason='needs pyarrow')
+def test_store_keeps_dates(tmp_path, reads):
+    store = FaceplateStore(tmp_path / 'store')
+    assert store.append('F1234', reads) == 3
+    assert store.append('F1234', reads) == 0
+    partitions = sorted(p.name for p in (tmp_path / 'store').iterdir())
+    assert partitions == ['date=2021-04-01', 'date=2021-04-02',
+                          'date=2021-04-13']
+
+    back = store.read(columns=['Datetime', 'TagID'])
+    assert sorted(back['Datetime'].tolist()) == reads['Datetime'].tolist()
+    later = store.read(columns=['Datetime'], start='2021-04-02')
+    assert sorted(later['Datetime'].dt.strftime('%d/%m/%Y')) == \
+        ['02/04/2021', '13/04/2021']
@@ -0,0 +1,219 @@
+import calendar
+import os
+import struct
+import time
+
+import pytest
+from fieldtools.src.fatimage import (FatReader, extract_image, image_card,
+                                     metadata_length, mount_utc_offset,
+                                     parse_boot_sector, patch_volume,
+                                     read_volume_info)
+
+SECTOR = 512
+RESERVED = 32
+FAT_SECTORS = 8
+CLUSTERS = 200
+DATA_START = (RESERVED + 2 * FAT_SECTORS) * SECTOR
+END = 0x0FFFFFFF
+
+# 2021-04-13 08:15:30 (UTC), as FAT date and time fields
+MTIME = calendar.timegm((2021, 4, 13, 8, 15, 30, 0, 0, 0))
+FAT_DATE = ((2021 - 1980) << 9) | (4 << 5) | 13
+FAT_TIME = (8 << 11) | (15 << 5) | (30 // 2)
+
+LONG_NAME = 'Long recording name.WAV'
+
+
+def cluster_offset(n):
+    return DATA_START + (n - 2) * SECTOR
+
+
+def boot_sector():
+    boot = bytearray(SECTOR)
+    boot[0:3] = b'\xeb\x58\x90'
+    boot[3:11] = b'mkfs.fat'
+    struct.pack_into('<HBHBHHBH', boot, 0x0B, SECTOR, 1, RESERVED, 2, 0, 0,
+                     0xF8, 0)
+    struct.pack_into('<III', boot, 0x1C, 0,
+                     RESERVED + 2 * FAT_SECTORS + CLUSTERS, FAT_SECTORS)
+    struct.pack_into('<HHIHH', boot, 0x28, 0, 0, 2, 1, 6)
+    boot[0x40], boot[0x42] = 0x80, 0x29
+    struct.pack_into('<I', boot, 0x43, 0xDEADBEEF)
+    boot[0x47:0x52] = b'NO NAME    '
+    boot[0x52:0x5A] = b'FAT32   '
+    boot[510:512] = b'\x55\xaa'
+    return boot
+
+
+def short_entry(name, attr=0x20, cluster=0, size=0):
+    entry = bytearray(32)
+    entry[0:11] = name
+    entry[11] = attr
+    struct.pack_into('<HHHHI', entry, 20, cluster >> 16, FAT_TIME, FAT_DATE,
+                     cluster & 0xFFFF, size)
+    return entry
+
+
+def lfn_entries(name, short):
+    # Long name entries, as they are stored: last part first
+    checksum = 0
+    for byte in short:
+        checksum = (((checksum & 1) << 7) + (checksum >> 1) + byte) & 0xFF
+    chars = name.encode('utf-16-le') + b'\x00\x00'
+    parts = [chars[i:i + 26] for i in range(0, len(chars), 26)]
+    parts[-1] = parts[-1].ljust(26, b'\xff')
+    entries = []
+    for seq, part in enumerate(parts, 1):
+        entry = bytearray(32)
+        entry[0] = seq | (0x40 if seq == len(parts) else 0)
+        entry[1:11], entry[14:26], entry[28:32] = \
+            part[0:10], part[10:22], part[22:26]
+        entry[11], entry[13] = 0x0F, checksum
+        entries.append(entry)
+    return entries[::-1]
+
+
+def content(n):
+    return bytes((i * 7 + n) % 251 for i in range(n))
+
+
+@pytest.fixture(autouse=True)
+def utc(monkeypatch):
+    # FAT times are read in the local time zone
+    monkeypatch.setenv('TZ', 'UTC')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+@pytest.fixture
+def card(tmp_path):
+    """A small FAT32 volume:
+
+    /OLDLABEL (volume label)
+    /Long recording name.WAV  clusters 4-5
+    /BROKEN.BIN               cluster 12, chain cut short
+    /AM01/FRAG.BIN            clusters 6, 7, 10, 11
+    """
+    image = bytearray(DATA_START + CLUSTERS * SECTOR)
+    boot = boot_sector()
+    image[0:SECTOR] = boot
+    image[6 * SECTOR:7 * SECTOR] = boot
+
+    fat = {0: 0x0FFFFFF8, 1: END, 2: END, 3: END, 4: 5, 5: END,
+           6: 7, 7: 10, 10: 11, 11: END,
+           12: END}  # BROKEN.BIN claims 2000 bytes
+    for copy in range(2):
+        base = (RESERVED + copy * FAT_SECTORS) * SECTOR
+        for n, value in fat.items():
+            struct.pack_into('<I', image, base + 4 * n, value)
+
+    wav, frag = content(700), content(1800)
+    short = b'LONGRE~1WAV'
+    root = [short_entry(b'OLDLABEL   ', attr=0x08)] + \
+        lfn_entries(LONG_NAME, short) + [
+        short_entry(short, cluster=4, size=len(wav)),
+        short_entry(b'AM01       ', attr=0x10, cluster=3),
+        short_entry(b'BROKEN  BIN', cluster=12, size=2000)]
+    image[cluster_offset(2):cluster_offset(2) + 32 * len(root)] = \
+        b''.join(root)
+    subdir = [short_entry(b'.          ', attr=0x10, cluster=3),
+              short_entry(b'..         ', attr=0x10),
+              short_entry(b'FRAG    BIN', cluster=6, size=len(frag))]
+    image[cluster_offset(3):cluster_offset(3) + 32 * len(subdir)] = \
+        b''.join(subdir)
+
+    image[cluster_offset(4):cluster_offset(4) + len(wav)] = wav
+    image[cluster_offset(6):cluster_offset(8)] = frag[:1024]
+    image[cluster_offset(10):cluster_offset(10) + 776] = frag[1024:]
+    image[cluster_offset(12):cluster_offset(13)] = b'B' * SECTOR
+    # Leftovers in free clusters, which imaging skips
+    image[cluster_offset(8):cluster_offset(10)] = b'X' * 2 * SECTOR
+
+    path = tmp_path / 'card.img'
+    path.write_bytes(bytes(image))
+    return {'path': str(path), 'wav': wav, 'frag': frag}
+
+
+def test_long_names_and_mtimes(card):
+    with FatReader(card['path']) as fat:
+        root = {entry['name']: entry for entry in fat.list_dir()}
+        assert sorted(root) == ['AM01', 'BROKEN.BIN', LONG_NAME]
+        assert root['AM01']['is_dir']
+        assert root[LONG_NAME]['size'] == 700
+        assert root[LONG_NAME]['mtime'] == MTIME
+        paths = sorted(path for path, _ in fat.walk())
+    assert paths == [os.path.join('AM01', 'FRAG.BIN'), 'BROKEN.BIN',
+                     LONG_NAME]
+
+
+def test_mtimes_are_local(card, monkeypatch):
+    # As the vfat driver reads them: shifted by the local UTC offset
+    monkeypatch.setenv('TZ', 'Asia/Kolkata')
+    time.tzset()
+    with FatReader(card['path']) as fat:
+        assert fat.list_dir()[0]['mtime'] == MTIME - 5.5 * 3600
+    with FatReader(card['path'], utc_offset=0) as fat:
+        assert fat.list_dir()[0]['mtime'] == MTIME
+
+
+def test_mount_utc_offset(card, tmp_path):
+    # The mount shifts times by the kernel's offset (here +1h, set at
+    # boot), whatever the local offset is now (UTC)
+    mount = tmp_path / 'mnt'
+    mount.mkdir()
+    assert mount_utc_offset(card['path'], mount) is None
+    (mount / LONG_NAME).write_bytes(card['wav'])
+    os.utime(mount / LONG_NAME, (MTIME - 3600 + 1, MTIME - 3600 + 1))
+    assert mount_utc_offset(card['path'], mount) == 3600
+    out = tmp_path / 'out'
+    extract_image(card['path'], out, utc_offset=3600)
+    assert os.stat(out / LONG_NAME).st_mtime == MTIME - 3600
+
+
+def test_fragmented_chain(card):
+    with FatReader(card['path']) as fat:
+        assert fat.runs(6) == [[cluster_offset(6), 2 * SECTOR],
+                               [cluster_offset(10), 2 * SECTOR]]
+
+
+def test_extract(card, tmp_path):
+    out = tmp_path / 'out'
+    result = extract_image(card['path'], out)
+    wav, frag = out / LONG_NAME, out / 'AM01' / 'FRAG.BIN'
+    assert wav.read_bytes() == card['wav']
+    assert frag.read_bytes() == card['frag']
+    assert os.stat(wav).st_mtime == MTIME
+    assert result['files'][str(frag)] == 1800
+    assert result['short'] == {str(out / 'BROKEN.BIN'): 2000}
+    assert (out / 'BROKEN.BIN').read_bytes() == b'B' * SECTOR
+
+
+def test_image_reads_used_clusters_only(card, tmp_path):
+    image = str(tmp_path / 'copy.img')
+    result = image_card(card['path'], image, block=SECTOR)
+    # Metadata region, clusters 2-7 and 10-12
+    assert result['bytes_read'] == DATA_START + 9 * SECTOR
+    assert result['clusters_used'] == 9
+    with open(image, 'rb') as f:
+        f.seek(cluster_offset(8))
+        assert f.read(2 * SECTOR) == bytes(2 * SECTOR)
+    extract_image(image, tmp_path / 'out')
+    assert (tmp_path / 'out' / 'AM01' / 'FRAG.BIN').read_bytes() == \
+        card['frag']
+
+
+def test_patch_volume(card):
+    with open(card['path'], 'rb') as f:
+        boot = parse_boot_sector(f.read(SECTOR))
+        f.seek(0)
+        buf = bytearray(f.read(metadata_length(boot)))
+    patch_volume(buf, 'am07', 0x1234ABCD)
+    with open(card['path'], 'r+b') as f:
+        f.write(buf)
+    assert read_volume_info(card['path']) == {
+        'label': 'AM07', 'boot_label': 'AM07', 'serial': '1234-ABCD'}
+    with open(card['path'], 'rb') as f:
+        f.seek(6 * SECTOR + 0x43)
+        assert struct.unpack('<I', f.read(4))[0] == 0x1234ABCD
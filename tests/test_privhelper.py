@@ -0,0 +1,68 @@
+import io
+import json
+import os
+import time
+from concurrent.futures import Future
+
+import pytest
+from fieldtools.src import privhelper
+
+
+def serve(*requests):
+    stdin = io.StringIO(''.join(json.dumps(r) + '\n' for r in requests))
+    stdout = io.StringIO()
+    privhelper.serve(stdin, stdout)
+    return {m['id']: m['results']
+            for m in map(json.loads, stdout.getvalue().splitlines())}
+
+
+def test_failed_operations_still_get_a_reply(tmp_path, monkeypatch):
+    def broken(*args, timeout):
+        raise ValueError('broken')
+    monkeypatch.setitem(privhelper.OPERATIONS, 'broken', broken)
+    replies = serve(
+        {'id': 1, 'sequences': [[{'op': 'broken'}]]},
+        {'id': 2, 'sequences': [[{'args': []}]]},
+        {'id': 3, 'sequences': [['not an op']]},
+        {'id': 4, 'sequences': [[{'op': 'mkdir',
+                                  'args': [str(tmp_path / 'new')]}]]})
+    assert set(replies) == {1, 2, 3, 4}
+    assert replies[1][0][0]['returncode'] == -1
+    assert 'broken' in replies[1][0][0]['stderr']
+    assert replies[2][0][0]['returncode'] == -1
+    assert replies[3][0][0]['returncode'] == -1
+    assert replies[4][0][0]['returncode'] == 0
+    assert (tmp_path / 'new').is_dir()
+
+
+def test_read_ranges(tmp_path):
+    source, image = tmp_path / 'card', tmp_path / 'card.img'
+    source.write_bytes(bytes(range(256)) * 64)
+    image.write_bytes(b'')
+    result = privhelper._read_ranges(str(source), str(image),
+                                     [[0, 16], [1024, 2048]], timeout=30)
+    assert result['returncode'] == 0, result['stderr']
+    data = image.read_bytes()
+    assert data[:16] == source.read_bytes()[:16]
+    assert data[1024:2048] == source.read_bytes()[1024:2048]
+
+
+def test_read_ranges_timeout(tmp_path):
+    # A fifo with no writer blocks the read, like a card that stopped
+    # answering
+    fifo = tmp_path / 'stuck'
+    os.mkfifo(fifo)
+    (tmp_path / 'card.img').write_bytes(b'')
+    start = time.monotonic()
+    result = privhelper._read_ranges(str(fifo), str(tmp_path / 'card.img'),
+                                     [[0, 16]], timeout=1)
+    assert result['returncode'] == -1
+    assert time.monotonic() - start < 10
+
+
+def test_client_timeout(monkeypatch):
+    helper = privhelper.PrivilegedHelper()
+    monkeypatch.setattr(privhelper, 'REPLY_MARGIN', 0)
+    monkeypatch.setattr(helper, 'submit', lambda *a, **k: Future())
+    with pytest.raises(privhelper.HelperError):
+        helper.run_one('mount', 'x', 'y', timeout=.1)
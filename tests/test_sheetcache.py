@@ -0,0 +1,84 @@
+import os
+
+import pytest
+from fieldtools.src.sheetcache import (LocalSheetSource, SheetCache,
+                                       SheetUnavailable)
+
+
+class CountingSource(LocalSheetSource):
+    # Counts downloads; fails every call once `broken` is set
+
+    def __init__(self, directory):
+        super().__init__(directory)
+        self.fetches = 0
+        self.broken = False
+
+    def revision(self, key):
+        if self.broken:
+            raise ConnectionError('no connection')
+        return super().revision(key)
+
+    def fetch(self, key, has_header=True):
+        if self.broken:
+            raise ConnectionError('no connection')
+        self.fetches += 1
+        return super().fetch(key, has_header)
+
+
+@pytest.fixture
+def source(tmp_path):
+    (tmp_path / 'sheets').mkdir()
+    return CountingSource(tmp_path / 'sheets')
+
+
+def write_sheet(source, key, rows, mtime_ns):
+    path = os.path.join(source.directory, f'{key}.csv')
+    with open(path, 'w') as f:
+        f.write('Nestbox,AM\n' + ''.join(f'{n},{am}\n' for n, am in rows))
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_ttl(source, tmp_path):
+    cache = SheetCache(source, tmp_path / 'cache', ttl=3600)
+    write_sheet(source, 'abc', [('W12', '01')], 10 ** 18)
+    assert list(cache.get('abc')['Nestbox']) == ['W12']
+    write_sheet(source, 'abc', [('C3', '02')], 2 * 10 ** 18)
+    # Younger than the ttl: not checked
+    assert list(cache.get('abc')['Nestbox']) == ['W12']
+    assert source.fetches == 1
+    assert cache.snapshot_time('abc') is not None
+
+
+def test_revision(source, tmp_path):
+    cache = SheetCache(source, tmp_path / 'cache', ttl=0)
+    write_sheet(source, 'abc', [('W12', '01')], 10 ** 18)
+    cache.get('abc')
+    # Same revision: not downloaded again
+    assert list(cache.get('abc')['AM']) == ['01']
+    assert source.fetches == 1
+    write_sheet(source, 'abc', [('C3', '02')], 2 * 10 ** 18)
+    assert list(cache.get('abc')['Nestbox']) == ['C3']
+    assert source.fetches == 2
+    # Header modes are cached separately
+    assert list(cache.get('abc', has_header=False)[0]) == ['Nestbox', 'C3']
+
+
+def test_source_unavailable(source, tmp_path):
+    cache = SheetCache(source, tmp_path / 'cache', ttl=0)
+    write_sheet(source, 'abc', [('W12', '01')], 10 ** 18)
+    cache.get('abc')
+    source.broken = True
+    assert list(cache.get('abc')['Nestbox']) == ['W12']
+    with pytest.raises(SheetUnavailable):
+        cache.get('never-downloaded')
+
+
+def test_offline(source, tmp_path):
+    write_sheet(source, 'abc', [('W12', '01')], 10 ** 18)
+    SheetCache(source, tmp_path / 'cache').get('abc')
+    offline = SheetCache(source, tmp_path / 'cache', ttl=0, offline=True)
+    write_sheet(source, 'abc', [('C3', '02')], 2 * 10 ** 18)
+    assert list(offline.get('abc')['Nestbox']) == ['W12']
+    assert source.fetches == 1
+    with pytest.raises(SheetUnavailable):
+        offline.get('abc', has_header=False)